@@ -0,0 +1,101 @@
+import time
+from contextlib import contextmanager
+from functools import partial
+from unittest import mock
+
+
+def fake_address(latitude, longitude, api_key=None, latency=0.0):
+    """
+    Stand-in for reverse geocoding, returns address made of coordinates
+    :param latitude: location latitude
+    :param longitude: location longitude
+    :param api_key: ignored
+    :param latency: simulated request time in seconds
+    :return: physical address
+    :rtype: str
+    """
+    time.sleep(latency)
+    return f'{latitude:.5f}, {longitude:.5f}, Benchmark street'
+
+
+def fake_day_temperatures(latitude, day, hours=24):
+    """
+    Plausible hourly temperatures that depend on latitude and day
+    :param latitude: city latitude
+    :param day: day number in relation to current day
+    :param hours: number of values
+    :rtype: List[float]
+    """
+    base = 30 - abs(latitude) / 2 + day
+    return [round(base + 5 * ((hour % 24) - 12) / 12, 2) for hour in range(hours)]
+
+
+def fake_day_hist_temp(day_num, latitude, longitude, latency=0.0):
+    """
+    Stand-in for get_day_hist_temp
+    :param day_num: day number in range (-5, 0)
+    :param latitude: city latitude
+    :param longitude: city longitude
+    :param latency: simulated request time in seconds
+    :return: list of day temperatures
+    :rtype: List[float]
+    """
+    time.sleep(latency)
+    return fake_day_temperatures(latitude, day_num, hours=24 if day_num else 12)
+
+
+def fake_forecast_temp_list(coord_tuple, latency=0.0):
+    """
+    Stand-in for get_forecast_temp_list
+    :param coord_tuple: latitude and longitude
+    :param latency: simulated request time in seconds
+    :return: list of today forecast temperatures and list of lists of coming 4 days temps
+    :rtype: tuple[list,list[list]]
+    """
+    time.sleep(latency)
+    latitude, _ = coord_tuple
+    forecast_today = fake_day_temperatures(latitude, 0, hours=12)[::3]
+    forecast_4days = [fake_day_temperatures(latitude, day)[::3] for day in range(1, 5)]
+    return forecast_today, forecast_4days
+
+
+def fake_city_timezone(latitude, longitude, latency=0.0):
+    """
+    Stand-in for get_city_timezone, timezone is approximated with longitude
+    :param latitude: city latitude
+    :param longitude: city longitude
+    :param latency: simulated request time in seconds
+    :return: timezone (i.e. time shift in seconds from UTC time)
+    :rtype: int
+    """
+    time.sleep(latency)
+    return round(longitude / 15) * 3600
+
+
+def fake_addresses_batch(locations, api_key=None, latency=0.0):
+    """
+    Stand-in for batch reverse geocoding, one simulated request for all locations
+    :param locations: latitude, longitude pairs
+    :param api_key: ignored
+    :param latency: simulated request time in seconds
+    :return: physical addresses
+    :rtype: List[str]
+    """
+    time.sleep(latency)
+    return [fake_address(latitude, longitude) for latitude, longitude in locations]
+
+
+@contextmanager
+def fake_services(latency=0.0):
+    """
+    Replaces geocoding and weather requests made by pipeline with local stand-ins
+    :param latency: simulated time of one request in seconds
+    :return: context manager
+    """
+    fake_forecast = partial(fake_forecast_temp_list, latency=latency)
+    with mock.patch('toolbox.geo_tools.get_address', partial(fake_address, latency=latency)), \
+            mock.patch('toolbox.geo_tools.get_addresses_batch', partial(fake_addresses_batch, latency=latency)), \
+            mock.patch('toolbox.weather_tools.get_day_hist_temp', partial(fake_day_hist_temp, latency=latency)), \
+            mock.patch('toolbox.weather_tools.get_forecast_temp_list', fake_forecast), \
+            mock.patch('toolbox.weather_tools.get_city_timezone', partial(fake_city_timezone, latency=latency)):
+        yield
@@ -0,0 +1,114 @@
+import csv
+import io
+import os
+import pathlib
+from zipfile import ZIP_DEFLATED, ZipFile
+
+import click
+import numpy as np
+
+COUNTRIES = ('US', 'GB', 'FR', 'IT', 'ES', 'DE', 'NL', 'AT', 'RU', 'JP', 'BR', 'AU')
+CITIES_PER_COUNTRY = 200
+ROWS_PER_FILE = 100000
+INVALID_SHARE = 0.02
+HEADER = ['Id', 'Name', 'Country', 'City', 'Latitude', 'Longitude']
+
+
+def generate_rows(hotels, seed=0, start_id=0):
+    """
+    Generates synthetic hotels rows. City sizes follow Zipf distribution, so each country has one major city;
+    small share of rows is invalid (unknown country, missing city or coordinate out of range),
+    some hotel names contain commas and need csv quoting
+    :param hotels: number of rows
+    :param seed: random generator seed, the same seed gives the same rows
+    :param start_id: first hotel id
+    :return: rows with id, name, country, city, latitude, longitude
+    :rtype: Generator[list]
+    """
+    rng = np.random.default_rng(seed)
+    city_centers = rng.uniform((-60, -170), (70, 170), size=(len(COUNTRIES), CITIES_PER_COUNTRY, 2))
+    country_indexes = rng.integers(0, len(COUNTRIES), size=hotels)
+    city_indexes = np.minimum(rng.zipf(1.5, size=hotels) - 1, CITIES_PER_COUNTRY - 1)
+    offsets = rng.normal(0, 0.05, size=(hotels, 2))
+    invalid = rng.random(hotels) < INVALID_SHARE
+    with_comma = rng.random(hotels) < 0.01
+    for i in range(hotels):
+        country_index, city_index = country_indexes[i], city_indexes[i]
+        latitude, longitude = city_centers[country_index, city_index] + offsets[i]
+        country, city = COUNTRIES[country_index], f'City {city_index}'
+        name = f'Hotel {start_id + i}, Resort & Spa' if with_comma[i] else f'Hotel {start_id + i}'
+        if invalid[i]:
+            kind = i % 3
+            if kind == 0:
+                country = 'OO'
+            elif kind == 1:
+                city = ''
+            else:
+                latitude = 200.0
+        yield [start_id + i, name, country, city, round(latitude, 6), round(longitude, 6)]
+
+
+def write_csv_part(stream, rows):
+    """
+    Writes header and rows to csv text stream, fields with commas are quoted
+    :param stream: text stream
+    :param rows: hotels rows
+    :return: None
+    """
+    writer = csv.writer(stream, lineterminator='\n')
+    writer.writerow(HEADER)
+    writer.writerows(rows)
+
+
+def write_hotels(output_path, hotels, seed=0, as_zip=True, rows_per_file=ROWS_PER_FILE):
+    """
+    Writes synthetic hotels dataset as zip archive or directory with csv files of limited size
+    :param output_path: path to zip file or directory to create
+    :param hotels: total number of hotels
+    :param seed: random generator seed
+    :param as_zip: write zip archive instead of directory
+    :param rows_per_file: maximal number of hotels in one csv file
+    :return: path to written dataset
+    :rtype: str
+    """
+    def part_rows(part):
+        start = part * rows_per_file
+        return generate_rows(min(rows_per_file, hotels - start), seed=seed + part, start_id=start)
+
+    parts = range((hotels + rows_per_file - 1) // rows_per_file)
+    if as_zip:
+        pathlib.Path(os.path.dirname(os.path.abspath(output_path))).mkdir(parents=True, exist_ok=True)
+        with ZipFile(output_path, 'w', compression=ZIP_DEFLATED) as zip_file:
+            for part in parts:
+                with zip_file.open(f'part-{part:05d}.csv', 'w') as raw_stream:
+                    with io.TextIOWrapper(raw_stream, encoding='utf-8', newline='') as stream:
+                        write_csv_part(stream, part_rows(part))
+    else:
+        pathlib.Path(output_path).mkdir(parents=True, exist_ok=True)
+        for part in parts:
+            with open(os.path.join(output_path, f'part-{part:05d}.csv'), 'w', encoding='utf-8', newline='') as stream:
+                write_csv_part(stream, part_rows(part))
+    return output_path
+
+
+@click.command()
+@click.argument('output_path', type=click.Path())
+@click.option('-n', '--hotels', type=int, default=10000, help='Number of hotels to generate')
+@click.option('-s', '--seed', type=int, default=0, help='Random generator seed')
+@click.option('--zip/--directory', 'as_zip', default=True, help='Write zip archive or directory with csv files')
+def main(output_path, hotels, seed, as_zip):
+    """
+    Generates synthetic hotels dataset in the same format as source data.
+
+    :param output_path: path to zip file or directory to create
+    :param hotels: number of hotels
+    :param seed: random generator seed
+    :param as_zip: write zip archive instead of directory
+    :return: None
+    """
+    write_hotels(output_path, hotels, seed=seed, as_zip=as_zip)
+    click.echo(f'{hotels} hotels written to {output_path}')
+
+
+if __name__ == '__main__':
+    main()
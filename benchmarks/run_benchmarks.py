@@ -0,0 +1,192 @@
+import datetime
+import json
+import os
+import pathlib
+import platform
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+
+import click
+
+from models import CityData, DailyTemperature, Hotel, IngestedFile, MajorCity
+from toolbox.data_tools import WEB_IMAGES_DIR
+from toolbox.db_tools import (create_and_save_all_plots,
+                              fill_addresses_for_major_cities,
+                              fill_major_cities_table,
+                              fill_major_cities_table_with_coordinates,
+                              fill_major_cities_table_with_temperatures,
+                              fill_table_from_csv, find_major_cities,
+                              link_hotels_to_major_cities, start_db_session,
+                              write_from_db_to_files,
+                              write_temperature_analytics)
+from toolbox.os_tools import find_csv_sources, path_to_
+
+from .fake_services import fake_services
+from .generate_hotels import write_hotels
+from .stand_in_server import stand_in_services
+
+STAGES = (
+    'ingest', 'find_major_cities', 'geocoding', 'city_centers', 'weather', 'plotting', 'analytics', 'csv_export'
+)
+
+
+@contextmanager
+def timed(timings, stage):
+    """
+    Measures wall time of code block
+    :param timings: stage name to seconds mapping to update
+    :param stage: stage name
+    :return: context manager
+    """
+    start = time.perf_counter()
+    yield
+    timings[stage] = time.perf_counter() - start
+
+
+def dataset_path(data_dir, hotels, seed):
+    """
+    Returns path to synthetic dataset zip file, generates it if it doesn't exist yet
+    :param data_dir: directory with generated datasets
+    :param hotels: number of hotels
+    :param seed: random generator seed
+    :rtype: str
+    """
+    path = os.path.join(data_dir, f'hotels_{hotels}_{seed}.zip')
+    if not os.path.exists(path):
+        write_hotels(path, hotels, seed=seed)
+    return path
+
+
+def run_pipeline(source_path, work_dir, threads=4, workers=1):
+    """
+    Runs the same stages as console pipeline on fresh database and measures each of them
+    :param source_path: path to zip file with hotels csv files
+    :param work_dir: directory for database, output files and web images
+    :param threads: number of threads for geocoding and weather requests
+    :param workers: number of processes validating csv files
+    :return: seconds per stage and sizes of processed data
+    :rtype: tuple[dict,dict]
+    """
+    timings = {}
+    session = start_db_session(f"sqlite:///{os.path.join(work_dir, 'bench.sqlite3')}")
+    output_path = os.path.join(work_dir, 'output')
+    pathlib.Path(work_dir, WEB_IMAGES_DIR).mkdir(parents=True, exist_ok=True)
+
+    with timed(timings, 'ingest'):
+        inserted, _, rejected = fill_table_from_csv(
+            find_csv_sources(source_path), session, Hotel, IngestedFile, workers=workers)
+    with timed(timings, 'find_major_cities'):
+        major_cities = find_major_cities(session, Hotel)
+        fill_major_cities_table(session, MajorCity, major_cities)
+        link_hotels_to_major_cities(session, Hotel, MajorCity)
+    with timed(timings, 'geocoding'):
+        fill_addresses_for_major_cities(session, Hotel, threads=threads)
+    with timed(timings, 'city_centers'):
+        fill_major_cities_table_with_coordinates(session, Hotel, CityData, MajorCity)
+    with timed(timings, 'weather'):
+        fill_major_cities_table_with_temperatures(session, CityData, DailyTemperature, threads=threads)
+    with timed(timings, 'plotting'):
+        create_and_save_all_plots(session, CityData, DailyTemperature, output_path, web_root=work_dir)
+    with timed(timings, 'analytics'):
+        write_temperature_analytics(session, CityData, DailyTemperature, output_path)
+    with timed(timings, 'csv_export'):
+        write_from_db_to_files(output_path, session, Hotel, MajorCity)
+
+    counts = {
+        'hotels': inserted,
+        'rejected': sum(rejected.values()),
+        'major_cities': len(major_cities),
+        'geocoded': session.query(Hotel).filter(Hotel.address.isnot(None)).count(),
+    }
+    session.close()
+    return timings, counts
+
+
+def compare_results(results, baseline, tolerance):
+    """
+    Finds stages that became slower than in baseline run by more than tolerance
+    :param results: current benchmark results
+    :param baseline: previous benchmark results
+    :param tolerance: allowed relative slowdown, e.g. 0.2 for 20%
+    :return: size, stage, baseline seconds, current seconds for each regression
+    :rtype: List[tuple]
+    """
+    previous_runs = {run['hotels_requested']: run for run in baseline['runs']}
+    regressions = []
+    for run in results['runs']:
+        previous_run = previous_runs.get(run['hotels_requested'])
+        if not previous_run:
+            continue
+        for stage, seconds in run['stages'].items():
+            previous_seconds = previous_run['stages'].get(stage)
+            if previous_seconds and seconds > previous_seconds * (1 + tolerance):
+                regressions.append((run['hotels_requested'], stage, previous_seconds, seconds))
+    return regressions
+
+
+@click.command()
+@click.option('-n', '--hotels', 'sizes', type=int, multiple=True, default=[10000],
+              help='Dataset size, may be repeated, e.g. -n 10000 -n 1000000')
+@click.option('-t', '--threads', type=int, default=4, help='Number of threads for geocoding and weather requests')
+@click.option('-w', '--workers', type=int, default=1, help='Number of processes validating csv files')
+@click.option('-l', '--latency', type=float, default=0.0, help='Simulated latency of one API request in seconds')
+@click.option('--stand-in-server', is_flag=True,
+              help='Send requests over HTTP to local stand-in server instead of in-process stand-ins')
+@click.option('-s', '--seed', type=int, default=0, help='Random generator seed for synthetic datasets')
+@click.option('--data-dir', type=click.Path(), default=path_to_('benchmarks', 'data'),
+              help='Directory for generated datasets')
+@click.option('-o', '--output', type=click.Path(), default='bench_results.json', help='Path to JSON results file')
+@click.option('-b', '--baseline', type=click.Path(exists=True), default=None,
+              help='Previous JSON results file to compare with')
+@click.option('--tolerance', type=float, default=0.2, help='Allowed relative slowdown of a stage compared to baseline')
+def main(sizes, threads, workers, latency, stand_in_server, seed, data_dir, output, baseline, tolerance):
+    """
+    Runs pipeline stages on synthetic hotels datasets with local stand-ins for geocoding and weather services.
+    Writes timings of each stage to JSON file and optionally compares them with previous results.
+
+    :return: None
+    """
+    pathlib.Path(data_dir).mkdir(parents=True, exist_ok=True)
+    results = {
+        'started': datetime.datetime.utcnow().isoformat(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'parameters': {
+            'threads': threads, 'workers': workers, 'latency': latency, 'stand_in_server': stand_in_server, 'seed': seed
+        },
+        'runs': [],
+    }
+    for hotels in sizes:
+        click.echo(f'Preparing dataset with {hotels} hotels...')
+        source_path = dataset_path(data_dir, hotels, seed)
+        click.echo('Running pipeline...')
+        services = stand_in_services(latency=latency) if stand_in_server else fake_services(latency=latency)
+        with tempfile.TemporaryDirectory() as work_dir, services:
+            timings, counts = run_pipeline(source_path, work_dir, threads=threads, workers=workers)
+        results['runs'].append({
+            'hotels_requested': hotels,
+            **counts,
+            'stages': timings,
+            'total': sum(timings.values()),
+            'ingest_rows_per_second': counts['hotels'] / timings['ingest'] if timings['ingest'] else None,
+        })
+        for stage in STAGES:
+            click.echo(f'  {stage:<18}{timings[stage]:10.3f} s')
+
+    with open(output, 'w') as output_file:
+        json.dump(results, output_file, indent=4)
+    click.echo(f'Results saved to {output}')
+
+    if baseline:
+        with open(baseline) as baseline_file:
+            regressions = compare_results(results, json.load(baseline_file), tolerance)
+        for hotels, stage, previous_seconds, seconds in regressions:
+            click.echo(f'REGRESSION: {stage} on {hotels} hotels took {seconds:.3f} s (was {previous_seconds:.3f} s)')
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
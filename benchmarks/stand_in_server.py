@@ -0,0 +1,485 @@
+import datetime
+import json
+import math
+import os
+import random
+import threading
+import time
+import zlib
+from collections import Counter, deque
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+import click
+import requests
+
+from toolbox import geo_tools, weather_tools
+from toolbox.time_tools import find_timezone_name, get_zone_timezone
+
+UPSTREAMS = {
+    '/data/2.5/': 'https://api.openweathermap.org',
+    '/nominatim/': 'https://open.mapquestapi.com',
+    '/geocoding/': 'https://www.mapquestapi.com',
+}
+STREETS = ('Main Street', 'High Street', 'Station Road', 'Park Avenue', 'Church Lane', 'Market Square', 'Mill Road')
+SECONDS_PER_DAY = 24 * 60 * 60
+FORECAST_STEP = 3 * 60 * 60
+FORECAST_STEPS = 40
+
+
+def location_hash(latitude, longitude, *extra):
+    """
+    Stable number derived from rounded coordinates, so synthesized responses are the same on every run
+    :param latitude: location latitude
+    :param longitude: location longitude
+    :param extra: other values response depends on, e.g. day
+    :rtype: int
+    """
+    return zlib.crc32(f'{latitude:.4f},{longitude:.4f},{extra}'.encode())
+
+
+def location_timezone(latitude, longitude):
+    """
+    Timezone shift of location in seconds, approximated offline with zone of the nearest principal location
+    :param latitude: location latitude
+    :param longitude: location longitude
+    :rtype: int
+    """
+    timezone = get_zone_timezone(find_timezone_name(latitude, longitude))
+    return timezone if timezone is not None else round(longitude / 15) * 3600
+
+
+def synthetic_temperature(latitude, longitude, timestamp, timezone):
+    """
+    Plausible air temperature: colder at high latitudes, seasonal in both hemispheres,
+    warmest in the afternoon, with stable day-to-day noise
+    :param latitude: location latitude
+    :param longitude: location longitude
+    :param timestamp: unix timestamp
+    :param timezone: timezone shift in seconds
+    :return: temperature in Celsius
+    :rtype: float
+    """
+    local_time = datetime.datetime.utcfromtimestamp(timestamp + timezone)
+    season = math.cos(2 * math.pi * (local_time.timetuple().tm_yday - 196) / 365)
+    seasonal = 12 * min(abs(latitude), 60) / 60 * season * (1 if latitude >= 0 else -1)
+    daily = 5 * math.sin(2 * math.pi * (local_time.hour + local_time.minute / 60 - 9) / 24)
+    noise = location_hash(latitude, longitude, local_time.date().isoformat()) % 400 / 100 - 2
+    return round(28 - 0.45 * abs(latitude) + seasonal + daily + noise, 2)
+
+
+def requested_location(params):
+    """
+    Requested location of weather or reverse geocoding request
+    :param params: parsed query parameters
+    :return: latitude, longitude
+    :rtype: tuple[float]
+    """
+    return float(params['lat'][0]), float(params['lon'][0])
+
+
+def batch_locations(params):
+    """
+    Requested locations of batch geocoding request
+    :param params: parsed query parameters
+    :return: latitude, longitude pairs
+    :rtype: List[tuple[float]]
+    """
+    return [tuple(float(value) for value in location.split(',')) for location in params['location']]
+
+
+def synthesize_current(params, now):
+    """
+    Current weather response with timezone, like OpenWeatherMap /data/2.5/weather
+    :rtype: dict
+    """
+    latitude, longitude = requested_location(params)
+    timezone = location_timezone(latitude, longitude)
+    return {
+        'coord': {'lat': latitude, 'lon': longitude},
+        'main': {'temp': synthetic_temperature(latitude, longitude, now, timezone)},
+        'dt': int(now),
+        'timezone': timezone,
+        'name': 'Stand-in',
+        'cod': 200,
+    }
+
+
+def synthesize_historic(params, now):
+    """
+    Hourly temperatures of local day that contains requested moment,
+    like OpenWeatherMap /data/2.5/onecall/timemachine. Hours in future are not included
+    :rtype: dict
+    """
+    latitude, longitude = requested_location(params)
+    timezone = location_timezone(latitude, longitude)
+    moment = int(params['dt'][0])
+    day_start = moment - (moment + timezone) % SECONDS_PER_DAY
+    hours = [day_start + hour * 3600 for hour in range(24) if day_start + hour * 3600 <= now] or [day_start]
+    return {
+        'lat': latitude,
+        'lon': longitude,
+        'timezone_offset': timezone,
+        'current': {'dt': moment, 'temp': synthetic_temperature(latitude, longitude, moment, timezone)},
+        'hourly': [{'dt': hour, 'temp': synthetic_temperature(latitude, longitude, hour, timezone)} for hour in hours],
+    }
+
+
+def synthesize_forecast(params, now):
+    """
+    5 days forecast with 3 hours step, like OpenWeatherMap /data/2.5/forecast
+    :rtype: dict
+    """
+    latitude, longitude = requested_location(params)
+    timezone = location_timezone(latitude, longitude)
+    start = int(now) - int(now) % FORECAST_STEP + FORECAST_STEP
+    records = []
+    for step in range(FORECAST_STEPS):
+        moment = start + step * FORECAST_STEP
+        temperature = synthetic_temperature(latitude, longitude, moment, timezone)
+        records.append({
+            'dt': moment,
+            'main': {'temp': temperature, 'temp_min': temperature, 'temp_max': temperature},
+            'dt_txt': datetime.datetime.utcfromtimestamp(moment).strftime('%Y-%m-%d %H:%M:%S'),
+        })
+    return {'cod': '200', 'cnt': len(records), 'list': records, 'city': {'timezone': timezone}}
+
+
+def synthetic_address(latitude, longitude):
+    """
+    Plausible address parts of location
+    :rtype: dict
+    """
+    number = location_hash(latitude, longitude)
+    return {
+        'house_number': str(number % 200 + 1),
+        'road': STREETS[number % len(STREETS)],
+        'city': f'Stand-in City {number % 97}',
+        'postcode': str(number % 90000 + 10000),
+    }
+
+
+def synthesize_reverse(params, now):
+    """
+    Reverse geocoding response, like MapQuest /nominatim/v1/reverse
+    :rtype: dict
+    """
+    latitude, longitude = requested_location(params)
+    address = synthetic_address(latitude, longitude)
+    return {
+        'place_id': location_hash(latitude, longitude),
+        'lat': str(latitude),
+        'lon': str(longitude),
+        'display_name': ', '.join(address.values()),
+        'address': address,
+    }
+
+
+def synthesize_batch(params, now):
+    """
+    Batch reverse geocoding response, like MapQuest /geocoding/v1/batch
+    :rtype: dict
+    """
+    results = []
+    for latitude, longitude in batch_locations(params):
+        address = synthetic_address(latitude, longitude)
+        results.append({
+            'providedLocation': {'latLng': {'lat': latitude, 'lng': longitude}},
+            'locations': [{
+                'street': f"{address['house_number']} {address['road']}",
+                'adminArea5': address['city'],
+                'postalCode': address['postcode'],
+                'latLng': {'lat': latitude, 'lng': longitude},
+            }],
+        })
+    return {'info': {'statuscode': 0, 'messages': []}, 'results': results}
+
+
+ENDPOINTS = {
+    '/data/2.5/weather': synthesize_current,
+    '/data/2.5/onecall/timemachine': synthesize_historic,
+    '/data/2.5/forecast': synthesize_forecast,
+    '/nominatim/v1/reverse': synthesize_reverse,
+    '/geocoding/v1/batch': synthesize_batch,
+}
+
+
+def recording_key(path, params, now):
+    """
+    Key of recorded response: endpoint and rounded coordinates, historic requests also include number of days ago
+    (in location local time), so recordings made on another day are replayed for the same relative day
+    :param path: endpoint path
+    :param params: parsed query parameters
+    :param now: current timestamp
+    :rtype: str
+    """
+    if path == '/geocoding/v1/batch':
+        return f"{path}|{';'.join(f'{lat:.4f},{lon:.4f}' for lat, lon in batch_locations(params))}"
+    latitude, longitude = requested_location(params)
+    key = f'{path}|{latitude:.4f},{longitude:.4f}'
+    if 'dt' in params:
+        timezone = location_timezone(latitude, longitude)
+        days_ago = (int(now) + timezone) // SECONDS_PER_DAY - (int(params['dt'][0]) + timezone) // SECONDS_PER_DAY
+        key += f'|{days_ago}'
+    return key
+
+
+def shift_timestamps(value, seconds):
+    """
+    Moves all 'dt' timestamps of recorded response by given number of seconds
+    :param value: decoded JSON response
+    :param seconds: shift in seconds
+    :return: response with shifted timestamps
+    """
+    if isinstance(value, dict):
+        return {key: item + seconds if key == 'dt' and isinstance(item, int) else shift_timestamps(item, seconds)
+                for key, item in value.items()}
+    if isinstance(value, list):
+        return [shift_timestamps(item, seconds) for item in value]
+    return value
+
+
+class StandInServer:
+    """
+    Local HTTP server that stands in for OpenWeatherMap and MapQuest APIs.
+    Replays recorded responses, synthesizes plausible responses for requests that weren't recorded
+    or, in record mode, forwards them to real service and records responses.
+    Simulates latency, server errors and rate limiting with 429 responses
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, recordings_path=None, record=False, latency=0.0, error_rate=0.0,
+                 rate_limit=None, api_keys=None, seed=0):
+        """
+        :param host: interface to listen on
+        :param port: port to listen on, 0 for any free port
+        :param recordings_path: path to JSON file with recorded responses
+        :param record: forward requests that weren't recorded to real services and save their responses
+        :param latency: seconds added to every response
+        :param error_rate: share of requests answered with 503 status
+        :param rate_limit: maximal number of requests per second, requests over limit are answered with 429 status
+        :param api_keys: accepted API keys, requests with other keys are answered with 401 status; any key if None
+        :param seed: random generator seed for errors simulation
+        """
+        self.recordings_path = recordings_path
+        self.record = record
+        self.latency = latency
+        self.error_rate = error_rate
+        self.rate_limit = rate_limit
+        self.api_keys = set(api_keys) if api_keys else None
+        self.requests = Counter()
+        self.recordings = {}
+        if recordings_path and os.path.exists(recordings_path):
+            with open(recordings_path) as recordings_file:
+                self.recordings = json.load(recordings_file)
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._recent = deque()
+        self._server = ThreadingHTTPServer((host, port), StandInHandler)
+        self._server.daemon_threads = True
+        self._server.stand_in = self
+        self._thread = None
+
+    @property
+    def url(self):
+        """
+        Base url to configure weather_tools and geo_tools with
+        :rtype: str
+        """
+        host, port = self._server.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def start(self):
+        """
+        Starts serving requests in background thread
+        :return: None
+        """
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stops server and saves new recordings
+        :return: None
+        """
+        self._server.shutdown()
+        self._server.server_close()
+        if self.record and self.recordings_path:
+            self.save()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def save(self):
+        """
+        Writes recorded responses to recordings file
+        :return: None
+        """
+        with self._lock:
+            recordings = dict(self.recordings)
+        with open(self.recordings_path, 'w') as recordings_file:
+            json.dump(recordings, recordings_file, indent=1, sort_keys=True)
+
+    def is_rate_limited(self, now):
+        """
+        Counts request in one second sliding window
+        :param now: current timestamp
+        :return: `True` if request is over rate limit
+        :rtype: bool
+        """
+        if self.rate_limit is None:
+            return False
+        with self._lock:
+            while self._recent and self._recent[0] <= now - 1:
+                self._recent.popleft()
+            if len(self._recent) >= self.rate_limit:
+                return True
+            self._recent.append(now)
+            return False
+
+    def is_failed(self):
+        """
+        :return: `True` if request should be answered with server error
+        :rtype: bool
+        """
+        with self._lock:
+            return self._random.random() < self.error_rate
+
+    def forward(self, path, query):
+        """
+        Sends request to real service
+        :param path: endpoint path
+        :param query: original query string
+        :return: status and decoded JSON response
+        :rtype: tuple[int,dict]
+        """
+        base_url = next(url for prefix, url in UPSTREAMS.items() if path.startswith(prefix))
+        resp = requests.get(f'{base_url}{path}?{query}', timeout=10)
+        return resp.status_code, resp.json()
+
+    def respond(self, path, query):
+        """
+        Makes response to request
+        :param path: endpoint path
+        :param query: query string
+        :return: status, decoded JSON response, extra headers
+        :rtype: tuple[int,dict,dict]
+        """
+        now = time.time()
+        if path not in ENDPOINTS:
+            return 404, {'cod': 404, 'message': 'Not found'}, {}
+        if self.is_rate_limited(now):
+            return 429, {'cod': 429, 'message': 'Too many requests'}, {'Retry-After': '1'}
+        if self.latency:
+            time.sleep(self.latency)
+        if self.is_failed():
+            return 503, {'cod': 503, 'message': 'Service unavailable'}, {}
+        params = parse_qs(query)
+        api_key = (params.get('appid') or params.get('key') or [None])[0]
+        if self.api_keys is not None and api_key not in self.api_keys:
+            return 401, {'cod': 401, 'message': 'Invalid API key'}, {}
+        try:
+            key = recording_key(path, params, now)
+        except (KeyError, ValueError):
+            return 400, {'cod': 400, 'message': 'Nothing to geocode'}, {}
+        with self._lock:
+            recorded = self.recordings.get(key)
+        if recorded:
+            days = round((now - recorded['recorded_at']) / SECONDS_PER_DAY)
+            return recorded['status'], shift_timestamps(recorded['body'], days * SECONDS_PER_DAY), {}
+        if self.record:
+            status, body = self.forward(path, query)
+            if status == 200:
+                with self._lock:
+                    self.recordings[key] = {'status': status, 'recorded_at': int(now), 'body': body}
+            return status, body, {}
+        return 200, ENDPOINTS[path](params, now), {}
+
+    def count(self, path, status):
+        """
+        Counts served request
+        :param path: endpoint path
+        :param status: response status
+        :return: None
+        """
+        with self._lock:
+            self.requests[path, status] += 1
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """
+    Request handler of StandInServer, keeps connections alive like real services
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        stand_in = self.server.stand_in
+        status, body, headers = stand_in.respond(url.path, url.query)
+        stand_in.count(url.path, status)
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+@contextmanager
+def stand_in_services(**options):
+    """
+    Runs stand-in server and points weather and geocoding requests to it
+    :param options: StandInServer options, e.g. latency or error_rate
+    :return: context manager with running server
+    """
+    previous_weather_url, previous_geocode_url = weather_tools.WEATHER_BASE_URL, geo_tools.GEOCODE_BASE_URL
+    with StandInServer(**options) as server:
+        weather_tools.configure_weather_base_url(server.url)
+        geo_tools.configure_geocode_base_url(server.url)
+        try:
+            yield server
+        finally:
+            weather_tools.configure_weather_base_url(previous_weather_url)
+            geo_tools.configure_geocode_base_url(previous_geocode_url)
+
+
+@click.command()
+@click.option('--host', default='127.0.0.1', help='Interface to listen on')
+@click.option('-p', '--port', type=int, default=8000, help='Port to listen on')
+@click.option('-r', '--recordings', type=click.Path(), default=None, help='JSON file with recorded responses')
+@click.option('--record', is_flag=True, help='Forward requests that were not recorded to real services and record them')
+@click.option('-l', '--latency', type=float, default=0.0, help='Seconds added to every response')
+@click.option('-e', '--error-rate', type=float, default=0.0, help='Share of requests answered with 503 status')
+@click.option('--rate-limit', type=int, default=None, help='Requests per second, requests over limit get 429 status')
+@click.option('-s', '--seed', type=int, default=0, help='Random generator seed for errors simulation')
+def main(host, port, recordings, record, latency, error_rate, rate_limit, seed):
+    """
+    Runs local stand-in for OpenWeatherMap and MapQuest APIs until interrupted.
+    Point the application to it with WEATHER_BASE_URL and GEOCODE_BASE_URL environment variables.
+
+    :return: None
+    """
+    server = StandInServer(host, port, recordings_path=recordings, record=record, latency=latency,
+                           error_rate=error_rate, rate_limit=rate_limit, seed=seed)
+    click.echo(f'Stand-in server is listening on {server.url}')
+    click.echo(f'export WEATHER_BASE_URL={server.url} GEOCODE_BASE_URL={server.url}')
+    server.start()
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        server.stop()
+        click.echo(f'Served requests: {dict(server.requests)}')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,39 +1,89 @@
-import os
 import time
 
 import click
 
-from models import CityData, Hotel, MajorCity
-from toolbox.db_tools import (create_and_save_all_plots,
+from models import CityData, DailyTemperature, Hotel, IngestedFile, MajorCity
+from toolbox.data_tools import REJECTION_REASONS
+from toolbox.db_tools import (BULK_CHUNK_SIZE, create_and_save_all_plots,
                               fill_addresses_for_major_cities,
                               fill_major_cities_table,
                               fill_major_cities_table_with_coordinates,
                               fill_major_cities_table_with_temperatures,
                               fill_table_from_csv, find_major_cities,
-                              start_db_session, write_from_db_to_files,
+                              link_hotels_to_major_cities, start_db_session,
+                              write_from_db_to_files,
                               write_temperature_analytics)
-from toolbox.os_tools import unzip_next_to
+from toolbox.geo_tools import (GEOCODE_BATCH_SIZE, GEOCODE_CACHE_PRECISION,
+                               GEOCODE_CONCURRENCY, get_geocode_concurrency,
+                               open_geocode_cache)
+from toolbox.os_tools import find_csv_sources, write_concurrency_log
+from toolbox.weather_tools import (FORECAST_DAYS, HISTORIC_DAYS,
+                                   WEATHER_TIMEOUT, get_weather_concurrency,
+                                   get_weather_stats, open_weather_cache)
 from web import configure_app
 
 
 @click.command()
 @click.argument('source_path', type=click.Path())
 @click.argument('output_path', type=click.Path())
-@click.option('-t', '--threads', type=int, default=4, help='Number of threads in several I/O-bound functions')
+@click.option('-t', '--threads', type=int, default=4,
+              help='Initial number of parallel geocoding and weather requests')
+@click.option('--max-threads', type=int, default=32,
+              help='Maximal number of parallel requests, reached while services respond fast')
+@click.option('--concurrency-log', type=click.Path(), default=None,
+              help='Path to csv file with chosen number of parallel requests over time')
 @click.option('-d', '--database', type=click.Path(), default='sqlite:///db.sqlite3', help='Database path')
-def main(source_path, output_path, threads, database):
+@click.option('-c', '--chunk-size', type=int, default=BULK_CHUNK_SIZE, help='Number of hotels in one bulk insert')
+@click.option('-w', '--workers', type=int, default=1, help='Number of processes validating csv files')
+@click.option('--spherical-centers', is_flag=True, help='Use spherical mean of hotels locations as city center')
+@click.option('-g', '--geocode-cache', type=click.Path(), default='geocode_cache.sqlite3',
+              help='Path to reverse geocoding cache file')
+@click.option('--geocode-precision', type=int, default=GEOCODE_CACHE_PRECISION,
+              help='Number of decimal places coordinates are rounded to in geocoding cache')
+@click.option('--share-distance', type=float, default=0,
+              help='Maximal distance in meters between hotels that share one geocoding lookup')
+@click.option('-b', '--geocode-batch-size', type=click.IntRange(1, GEOCODE_BATCH_SIZE), default=1,
+              help='Number of locations in one geocoding request')
+@click.option('--async-geocoding', is_flag=True, help='Use asyncio geocoding engine instead of threads')
+@click.option('--concurrency', type=int, default=GEOCODE_CONCURRENCY,
+              help='Maximal number of geocoding requests in flight for asyncio engine')
+@click.option('--weather-timeout', type=float, default=WEATHER_TIMEOUT,
+              help='Seconds to wait for connection and response of weather service')
+@click.option('--weather-cache', type=click.Path(), default='weather_cache.sqlite3', help='Path to weather cache file')
+@click.option('--historic-days', type=click.IntRange(0, HISTORIC_DAYS), default=HISTORIC_DAYS,
+              help='Number of past days in temperature analysis')
+@click.option('--forecast-days', type=click.IntRange(0, FORECAST_DAYS), default=FORECAST_DAYS,
+              help='Number of coming days in temperature analysis')
+def main(source_path, output_path, threads, max_threads, concurrency_log, database, chunk_size, workers,
+         spherical_centers, geocode_cache, geocode_precision, share_distance, geocode_batch_size, async_geocoding,
+         concurrency, weather_timeout, weather_cache, historic_days, forecast_days):
     """
     Main pipeline for processing hotels data.
     Provides moderate command line interface with required and optional arguments.
     Extracts valid records from csv files to database; finds cities with maximal number of hotels in each country;
     for hotels in those cities brings physical addresses; gets temperature information for 10 days in total
-    starting from 5 days ago; creates temperature plots and other analytics; saves that analytics
-    to provided output folder along with all hotels addresses.
+    starting from 5 days ago (window is set with historic and forecast days); creates temperature plots
+    and other analytics; saves that analytics to provided output folder along with all hotels addresses.
 
     :param source_path: path to zip folder with source data, required argument
     :param output_path: path to directory where results should be saved, required argument
-    :param threads: number of threads in several I/O-bound functions, optional argument
+    :param threads: initial number of parallel geocoding and weather requests, optional argument
+    :param max_threads: maximal number of parallel geocoding and weather requests, optional argument
+    :param concurrency_log: path to csv file with chosen number of parallel requests over time, optional argument
     :param database: database path, optional argument
+    :param chunk_size: number of hotels in one bulk insert, optional argument
+    :param workers: number of processes validating csv files, optional argument
+    :param spherical_centers: calculate cities centers as spherical mean, optional flag
+    :param geocode_cache: path to reverse geocoding cache file, optional argument
+    :param geocode_precision: number of decimal places coordinates are rounded to in geocoding cache, optional argument
+    :param share_distance: maximal distance in meters between hotels that share one geocoding lookup, optional argument
+    :param geocode_batch_size: number of locations in one geocoding request, optional argument
+    :param async_geocoding: use asyncio geocoding engine instead of threads, optional flag
+    :param concurrency: maximal number of geocoding requests in flight for asyncio engine, optional argument
+    :param weather_timeout: seconds to wait for connection and response of weather service, optional argument
+    :param weather_cache: path to weather cache file, optional argument
+    :param historic_days: number of past days in temperature analysis, optional argument
+    :param forecast_days: number of coming days in temperature analysis, optional argument
     :return: None
     """
     click.echo(
@@ -42,33 +92,67 @@ def main(source_path, output_path, threads, database):
         f'Results will be saved in directory: {output_path}'
     )
     start = time.time()
-    click.echo('Unzipping...')
-    unzipped = unzip_next_to(source_path)
-    if not os.path.isdir(unzipped):
-        click.echo(f"ERROR: {unzipped}")
+    click.echo('Looking for csv files...')
+    sources = find_csv_sources(source_path)
+    if isinstance(sources, str):
+        click.echo(f"ERROR: {sources}")
         return False
-    if threads > 9:
-        threads = 9
-        click.echo('You exceeded maximum recommended number of threads for this application. It is reset to 9')
+    max_threads = max(max_threads, threads)
 
     session = start_db_session(database)
     click.echo('Cleaning data...')
-    fill_table_from_csv(unzipped, session, Hotel)
+    ingest_start = time.time()
+    inserted, retracted, rejected = fill_table_from_csv(
+        sources, session, Hotel, IngestedFile, chunk_size=chunk_size, workers=workers)
+    if inserted:
+        ingest_time = time.time() - ingest_start
+        click.echo(f'Saved {inserted} hotels in {ingest_time:.2f} seconds ({inserted / ingest_time:.0f} rows/sec)')
+    else:
+        click.echo('Source files are unchanged since previous run')
+    if retracted:
+        click.echo(f'Deleted {retracted} hotels from removed or changed source files')
+    if rejected:
+        reasons = ', '.join(f'{reason}: {rejected[reason]}' for reason in REJECTION_REASONS if rejected[reason])
+        click.echo(f'Rejected {sum(rejected.values())} invalid records ({reasons})')
     click.echo('Choosing cities with max number of hotels in country...')
-    major_cities = find_major_cities(session, MajorCity)
+    major_cities = find_major_cities(session, Hotel)
     fill_major_cities_table(session, MajorCity, major_cities)
+    link_hotels_to_major_cities(session, Hotel, MajorCity)
     click.echo('Fetching addresses for hotels located in these cities...')
-    fill_addresses_for_major_cities(session, Hotel, major_cities, threads=threads)
+    address_cache = open_geocode_cache(geocode_cache)
+    saved_lookups = fill_addresses_for_major_cities(
+        session, Hotel, threads=threads, cache=address_cache, precision=geocode_precision,
+        share_distance=share_distance, batch_size=geocode_batch_size, use_async=async_geocoding,
+        concurrency=concurrency, max_threads=max_threads)
+    controllers = {'geocoding': get_geocode_concurrency()}
+    click.echo(f'Nearby hotels shared addresses, {saved_lookups} geocoding lookups saved')
+    click.echo(f'Geocoding cache: {address_cache.hits} hits, {address_cache.misses} misses')
+    address_cache.close()
     click.echo('Calculating cities centers coordinates...')
-    fill_major_cities_table_with_coordinates(session, Hotel, CityData, major_cities)
+    fill_major_cities_table_with_coordinates(session, Hotel, CityData, MajorCity, spherical=spherical_centers)
     click.echo('Fetching weather statistics for cities centers...')
-    fill_major_cities_table_with_temperatures(session, CityData, threads=threads)
+    temperature_cache = open_weather_cache(weather_cache)
+    fill_major_cities_table_with_temperatures(
+        session, CityData, DailyTemperature, threads=threads, timeout=weather_timeout, cache=temperature_cache,
+        max_threads=max_threads, historic_days=historic_days, forecast_days=forecast_days)
+    controllers['weather'] = get_weather_concurrency()
+    for endpoint, stats in get_weather_stats().items():
+        click.echo(f"Weather {endpoint} requests: {stats['done']} done, {stats['failed']} failed, "
+                   f"max {stats['max_queued']} queued, max {stats['max_in_flight']} in flight")
+    click.echo(f'Weather cache: {temperature_cache.hits} hits, {temperature_cache.misses} misses')
+    temperature_cache.close()
+    for stage, controller in controllers.items():
+        summary = controller.summary()
+        click.echo(f"{stage.capitalize()} parallel requests: started with {summary['initial']}, "
+                   f"ended with {summary['final']}, ranged {summary['min']}-{summary['max']}")
+    if concurrency_log:
+        write_concurrency_log(concurrency_log, {stage: controller.history for stage, controller in controllers.items()})
     click.echo('Creating and saving temperature plots for cities centers...')
-    create_and_save_all_plots(session, CityData, output_path)
+    create_and_save_all_plots(session, CityData, DailyTemperature, output_path)
     click.echo('Creating and saving cities temperature analytics...')
-    write_temperature_analytics(session, CityData, output_path)
+    write_temperature_analytics(session, CityData, DailyTemperature, output_path)
     click.echo('Saving cities hotels data to csv files...')
-    write_from_db_to_files(output_path, session, Hotel, major_cities)
+    write_from_db_to_files(output_path, session, Hotel, MajorCity)
 
     execution_time = time.time() - start
     click.echo(f'Total execution time: {execution_time} seconds.')
@@ -9,6 +9,10 @@ class Hotel(Base):
     Keeps information about hotels.
     """
     __tablename__ = 'hotels'
+    __table_args__ = (
+        sa.Index('ix_hotels_country_city', 'country', 'city'),
+        sa.Index('ix_hotels_latitude_longitude', 'latitude', 'longitude'),
+    )
     id = sa.Column(sa.Integer, primary_key=True)
     name = sa.Column(sa.String)
     country = sa.Column(sa.String)
@@ -16,15 +20,31 @@ class Hotel(Base):
     latitude = sa.Column(sa.Float)
     longitude = sa.Column(sa.Float)
     address = sa.Column(sa.String)
+    source = sa.Column(sa.String, index=True)
+    major_city_id = sa.Column(sa.Integer, sa.ForeignKey('major_cities.id'), index=True)
 
     def __repr__(self):
         return f'<{self.country} | {self.city} | {self.name}>'
 
 
+class IngestedFile(Base):
+    """
+    Ingest manifest. Keeps fingerprint of each csv source loaded to hotels table.
+    """
+    __tablename__ = 'ingested_files'
+    source = sa.Column(sa.String, primary_key=True)
+    size = sa.Column(sa.Integer)
+    mtime = sa.Column(sa.Float)
+    content_hash = sa.Column(sa.String)
+
+    def __repr__(self):
+        return f'<{self.source} | {self.content_hash}>'
+
+
 class CityData(Base):
     """
-    Represents one city per each country with geographic and weather information.
-    Last 10 columns are intended for sequential days temperature lists starting from 5 days ago
+    Represents one city per each country with geographic information.
+    Day temperatures are kept in daily temperatures table
     """
     __tablename__ = 'cities'
     id = sa.Column(sa.Integer, primary_key=True)
@@ -33,27 +53,44 @@ class CityData(Base):
     latitude = sa.Column(sa.Float)
     longitude = sa.Column(sa.Float)
     temperature_graphic = sa.Column(sa.String)
-    historic_5 = sa.Column(sa.String)
-    historic_4 = sa.Column(sa.String)
-    historic_3 = sa.Column(sa.String)
-    historic_2 = sa.Column(sa.String)
-    historic_1 = sa.Column(sa.String)
-    today = sa.Column(sa.String)
-    forecast_1 = sa.Column(sa.String)
-    forecast_2 = sa.Column(sa.String)
-    forecast_3 = sa.Column(sa.String)
-    forecast_4 = sa.Column(sa.String)
 
     def __repr__(self):
         return f'Temperature in {self.city}'
 
 
+class DailyTemperature(Base):
+    """
+    Keeps minimal and maximal temperature of one city in one local date.
+    Source is 'historic' for past days, 'today' or 'forecast' for coming days.
+    Series keeps all day measurements as packed float32 values: hourly for historic days,
+    3-hourly for forecast days, hourly followed by 3-hourly for today.
+    Series split is number of hourly measurements at the start of series
+    """
+    __tablename__ = 'daily_temperatures'
+    __table_args__ = (
+        sa.Index('ix_daily_temperatures_city_date', 'city_id', 'date', unique=True),
+    )
+    id = sa.Column(sa.Integer, primary_key=True)
+    city_id = sa.Column(sa.Integer, sa.ForeignKey('cities.id'))
+    date = sa.Column(sa.Date)
+    min_temp = sa.Column(sa.Float)
+    max_temp = sa.Column(sa.Float)
+    source = sa.Column(sa.String)
+    series = sa.Column(sa.LargeBinary)
+    series_split = sa.Column(sa.Integer)
+
+    def __repr__(self):
+        return f'<{self.city_id} | {self.date} | {self.min_temp}..{self.max_temp}>'
+
+
 class MajorCity(Base):
     """
     Service class. Maps city to country.
+    Hotels located in major city refer to it by id
     """
     __tablename__ = 'major_cities'
-    country = sa.Column(sa.String, primary_key=True)
+    id = sa.Column(sa.Integer, primary_key=True)
+    country = sa.Column(sa.String, unique=True)
     city = sa.Column(sa.String)
 
     def __repr__(self):
@@ -0,0 +1,70 @@
+import time
+
+from toolbox import cache_tools
+from toolbox.cache_tools import PersistentCache, pack_json, unpack_json
+
+
+def test_persistent_cache_keeps_values_between_instances_and_counts_hits(tmp_path):
+    path = str(tmp_path / 'cache.sqlite3')
+    cache = PersistentCache(path)
+    assert cache.get('key') is None
+    cache.set('key', 'value')
+    cache.close()
+    cache = PersistentCache(path)
+    assert cache.get('key') == 'value'
+    assert (cache.hits, cache.misses) == (1, 0)
+
+
+def test_persistent_cache_expires_entries_after_ttl():
+    cache = PersistentCache(':memory:', ttl=0.05)
+    cache.set('key', 'value')
+    cache.set('forever', 'value', ttl=None)
+    time.sleep(0.1)
+    assert cache.get('key') is None
+    assert cache.get('forever') == 'value'
+
+
+def test_persistent_cache_evicts_least_recently_used_entries(monkeypatch):
+    monkeypatch.setattr(cache_tools, 'EVICTION_INTERVAL', 1)
+    cache = PersistentCache(':memory:', max_entries=2)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    time.sleep(0.01)
+    cache.get('a')
+    cache.set('c', 3)
+    assert len(cache) == 2
+    assert cache.get('b') is None
+    assert cache.get('a') == 1
+
+
+def test_persistent_cache_evicts_least_recently_used_entries_over_max_bytes(monkeypatch):
+    monkeypatch.setattr(cache_tools, 'EVICTION_INTERVAL', 1)
+    cache = PersistentCache(':memory:', max_bytes=25)
+    cache.set('a', b'x' * 10)
+    time.sleep(0.01)
+    cache.set('b', b'x' * 10)
+    time.sleep(0.01)
+    cache.set('c', b'x' * 10)
+    assert len(cache) == 2
+    assert cache.get('a') is None
+
+
+def test_persistent_cache_writes_access_times_of_hits_in_batches(monkeypatch):
+    monkeypatch.setattr(cache_tools, 'ACCESS_FLUSH_INTERVAL', 3)
+    cache = PersistentCache(':memory:')
+    for key in 'abc':
+        cache.set(key, 1)
+    changes = cache._connection.total_changes
+    cache.get('a')
+    cache.get('b')
+    cache.get('a')
+    assert cache._connection.total_changes == changes
+    cache.get('c')
+    assert cache._connection.total_changes == changes + 3
+
+
+def test_pack_json_restores_value_and_compresses_repeated_data():
+    value = [[round(20 + hour / 10, 2) for hour in range(24)] for _ in range(10)]
+    blob = pack_json(value)
+    assert unpack_json(blob) == value
+    assert len(blob) < len(str(value)) / 2
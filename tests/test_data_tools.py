@@ -1,4 +1,6 @@
-from toolbox import data_tools
+import io
+
+from toolbox import data_tools, os_tools
 
 
 def test_country_name_validation_func():
@@ -43,3 +45,56 @@ def test_get_max_minmax_temp_delta():
     temp_list = [['day1', 1, 5], ['day2', 2, 12], ['day3', 3, 7]]
     result = data_tools.get_max_minmax_temp_delta(temp_list)
     assert result == (10, 'day2')
+
+
+def test_chunked_splits_iterable_into_fixed_size_lists():
+    result = list(data_tools.chunked(range(7), 3))
+    assert result == [[0, 1, 2], [3, 4, 5], [6]]
+
+
+def test_read_validated_shards_together_return_same_records_as_whole_file(tmp_path):
+    file_path = tmp_path / 'hotels.csv'
+    lines = ['Id,Name,Country,City,Latitude,Longitude'] + [
+        f'{i},Hotel {i},GB,London,51.{i},-0.{i}' for i in range(200)]
+    file_path.write_text('\n'.join(lines) + '\n')
+    source = os_tools.CsvSource(str(file_path), None, file_path.stat().st_size, file_path.stat().st_mtime)
+    shards = os_tools.split_csv_source(source, shard_size=97)
+    assert len(shards) > 1
+    records = [record for shard in shards for record in data_tools.read_validated_shard(shard)[0]]
+    assert records == list(data_tools.read_validated(str(file_path)))
+    assert len(records) == 200
+
+
+def test_validate_rows_func_counts_rejected_rows_by_first_failed_check():
+    rows = [
+        ['1', 'Hotel 1', 'GB', 'London', '51.5', '-0.1'],
+        ['2', 'Hotel, with comma', 'FR', 'Paris', '48.8', '2.3'],
+        ['3', 'Hotel 3', 'OO', 'Milan', '45.5', '9.2'],
+        ['4', 'Hotel 4', 'IT', 'Milan', '185.5', 'abc'],
+        ['5', 'Hotel 5', 'IT', ''],
+    ]
+    records, rejected = data_tools.validate_rows(rows)
+    assert records == [('Hotel 1', 'GB', 'London', 51.5, -0.1), ('Hotel, with comma', 'FR', 'Paris', 48.8, 2.3)]
+    assert rejected == {'columns': 1, 'country': 1, 'latitude': 1}
+
+
+def test_read_validated_func_keeps_hotel_names_with_quoted_commas():
+    stream = io.StringIO('Id,Name,Country,City,Latitude,Longitude\n'
+                         '60129542144,"The Golden Hotel, An Ascend Hotel Collection Member",US,Golden,39.7,-105.2\n')
+    result = list(data_tools.read_validated(stream))
+    assert result == [('The Golden Hotel, An Ascend Hotel Collection Member', 'US', 'Golden', 39.7, -105.2)]
+
+
+def test_find_city_center_spherical_func_handles_antimeridian():
+    latitude, longitude = data_tools.find_city_center_spherical([(0, 179), (0, -179)])
+    assert abs(latitude) < 1e-9
+    assert abs(abs(longitude) - 180) < 1e-9
+
+
+def test_temperature_series_is_packed_to_4_bytes_per_value_and_read_without_copy():
+    blob = data_tools.pack_temperature_series([1.5, -2.25, 30.0])
+    assert len(blob) == 12
+    series = data_tools.unpack_temperature_series(blob)
+    assert series.tolist() == [1.5, -2.25, 30.0]
+    assert not series.flags.owndata
+    assert not series.flags.writeable
@@ -0,0 +1,447 @@
+import datetime
+import os
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import partial
+
+import pytest
+import sqlalchemy as sa
+
+from models import CityData, DailyTemperature, Hotel, IngestedFile, MajorCity
+from toolbox import db_tools, weather_tools
+from toolbox.cache_tools import PersistentCache
+from toolbox.db_tools import (fill_addresses_for_major_cities,
+                              fill_major_cities_table,
+                              fill_major_cities_table_with_coordinates,
+                              fill_major_cities_table_with_temperatures,
+                              fill_table_from_csv, find_major_cities,
+                              get_cities_statistics,
+                              get_major_cities_coordinates,
+                              get_temperature_series,
+                              link_hotels_to_major_cities, start_db_session)
+from toolbox.os_tools import find_csv_sources, split_csv_source
+from toolbox.time_tools import get_zone_timezone
+
+
+def add_hotels(session, *cities):
+    for i, (country, city) in enumerate(cities):
+        session.add(Hotel(name=f'Hotel {i}', country=country, city=city, latitude=i / 100, longitude=i / 100))
+    session.commit()
+
+
+def write_csv(directory, name, *cities, mtime=None):
+    path = directory / name
+    rows = [f'{i},Hotel {i},{country},{city},{51 + i / 100},{-i / 100}' for i, (country, city) in enumerate(cities)]
+    path.write_text('\n'.join(['Id,Name,Country,City,Latitude,Longitude'] + rows) + '\n')
+    if mtime is not None:
+        os.utime(path, (mtime, mtime))
+
+
+def ingest(session, directory):
+    inserted, retracted, _ = fill_table_from_csv(find_csv_sources(str(directory)), session, Hotel, IngestedFile)
+    return inserted, retracted
+
+
+def test_fill_table_from_csv_func_loads_only_new_and_changed_sources_and_retracts_removed(tmp_path):
+    session = start_db_session('sqlite://')
+    write_csv(tmp_path, 'a.csv', ('GB', 'London'), ('GB', 'London'), mtime=1000)
+    write_csv(tmp_path, 'b.csv', ('FR', 'Paris'), mtime=1000)
+    assert ingest(session, tmp_path) == (3, 0)
+    assert ingest(session, tmp_path) == (0, 0)
+
+    write_csv(tmp_path, 'a.csv', ('GB', 'London'), ('GB', 'London'), mtime=2000)
+    assert ingest(session, tmp_path) == (0, 0)
+    assert session.query(IngestedFile).filter_by(source='a.csv').one().mtime == 2000
+
+    write_csv(tmp_path, 'b.csv', ('FR', 'Paris'), ('FR', 'Lyon'), mtime=3000)
+    assert ingest(session, tmp_path) == (2, 1)
+    os.remove(tmp_path / 'a.csv')
+    write_csv(tmp_path, 'c.csv', ('IT', 'Rome'))
+    assert ingest(session, tmp_path) == (1, 2)
+    assert sorted(source for source, in session.query(IngestedFile.source)) == ['b.csv', 'c.csv']
+    assert sorted(city for city, in session.query(Hotel.city)) == ['Lyon', 'Paris', 'Rome']
+
+
+def test_start_db_session_func_upgrades_hotels_table_of_previous_version(tmp_path):
+    db_path = f'sqlite:///{tmp_path / "db.sqlite3"}'
+    engine = sa.create_engine(db_path)
+    with engine.begin() as connection:
+        connection.execute(sa.text(
+            'CREATE TABLE hotels (id INTEGER PRIMARY KEY, name VARCHAR, country VARCHAR, city VARCHAR, '
+            'latitude FLOAT, longitude FLOAT, address VARCHAR)'))
+        connection.execute(sa.text("INSERT INTO hotels (name, country, city) VALUES ('Old', 'GB', 'London')"))
+    engine.dispose()
+
+    session = start_db_session(db_path)
+    columns = {column['name'] for column in sa.inspect(session.get_bind()).get_columns('hotels')}
+    assert {'source', 'major_city_id'} <= columns
+    write_csv(tmp_path, 'a.csv', ('GB', 'London'), ('FR', 'Paris'))
+    assert ingest(session, tmp_path) == (2, 1)
+    assert ingest(session, tmp_path) == (0, 0)
+    assert [source for source, in session.query(Hotel.source)] == ['a.csv', 'a.csv']
+
+
+def test_start_db_session_func_recreates_major_cities_table_of_previous_version(tmp_path):
+    db_path = f'sqlite:///{tmp_path / "db.sqlite3"}'
+    engine = sa.create_engine(db_path)
+    with engine.begin() as connection:
+        connection.execute(sa.text('CREATE TABLE major_cities (country VARCHAR PRIMARY KEY, city VARCHAR)'))
+        connection.execute(sa.text("INSERT INTO major_cities VALUES ('GB', 'London')"))
+    engine.dispose()
+
+    session = start_db_session(db_path)
+    write_csv(tmp_path, 'a.csv', ('GB', 'London'), ('GB', 'London'), ('FR', 'Paris'))
+    ingest(session, tmp_path)
+    fill_major_cities_table(session, MajorCity, find_major_cities(session, Hotel))
+    assert link_hotels_to_major_cities(session, Hotel, MajorCity) == 3
+    assert sorted(country for country, in session.query(MajorCity.country)) == ['FR', 'GB']
+
+
+def test_start_db_session_func_refuses_to_recreate_hotels_table(tmp_path):
+    db_path = f'sqlite:///{tmp_path / "db.sqlite3"}'
+    engine = sa.create_engine(db_path)
+    with engine.begin() as connection:
+        connection.execute(sa.text('CREATE TABLE hotels (name VARCHAR PRIMARY KEY)'))
+    engine.dispose()
+    with pytest.raises(RuntimeError):
+        start_db_session(db_path)
+
+
+def hotels_table(session):
+    return session.query(Hotel.name, Hotel.country, Hotel.city, Hotel.latitude, Hotel.longitude,
+                         Hotel.source).order_by(Hotel.source, Hotel.name).all()
+
+
+@pytest.mark.parametrize('chunk_size', [1, 3, 7, 10])
+def test_fill_table_from_csv_func_bulk_and_orm_inserts_give_same_rows(tmp_path, chunk_size):
+    write_csv(tmp_path, 'a.csv', *[('GB', 'London')] * 4, ('FR', 'Paris'), ('XX', 'Nowhere'))
+    write_csv(tmp_path, 'b.csv', ('IT', 'Rome'), ('IT', 'Milan'))
+    tables = []
+    for bulk in (True, False):
+        session = start_db_session('sqlite://')
+        inserted, _, rejected = fill_table_from_csv(
+            find_csv_sources(str(tmp_path)), session, Hotel, IngestedFile, bulk=bulk, chunk_size=chunk_size)
+        assert (inserted, sum(rejected.values())) == (7, 1)
+        tables.append(hotels_table(session))
+    assert tables[0] == tables[1]
+    assert len(tables[0]) == 7
+
+
+def test_fill_table_from_csv_func_with_worker_processes_gives_same_table_as_one_process(tmp_path, monkeypatch):
+    write_csv(tmp_path, 'a.csv', *[('GB', 'London'), ('FR', 'Paris'), ('XX', 'Nowhere')] * 20)
+    write_csv(tmp_path, 'b.csv', ('IT', 'Rome'), ('IT', 'Milan'))
+    monkeypatch.setattr(db_tools, 'split_csv_source', partial(split_csv_source, shard_size=300))
+    assert len(db_tools.split_csv_source(find_csv_sources(str(tmp_path))[0])) > 3
+    tables = []
+    for workers in (1, 2):
+        session = start_db_session('sqlite://')
+        inserted, _, rejected = fill_table_from_csv(
+            find_csv_sources(str(tmp_path)), session, Hotel, IngestedFile, chunk_size=7, workers=workers)
+        assert (inserted, rejected['country']) == (42, 20)
+        assert session.query(IngestedFile).count() == 2
+        tables.append(hotels_table(session))
+    assert tables[0] == tables[1]
+
+
+def test_find_major_cities_func_chooses_city_with_max_hotels_in_each_country():
+    session = start_db_session('sqlite://')
+    add_hotels(session, ('GB', 'London'), ('GB', 'London'), ('GB', 'Leeds'), ('FR', 'Paris'))
+    assert find_major_cities(session, Hotel) == {'GB': 'London', 'FR': 'Paris'}
+
+
+def test_find_major_cities_func_chooses_first_city_alphabetically_on_tie():
+    session = start_db_session('sqlite://')
+    add_hotels(session, ('IT', 'Rome'), ('IT', 'Milan'), ('IT', 'Rome'), ('IT', 'Milan'))
+    assert find_major_cities(session, Hotel) == {'IT': 'Milan'}
+
+
+def test_get_major_cities_coordinates_func_averages_hotels_in_one_query():
+    session = start_db_session('sqlite://')
+    session.add_all([
+        Hotel(name='Hotel 1', country='GB', city='London', latitude=51, longitude=-1),
+        Hotel(name='Hotel 2', country='GB', city='London', latitude=52, longitude=1),
+        Hotel(name='Hotel 3', country='GB', city='Leeds', latitude=53, longitude=-2),
+    ])
+    session.commit()
+    fill_major_cities_table(session, MajorCity, {'GB': 'London'})
+    link_hotels_to_major_cities(session, Hotel, MajorCity)
+    london_id = session.query(MajorCity.id).scalar()
+    assert get_major_cities_coordinates(session, Hotel) == {london_id: (51.5, 0)}
+    latitude, longitude = get_major_cities_coordinates(session, Hotel, spherical=True)[london_id]
+    assert abs(latitude - 51.5) < 0.01
+    assert abs(longitude) < 0.05
+
+
+def test_link_hotels_to_major_cities_func_follows_major_city_changes():
+    session = start_db_session('sqlite://')
+    add_hotels(session, ('GB', 'London'), ('GB', 'London'), ('GB', 'Leeds'), ('FR', 'Paris'))
+    fill_major_cities_table(session, MajorCity, {'GB': 'London', 'FR': 'Paris'})
+    assert link_hotels_to_major_cities(session, Hotel, MajorCity) == 3
+    london_id = session.query(MajorCity).filter_by(country='GB').one().id
+
+    assert fill_major_cities_table(session, MajorCity, {'GB': 'Leeds'}) is None
+    assert link_hotels_to_major_cities(session, Hotel, MajorCity) == 1
+    linked = session.query(Hotel).filter(Hotel.major_city_id.isnot(None)).one()
+    assert (linked.city, linked.major_city_id) == ('Leeds', london_id)
+    assert fill_major_cities_table(session, MajorCity, {'GB': 'Leeds'}) is True
+
+
+def test_fill_addresses_for_major_cities_func_commits_pages_and_resumes_after_failure(monkeypatch):
+    session = start_db_session('sqlite://')
+    add_hotels(session, *[('GB', 'London')] * 5, ('GB', 'Leeds'))
+    fill_major_cities_table(session, MajorCity, {'GB': 'London'})
+    link_hotels_to_major_cities(session, Hotel, MajorCity)
+    requested = []
+
+    def fake_geocode(locations, **kwargs):
+        if len(requested) == 2:
+            raise ConnectionError('service is down')
+        requested.append(locations)
+        return [f'Address {len(requested)}'] * len(locations)
+
+    monkeypatch.setattr(db_tools, 'geocode_locations', fake_geocode)
+    with pytest.raises(ConnectionError):
+        fill_addresses_for_major_cities(session, Hotel, page_size=2)
+    assert session.query(Hotel).filter(Hotel.address.isnot(None)).count() == 4
+    requested.clear()
+    fill_addresses_for_major_cities(session, Hotel, page_size=2)
+    assert session.query(Hotel).filter(Hotel.address.isnot(None)).count() == 5
+    assert session.query(Hotel).filter_by(city='Leeds').one().address is None
+
+
+def test_fill_addresses_for_major_cities_func_shares_lookups_between_nearby_hotels_of_different_pages(monkeypatch):
+    session = start_db_session('sqlite://')
+    for i, (latitude, longitude) in enumerate([(51.5, -0.1), (52.2, 0.1), (51.50001, -0.1), (52.20001, 0.1)]):
+        session.add(Hotel(name=f'Hotel {i}', country='GB', city='London', latitude=latitude, longitude=longitude))
+    session.commit()
+    fill_major_cities_table(session, MajorCity, {'GB': 'London'})
+    link_hotels_to_major_cities(session, Hotel, MajorCity)
+    requested = []
+
+    def fake_geocode(locations, **kwargs):
+        requested.extend(locations)
+        return [f'Address {latitude}' for latitude, _ in locations]
+
+    monkeypatch.setattr(db_tools, 'geocode_locations', fake_geocode)
+    assert fill_addresses_for_major_cities(session, Hotel, share_distance=1000, page_size=2) == 2
+    assert requested == [(51.5, -0.1), (52.2, 0.1)]
+    addresses = [address for address, in session.query(Hotel.address).order_by(Hotel.id)]
+    assert addresses == ['Address 51.5', 'Address 52.2'] * 2
+
+
+def test_yield_hotel_groups_without_address_func_reads_pages_without_splitting_groups():
+    session = start_db_session('sqlite://')
+    coordinates = [(3, 3), (1, 1), (0, 0.5), (1, 1), (2, 2), (0, 0), (1, 1)]
+    for i, (latitude, longitude) in enumerate(coordinates):
+        session.add(Hotel(name=f'Hotel {i}', country='GB', city='London', latitude=latitude, longitude=longitude))
+    session.commit()
+    fill_major_cities_table(session, MajorCity, {'GB': 'London'})
+    link_hotels_to_major_cities(session, Hotel, MajorCity)
+    statements = []
+    sa.event.listen(session.get_bind(), 'before_cursor_execute',
+                    lambda connection, cursor, statement, *args: statements.append(statement))
+
+    pages = list(db_tools.yield_hotel_groups_without_address(session, Hotel, page_size=3))
+    assert [[len(group) for group in groups] for groups in pages] == [[1, 1, 3], [1, 1]]
+    assert [(group[0].latitude, group[0].longitude) for group in pages[0]] == [(0, 0), (0, 0.5), (1, 1)]
+    assert statements and all('LIMIT' in statement for statement in statements)
+
+
+def completed(value):
+    future = Future()
+    future.set_result(value)
+    return future
+
+
+def test_fill_major_cities_table_with_temperatures_func_saves_one_row_per_city_day(monkeypatch):
+    session = start_db_session('sqlite://')
+    session.add_all([
+        CityData(country='GB', city='London', latitude=51.5, longitude=0),
+        CityData(country='FR', city='Paris', latitude=48.9, longitude=2.3),
+    ])
+    session.commit()
+    monkeypatch.setattr(db_tools, 'submit_all_hist_temp', lambda coords, cache=None, days=5: [
+        completed([coords[0] + day, coords[0] + day + 5]) for day in range(-days, 1)])
+    monkeypatch.setattr(db_tools, 'submit_forecast_temp_list', lambda coords, cache=None: completed(
+        ([coords[0] + 10], [[coords[0] + day, coords[0] + day + 2] for day in range(1, 5)])))
+
+    fill_major_cities_table_with_temperatures(session, CityData, DailyTemperature, historic_days=2, forecast_days=1)
+    rows = session.query(DailyTemperature).order_by(DailyTemperature.city_id, DailyTemperature.date).all()
+    assert [row.source for row in rows] == ['historic', 'historic', 'today', 'forecast'] * 2
+    london = [(row.min_temp, row.max_temp) for row in rows[:4]]
+    assert london == [(49.5, 54.5), (50.5, 55.5), (51.5, 61.5), (52.5, 54.5)]
+
+    statistics = dict(((country, city), indicators) for country, city, indicators in get_cities_statistics(
+        session, CityData, DailyTemperature))
+    max_temp, max_temp_day = statistics[('GB', 'London')][0]
+    assert max_temp == 61.5
+    assert max_temp_day == rows[2].date.isoformat()
+    assert statistics[('FR', 'Paris')][2][0] == 46.9
+
+    series = get_temperature_series(session, CityData, DailyTemperature, 'GB', 'London')
+    assert list(series) == [row.date.isoformat() for row in rows[:4]]
+    assert [(hourly.tolist(), three_hourly.tolist()) for hourly, three_hourly in series.values()] == [
+        ([49.5, 54.5], []), ([50.5, 55.5], []), ([51.5, 56.5], [61.5]), ([], [52.5, 54.5])]
+
+
+def test_start_db_session_func_gives_each_thread_own_session_on_wal_database(tmp_path):
+    session = start_db_session(f"sqlite:///{tmp_path / 'db.sqlite3'}")
+    assert session.execute('pragma journal_mode').scalar() == 'wal'
+    assert session.execute('pragma synchronous').scalar() == 1
+    add_hotels(session, ('GB', 'London'))
+    session.add(Hotel(name='Uncommitted', country='GB', city='London'))
+    session.flush()
+
+    def read_in_other_thread():
+        try:
+            return session(), session.query(Hotel).count()
+        finally:
+            session.remove()
+
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        other_session, count = pool.submit(read_in_other_thread).result()
+    assert other_session is not session()
+    assert count == 1
+    session.commit()
+
+
+def test_start_db_session_func_reuses_sqlite_connection_between_transactions(tmp_path):
+    session = start_db_session(f"sqlite:///{tmp_path / 'db.sqlite3'}")
+    connects = []
+    sa.event.listen(session.get_bind(), 'connect', lambda *args: connects.append(args))
+    for i in range(5):
+        add_hotels(session, ('GB', f'City {i}'))
+    assert session.query(Hotel).count() == 5
+    assert len(connects) <= 1
+    assert session.execute('pragma cache_size').scalar() == -64 * 1024
+
+
+def test_start_db_session_func_never_closes_sqlite_connection_in_use_by_other_thread(tmp_path):
+    session = start_db_session(f"sqlite:///{tmp_path / 'db.sqlite3'}")
+    add_hotels(session, ('GB', 'London'))
+    session.remove()
+    checked_out, closed_in_use = set(), []
+
+    def record_close(connection, connection_record):
+        if connection in checked_out:
+            closed_in_use.append(connection)
+
+    engine = session.get_bind()
+    sa.event.listen(engine, 'checkout', lambda connection, *args: checked_out.add(connection))
+    sa.event.listen(engine, 'checkin', lambda connection, *args: checked_out.discard(connection))
+    sa.event.listen(engine, 'close', record_close)
+    threads = 8
+    barrier = threading.Barrier(threads)
+
+    def read_in_other_thread(_):
+        try:
+            counts = [session.query(Hotel).count()]
+            barrier.wait(timeout=10)
+            counts.append(session.query(Hotel).count())
+            return counts
+        finally:
+            session.remove()
+
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        assert list(pool.map(read_in_other_thread, range(threads))) == [[1, 1]] * threads
+    assert closed_in_use == []
+
+
+def test_cities_and_temperatures_follow_major_city_change_after_incremental_ingest(tmp_path, monkeypatch):
+    requested = []
+
+    def fake_hist(coords, cache=None, days=5):
+        requested.append(coords)
+        return [completed([1.0, 2.0]) for _ in range(days + 1)]
+
+    monkeypatch.setattr(db_tools, 'submit_all_hist_temp', fake_hist)
+    monkeypatch.setattr(db_tools, 'submit_forecast_temp_list', lambda coords, cache=None: completed(
+        ([3.0], [[4.0, 5.0]] * 4)))
+
+    def run_pipeline(session):
+        major_cities = find_major_cities(session, Hotel)
+        fill_major_cities_table(session, MajorCity, major_cities)
+        link_hotels_to_major_cities(session, Hotel, MajorCity)
+        fill_major_cities_table_with_coordinates(session, Hotel, CityData, MajorCity)
+        fill_major_cities_table_with_temperatures(session, CityData, DailyTemperature)
+
+    session = start_db_session('sqlite://')
+    write_csv(tmp_path, 'a.csv', *[('GB', 'London')] * 3, ('FR', 'Paris'))
+    ingest(session, tmp_path)
+    run_pipeline(session)
+    paris_id = session.query(CityData).filter_by(city='Paris').one().id
+    assert len(requested) == 2
+
+    write_csv(tmp_path, 'b.csv', *[('GB', 'Leeds')] * 5)
+    ingest(session, tmp_path)
+    run_pipeline(session)
+    assert sorted(city for city, in session.query(CityData.city)) == ['Leeds', 'Paris']
+    assert session.query(CityData).filter_by(city='Paris').one().id == paris_id
+    assert len(requested) == 3
+    assert session.query(DailyTemperature).count() == 2 * 10
+    leeds_id = session.query(CityData).filter_by(city='Leeds').one().id
+    assert session.query(DailyTemperature).filter_by(city_id=leeds_id).count() == 10
+
+
+def test_fill_major_cities_table_with_temperatures_func_resolves_timezone_with_city_country(monkeypatch):
+    pytest.importorskip('zoneinfo')
+    requested = []
+
+    def fake_get_json(url, params):
+        requested.append((params['lat'], params['lon']))
+        return {'timezone': -5*60*60}
+
+    monkeypatch.setattr(weather_tools, '_timezones', {})
+    monkeypatch.setattr(weather_tools.weather_client, 'get_json', fake_get_json)
+    monkeypatch.setattr(db_tools, 'submit_all_hist_temp', lambda coords, cache=None, days=5: [
+        completed([1.0, 2.0]) for _ in range(days + 1)])
+    monkeypatch.setattr(db_tools, 'submit_forecast_temp_list', lambda coords, cache=None: completed(
+        ([3.0], [[4.0, 5.0]] * 4)))
+    session = start_db_session('sqlite://')
+    session.add_all([
+        CityData(country='FR', city='Strasbourg', latitude=48.5734, longitude=7.7521),
+        CityData(country='US', city='Dallas', latitude=32.7767, longitude=-96.797),
+    ])
+    session.commit()
+
+    fill_major_cities_table_with_temperatures(session, CityData, DailyTemperature)
+    assert weather_tools.get_city_timezone_cached(48.5734, 7.7521) == get_zone_timezone('Europe/Paris')
+    assert weather_tools.get_city_timezone_cached(32.7767, -96.797) == -5*60*60
+    assert requested == [(32.7767, -96.797)]
+
+
+def test_fill_major_cities_table_with_temperatures_func_refreshes_window_of_previous_day(monkeypatch):
+    requested = []
+
+    def fake_hist(coords, cache=None, days=5):
+        requested.append(cache)
+        return [completed([1.0, 2.0]) for _ in range(days + 1)]
+
+    monkeypatch.setattr(db_tools, 'submit_all_hist_temp', fake_hist)
+    monkeypatch.setattr(db_tools, 'submit_forecast_temp_list', lambda coords, cache=None: completed(
+        ([3.0], [[4.0, 5.0]] * 4)))
+    session = start_db_session('sqlite://')
+    session.add(CityData(country='GB', city='London', latitude=51.5, longitude=0))
+    session.commit()
+    fill_major_cities_table_with_temperatures(session, CityData, DailyTemperature)
+    current_dates = [date for date, in session.query(DailyTemperature.date).order_by(DailyTemperature.date)]
+    assert fill_major_cities_table_with_temperatures(session, CityData, DailyTemperature) is True
+    assert len(requested) == 1
+
+    for row in session.query(DailyTemperature):
+        row.date -= datetime.timedelta(days=1)
+    session.commit()
+    fill_major_cities_table_with_temperatures(session, CityData, DailyTemperature)
+    assert len(requested) == 2
+    assert [date for date, in session.query(DailyTemperature.date).order_by(DailyTemperature.date)] == current_dates
+
+    session.query(DailyTemperature).update({'series_split': None})
+    session.commit()
+    fill_major_cities_table_with_temperatures(session, CityData, DailyTemperature)
+    assert len(requested) == 3
+    assert session.query(DailyTemperature).filter(DailyTemperature.series_split.is_(None)).count() == 0
+
+    cache = PersistentCache(':memory:')
+    fill_major_cities_table_with_temperatures(session, CityData, DailyTemperature, cache=cache)
+    assert requested[-1] is cache
+    assert session.query(DailyTemperature).count() == 10
@@ -1,13 +1,120 @@
+import json
+import os
+import threading
 import time
-from toolbox.geo_tools import get_address
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import pytest
+import requests
+
+from benchmarks.stand_in_server import StandInServer
+from toolbox import geo_tools
+from toolbox.cache_tools import PersistentCache
+from toolbox.geo_tools import (cluster_locations, configure_geocode_base_url,
+                               coordinates_key, format_batch_address,
+                               get_address, get_addresses_batch)
+from toolbox.net_tools import TokenBucket
 
 GEOCODE_API_KEY = 's23N9lets5Gey28fkbpt3ub8v4N6efyk'
+RECORDINGS_PATH = os.path.join(os.path.dirname(__file__), 'test_data', 'stand_in_recordings.json')
+
+
+@pytest.fixture
+def stand_in():
+    previous_base_url = geo_tools.GEOCODE_BASE_URL
+    with StandInServer(recordings_path=RECORDINGS_PATH) as server:
+        configure_geocode_base_url(server.url)
+        yield server
+    configure_geocode_base_url(previous_base_url)
+
+
+class ReverseHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        status, payload = self.server.respond(parse_qs(urlparse(self.path).query))
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
 
+    def log_message(self, *args):
+        pass
 
-def test_get_address_func_returns_correct_address():
+
+@pytest.fixture
+def reverse_server(monkeypatch):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), ReverseHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    monkeypatch.setattr(geo_tools, 'GEOCODE_REVERSE_URL', f'http://127.0.0.1:{server.server_port}/reverse')
+    monkeypatch.setattr(geo_tools, 'geocode_limiter', TokenBucket(rate=1000))
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_get_address_func_returns_correct_address(stand_in):
     latitude, longitude = 51.5, -0.1
     start = time.time()
     result = get_address(latitude, longitude, api_key=GEOCODE_API_KEY)
     execution_time = time.time() - start
     assert result == 'Southwark Bridge Testing Station, Belvedere Place, Elephant and Castle, '\
-                     'London Borough of Southwark, London, Greater London, England, SE15, UK'
\ No newline at end of file
+                     'London Borough of Southwark, London, Greater London, England, SE15, UK'
+
+
+def test_coordinates_key_func_rounds_nearby_coordinates_to_one_key():
+    assert coordinates_key(51.500012, -0.099996) == coordinates_key(51.49999, -0.1) == '51.5000,-0.1000'
+    assert coordinates_key(-0.00001, 0.00001) == '0.0000,0.0000'
+
+
+def test_cluster_locations_func_groups_only_close_locations():
+    coordinates = [(51.5, -0.1), (51.50001, -0.10001), (51.6, -0.1), (51.5, -0.1)]
+    assert cluster_locations(coordinates, distance=50) == [[0, 1, 3], [2]]
+    assert cluster_locations(coordinates) == [[0, 3], [1], [2]]
+
+
+def test_format_batch_address_func_joins_known_fields_and_handles_unresolved_location():
+    result = {'locations': [{'street': 'Belvedere Place', 'adminArea5': 'London', 'adminArea3': 'England',
+                             'adminArea4': '', 'postalCode': 'SE1', 'adminArea1': 'GB'}]}
+    assert format_batch_address(result) == 'Belvedere Place, London, England, SE1, GB'
+    assert format_batch_address({'locations': []}) is None
+
+
+def test_geocode_locations_func_with_async_engine_resolves_all_locations(reverse_server):
+    reverse_server.respond = lambda params: (200, {'display_name': f"{params['lat'][0]}|{params['lon'][0]}"})
+    locations = [(float(i), -float(i)) for i in range(30)]
+    result = geo_tools.geocode_locations(locations, use_async=True, concurrency=10)
+    assert result == [f'{latitude}|{longitude}' for latitude, longitude in locations]
+
+
+def test_geocode_locations_func_keeps_and_caches_addresses_of_batches_that_did_not_fail(monkeypatch):
+    def flaky_batch(locations, api_key=None):
+        if (2.0, 2.0) in locations:
+            raise requests.ConnectionError('service is down')
+        return [f'{latitude}|{longitude}' for latitude, longitude in locations]
+
+    monkeypatch.setattr(geo_tools, 'get_addresses_batch', flaky_batch)
+    cache = PersistentCache(':memory:')
+    locations = [(float(i), float(i)) for i in range(5)]
+    result = geo_tools.geocode_locations(locations, cache=cache, batch_size=2)
+    assert result == ['0.0|0.0', '1.0|1.0', None, None, '4.0|4.0']
+    assert len(cache) == 3
+
+
+def test_geocode_locations_func_with_async_engine_leaves_failed_requests_unresolved(reverse_server):
+    reverse_server.respond = lambda params: (404 if params['lat'][0] == '3.0' else 200,
+                                             {'display_name': params['lat'][0]})
+    result = geo_tools.geocode_locations([(float(i), 0.0) for i in range(5)], use_async=True)
+    assert result == ['0.0', '1.0', '2.0', None, '4.0']
+
+
+def test_batch_geocoding_through_stand_in_server_retries_errors_and_synthesizes_addresses(stand_in, monkeypatch):
+    monkeypatch.setattr(geo_tools, 'geocode_limiter', TokenBucket(rate=1000))
+    monkeypatch.setattr(geo_tools.time, 'sleep', lambda seconds: None)
+    stand_in.error_rate = 0.5
+    locations = [(51.5, -0.1), (48.8566, 2.3522), (40.7128, -74.006)]
+    addresses = get_addresses_batch(locations, api_key=GEOCODE_API_KEY, max_retries=10)
+    assert all('Stand-in City' in address for address in addresses)
+    assert addresses == get_addresses_batch(locations, api_key=GEOCODE_API_KEY, max_retries=10)
+    assert stand_in.requests['/geocoding/v1/batch', 200] == 2
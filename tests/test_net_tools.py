@@ -0,0 +1,167 @@
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from toolbox.net_tools import (AdaptiveConcurrency, HttpClient,
+                               RequestScheduler, SingleFlight, TokenBucket)
+
+
+def test_token_bucket_spaces_requests_from_all_threads_at_given_rate():
+    bucket = TokenBucket(rate=50)
+    start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=5) as pool:
+        list(pool.map(lambda _: bucket.acquire(), range(11)))
+    assert 0.19 < time.monotonic() - start < 0.4
+
+
+def test_token_bucket_pause_postpones_next_request():
+    bucket = TokenBucket(rate=1000)
+    bucket.pause(0.1)
+    assert bucket.reserve() >= 0.1
+
+
+def test_single_flight_collapses_concurrent_identical_calls():
+    flight = SingleFlight()
+    calls = []
+    started = threading.Event()
+
+    def slow_call():
+        calls.append(1)
+        started.set()
+        time.sleep(0.1)
+        return 42
+
+    with ThreadPoolExecutor(max_workers=5) as pool:
+        leader = pool.submit(flight.do, 'key', slow_call)
+        started.wait()
+        followers = [pool.submit(flight.do, 'key', slow_call) for _ in range(4)]
+        results = [leader.result()] + [future.result() for future in followers]
+    assert results == [42] * 5
+    assert len(calls) == 1
+    assert flight.do('key', slow_call) == 42
+    assert len(calls) == 2
+
+
+def test_single_flight_reraises_call_error():
+    flight = SingleFlight()
+
+    def failing_call():
+        raise KeyError('Unexpected response')
+
+    with pytest.raises(KeyError):
+        flight.do('key', failing_call)
+
+
+def test_http_client_retries_unavailable_service_on_kept_alive_connection():
+    statuses = [503, 429, 200]
+    connections = set()
+
+    class FlakyHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_GET(self):
+            connections.add(self.client_address)
+            status = statuses.pop(0)
+            body = json.dumps({'status': status}).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), FlakyHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    client = HttpClient(pool_size=2, timeout=1, backoff=0.01)
+    try:
+        assert client.get_json(f'http://127.0.0.1:{server.server_port}/') == {'status': 200}
+    finally:
+        client.close()
+        server.shutdown()
+    assert not statuses
+    assert len(connections) == 1
+
+
+def test_http_client_retry_delay_is_jittered_within_backoff():
+    client = HttpClient(backoff=1, max_backoff=5)
+    delays = [client.retry_delay(attempt) for attempt in range(10) for _ in range(10)]
+    assert all(0 <= delay <= 5 for delay in delays)
+    assert len(set(delays)) > 1
+
+
+def test_request_scheduler_limits_requests_in_flight_per_endpoint():
+    scheduler = RequestScheduler({'historic': (2, None), 'forecast': (1, None)})
+    in_flight = {'historic': 0, 'forecast': 0}
+    peaks = {'historic': 0, 'forecast': 0}
+    lock = threading.Lock()
+
+    def request(endpoint, value):
+        with lock:
+            in_flight[endpoint] += 1
+            peaks[endpoint] = max(peaks[endpoint], in_flight[endpoint])
+        time.sleep(0.02)
+        with lock:
+            in_flight[endpoint] -= 1
+        return value
+
+    futures = [scheduler.submit(endpoint, request, endpoint, i) for i in range(6) for endpoint in in_flight]
+    assert [future.result() for future in futures] == [i for i in range(6) for _ in in_flight]
+    scheduler.shutdown()
+    assert peaks == {'historic': 2, 'forecast': 1}
+    stats = scheduler.stats()
+    assert stats['historic']['done'] == stats['forecast']['done'] == 6
+    assert stats['historic']['max_in_flight'] == 2
+    assert stats['forecast']['max_queued'] >= 4
+    assert stats['forecast']['queued'] == stats['forecast']['in_flight'] == 0
+
+
+def test_request_scheduler_counts_failed_requests():
+    scheduler = RequestScheduler({'historic': (1, 1000)})
+
+    def failing_request():
+        raise KeyError('Unexpected response')
+
+    future = scheduler.submit('historic', failing_request)
+    with pytest.raises(KeyError):
+        future.result()
+    scheduler.shutdown()
+    assert scheduler.stats()['historic']['failed'] == 1
+
+
+def test_adaptive_concurrency_grows_while_healthy_and_halves_on_overload():
+    controller = AdaptiveConcurrency(initial=4, maximum=8)
+    for _ in range(100):
+        controller.release(controller.acquire())
+    assert controller.concurrency == 8
+    started = [controller.acquire() for _ in range(3)]
+    for request_start in started:
+        controller.release(request_start, overloaded=True)
+    assert controller.concurrency == 4
+    assert controller.summary() == {'initial': 4, 'final': 4, 'min': 4, 'max': 8, 'changes': 5}
+
+
+def test_adaptive_concurrency_blocks_requests_over_limit():
+    controller = AdaptiveConcurrency(initial=2, maximum=2)
+    in_flight = []
+    peak = []
+    lock = threading.Lock()
+
+    def request(_):
+        started = controller.acquire()
+        with lock:
+            in_flight.append(1)
+            peak.append(len(in_flight))
+        time.sleep(0.02)
+        with lock:
+            in_flight.pop()
+        controller.release(started)
+
+    with ThreadPoolExecutor(max_workers=6) as pool:
+        list(pool.map(request, range(12)))
+    assert max(peak) == 2
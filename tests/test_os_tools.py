@@ -1,6 +1,11 @@
+import hashlib
 import os
 import shutil
-from toolbox.os_tools import path_to_, unzip_next_to, create_city_folder
+from zipfile import ZipFile
+
+from toolbox.os_tools import (create_city_folder, find_csv_sources,
+                              hash_csv_source, open_csv_source, path_to_,
+                              source_key, unzip_next_to)
 
 
 def test_path_to_func_result_created_from_root():
@@ -52,3 +57,33 @@ def test_create_city_folder_func_creates_folders_correctly():
         shutil.rmtree(path)
     create_city_folder(output_path, country, city)
     assert os.path.exists(path)
+
+
+def test_find_csv_sources_func_lists_zip_members_without_extracting():
+    provided_source_path = 'tests/test_data/csv_here/test_hotels.zip'
+    result = find_csv_sources(provided_source_path)
+    assert [(source.path, source.member) for source in result] == [(path_to_(provided_source_path), 'source_file1.csv')]
+    with open_csv_source(result[0]) as stream:
+        assert stream.readline().strip() == 'id, name, country, city, latitude, longitude'
+
+
+def test_find_csv_sources_func_lists_csv_files_in_directory():
+    provided_source_path = 'tests/test_data/csv_here'
+    result = find_csv_sources(provided_source_path)
+    assert [(source.path, source.member) for source in result] == [
+        (path_to_(provided_source_path, 'source_file1.csv'), None)]
+
+
+def test_find_csv_sources_func_return_message_when_path_not_zip_or_directory():
+    provided_source_path = 'tests/test_data/text.txt'
+    result = find_csv_sources(provided_source_path)
+    assert result == f"Directory {path_to_(provided_source_path)} is not a zip file. " \
+                     f"Please provide zip file or directory"
+
+
+def test_hash_csv_source_func_hashes_zip_member_content():
+    zip_source = find_csv_sources('tests/test_data/csv_here/test_hotels.zip')[0]
+    with ZipFile(zip_source.path) as zip_file:
+        expected_hash = hashlib.sha256(zip_file.read('source_file1.csv')).hexdigest()
+    assert source_key(zip_source) == 'source_file1.csv'
+    assert hash_csv_source(zip_source) == expected_hash
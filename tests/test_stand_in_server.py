@@ -0,0 +1,43 @@
+import json
+import time
+
+import requests
+
+from benchmarks.stand_in_server import (SECONDS_PER_DAY, StandInServer,
+                                        recording_key, shift_timestamps)
+
+
+def test_stand_in_server_answers_over_rate_limit_with_429():
+    with StandInServer(rate_limit=2) as server:
+        url = f'{server.url}/data/2.5/weather'
+        statuses = [requests.get(url, params={'lat': 55.75, 'lon': 37.62}).status_code for _ in range(3)]
+        resp = requests.get(url, params={'lat': 55.75, 'lon': 37.62})
+    assert statuses == [200, 200, 429]
+    assert resp.headers['Retry-After'] == '1'
+
+
+def test_stand_in_server_synthesizes_the_same_response_for_the_same_request():
+    with StandInServer() as server:
+        url = f'{server.url}/data/2.5/onecall/timemachine'
+        params = {'lat': 55.75, 'lon': 37.62, 'dt': int(time.time()) - SECONDS_PER_DAY}
+        first, second = (requests.get(url, params=params).json() for _ in range(2))
+    assert first == second
+    assert 1 <= len(first['hourly']) <= 24
+    assert all(-70 < record['temp'] < 70 for record in first['hourly'])
+
+
+def test_stand_in_server_replays_recordings_with_timestamps_moved_to_current_day(tmp_path):
+    now = int(time.time())
+    params = {'lat': ['55.75'], 'lon': ['37.62'], 'dt': [str(now - 2 * SECONDS_PER_DAY)]}
+    recorded_at = now - 3 * SECONDS_PER_DAY
+    body = {'hourly': [{'dt': recorded_at - 2 * SECONDS_PER_DAY, 'temp': 1.5}]}
+    recordings_path = tmp_path / 'recordings.json'
+    recordings_path.write_text(json.dumps({
+        recording_key('/data/2.5/onecall/timemachine', params, now): {
+            'status': 200, 'recorded_at': recorded_at, 'body': body}
+    }))
+    with StandInServer(recordings_path=str(recordings_path)) as server:
+        resp = requests.get(f'{server.url}/data/2.5/onecall/timemachine',
+                            params={key: values[0] for key, values in params.items()})
+    assert resp.json() == shift_timestamps(body, 3 * SECONDS_PER_DAY)
+    assert resp.json()['hourly'][0]['dt'] == now - 2 * SECONDS_PER_DAY
@@ -0,0 +1,40 @@
+import pytest
+
+from toolbox.time_tools import (find_timezone_name, get_country_timezone,
+                                get_zone_timezone)
+
+
+@pytest.mark.parametrize('latitude, longitude, zone', [
+    (55.751244, 37.618423, 'Europe/Moscow'),
+    (40.712776, -74.005974, 'America/New_York'),
+    (-33.868820, 151.209296, 'Australia/Sydney'),
+    (55.008353, 82.935733, 'Asia/Novosibirsk'),
+])
+def test_find_timezone_name_returns_zone_of_nearest_principal_location(latitude, longitude, zone):
+    assert find_timezone_name(latitude, longitude) == zone
+
+
+@pytest.mark.parametrize('latitude, longitude, country, zone', [
+    (42.240599, -8.720727, 'ES', 'Europe/Madrid'),
+    (39.470400, 75.989800, 'CN', 'Asia/Urumqi'),
+    (55.751244, 37.618423, 'XX', 'Europe/Moscow'),
+])
+def test_find_timezone_name_considers_only_zones_of_location_country(latitude, longitude, country, zone):
+    assert find_timezone_name(latitude, longitude, country) == zone
+
+
+def test_get_zone_timezone_returns_shift_in_seconds():
+    pytest.importorskip('zoneinfo')
+    assert get_zone_timezone('Europe/Moscow') == 3*60*60
+
+
+@pytest.mark.parametrize('country, timezone', [
+    ('RU', None),
+    ('US', None),
+    ('XX', None),
+    (None, None),
+    ('TR', 3*60*60),
+])
+def test_get_country_timezone_is_known_only_for_countries_with_one_shift(country, timezone):
+    pytest.importorskip('zoneinfo')
+    assert get_country_timezone(country) == timezone
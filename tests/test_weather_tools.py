@@ -1,22 +1,34 @@
 import pytest
 import requests
-from toolbox.weather_tools import get_city_timezone, get_all_hist_temp, get_forecast_temp_list
+
+from benchmarks.stand_in_server import StandInServer
+from toolbox import weather_tools
+from toolbox.weather_tools import (configure_weather_base_url,
+                                   get_all_hist_temp, get_city_timezone,
+                                   get_city_timezone_cached,
+                                   get_forecast_temp_list)
 
 WEATHER_API_KEY = "631f57b7539b1908d2fb62f79486fd95"
 
-URL_CURRENT = "https://api.openweathermap.org/data/2.5/weather"
-URL_FORECAST = "https://api.openweathermap.org/data/2.5/forecast"
-URL_HISTORIC = "https://api.openweathermap.org/data/2.5/onecall/timemachine"
+
+@pytest.fixture(scope='module', autouse=True)
+def stand_in():
+    previous_base_url = weather_tools.WEATHER_BASE_URL
+    with StandInServer(api_keys=(WEATHER_API_KEY, weather_tools.WEATHER_API_KEY)) as server:
+        configure_weather_base_url(server.url)
+        yield server
+    configure_weather_base_url(previous_base_url)
 
 
-def test_get_city_timezone_returns_correct_timezone():
-    moscow_timezone = get_city_timezone(55.751244, 37.618423, url=URL_CURRENT, api_key=WEATHER_API_KEY)
+def test_get_city_timezone_returns_correct_timezone(stand_in):
+    url = f'{stand_in.url}/data/2.5/weather'
+    moscow_timezone = get_city_timezone(55.751244, 37.618423, url=url, api_key=WEATHER_API_KEY)
     assert moscow_timezone == 3*60*60
 
 
-def test_error_raised_with_incorrect_url():
+def test_error_raised_with_incorrect_url(stand_in):
     params = {'appid': '123', 'lat': 55.751244, 'lon': 37.618423}
-    resp = requests.get(URL_CURRENT, params=params)
+    resp = requests.get(f'{stand_in.url}/data/2.5/weather', params=params)
     with pytest.raises(KeyError):
         return resp.json()['timezone']
 
@@ -33,3 +45,67 @@ def test_forecast_temperature_func_returns_8_reasonable_float_values_for_each_of
     for day_temps in forecast_4days:
         assert len(day_temps) == 8
         assert all(abs(float(day_temps[i])) < 70 for i in range(len(day_temps)))
+
+
+def test_city_timezone_is_resolved_without_weather_api(monkeypatch):
+    calls = []
+
+    def fake_get_json(url, params):
+        calls.append(url)
+        if url == weather_tools.URL_CURRENT:
+            return {'timezone': 3*60*60}
+        if url == weather_tools.URL_FORECAST:
+            return {'list': [{'dt': 0, 'main': {'temp': 1.0}}]}
+        return {'hourly': [{'dt': 0, 'temp': 1.0}]}
+
+    monkeypatch.setattr(weather_tools.weather_client, 'get_json', fake_get_json)
+    monkeypatch.setattr(weather_tools, '_timezones', {})
+    get_city_timezone_cached(48.8566, 2.3522, 'FR')
+    list(get_all_hist_temp((48.8566, 2.3522)))
+    get_forecast_temp_list((48.8566, 2.3522))
+    assert weather_tools.URL_CURRENT not in calls
+    assert len(calls) == 7
+
+
+@pytest.mark.parametrize('latitude, longitude, timezone', [
+    (32.7767, -96.797, -5*60*60),
+    (36.1627, -86.7816, -5*60*60),
+    (31.7619, -106.485, -6*60*60),
+])
+def test_city_timezone_is_requested_from_weather_api_in_country_with_several_shifts(
+        monkeypatch, latitude, longitude, timezone):
+    calls = []
+
+    def fake_get_json(url, params):
+        calls.append(url)
+        return {'timezone': timezone}
+
+    monkeypatch.setattr(weather_tools.weather_client, 'get_json', fake_get_json)
+    monkeypatch.setattr(weather_tools, '_timezones', {})
+    assert get_city_timezone_cached(latitude, longitude, 'US') == timezone
+    assert get_city_timezone_cached(latitude, longitude) == timezone
+    assert calls == [weather_tools.URL_CURRENT]
+
+
+def test_weather_responses_are_requested_once_with_cache(monkeypatch):
+    from toolbox.weather_tools import (open_weather_cache,
+                                       submit_all_hist_temp,
+                                       submit_forecast_temp_list)
+    calls = []
+
+    def fake_get_json(url, params):
+        calls.append(url)
+        if url == weather_tools.URL_FORECAST:
+            return {'list': [{'dt': 0, 'main': {'temp': 1.0}}]}
+        return {'hourly': [{'dt': 0, 'temp': 1.0}]}
+
+    monkeypatch.setattr(weather_tools.weather_client, 'get_json', fake_get_json)
+    monkeypatch.setattr(weather_tools, '_timezones', {(-33.8688, 151.2093): 10*60*60})
+    cache = open_weather_cache(':memory:')
+    for _ in range(2):
+        hist_temp_list = [day.result() for day in submit_all_hist_temp((-33.8688, 151.2093), cache=cache)]
+        forecast_today, forecast_4days = submit_forecast_temp_list((-33.8688, 151.2093), cache=cache).result()
+        assert hist_temp_list == [[1.0]] * 6
+        assert forecast_today == [1.0]
+    assert len(calls) == 7
+    assert (cache.hits, cache.misses) == (7, 7)
@@ -0,0 +1,152 @@
+import json
+import sqlite3
+import threading
+import time
+import zlib
+
+EVICTION_INTERVAL = 100
+ACCESS_FLUSH_INTERVAL = 100
+
+
+class PersistentCache:
+    """
+    Thread-safe key-value cache stored in SQLite file, so it is kept between runs and databases.
+    Entries expire after time to live, least recently used entries are evicted when cache grows over max_entries
+    or total size of values grows over max_bytes. Counts hits and misses.
+    Access times of hits are kept in memory and written in one transaction per ACCESS_FLUSH_INTERVAL hits,
+    so reading from cache doesn't write to disk
+    """
+
+    def __init__(self, path, ttl=None, max_entries=None, max_bytes=None):
+        """
+        :param path: path to cache file, ':memory:' for cache that is not persisted
+        :param ttl: default entry time to live in seconds, None for entries that never expire
+        :param max_entries: maximal number of entries, None for unlimited cache
+        :param max_bytes: maximal total size of values in bytes, None for unlimited cache
+        """
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._sets = 0
+        self._accessed = {}
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._connection.execute(
+            'create table if not exists cache (key text primary key, value blob, expires real, accessed real)')
+        self._connection.execute('create index if not exists ix_cache_accessed on cache (accessed)')
+
+    def get(self, key, default=None):
+        """
+        Returns cached value and marks it as recently used
+        :param key: entry key
+        :type key: str
+        :param default: value returned if key is missing or expired
+        :return: cached value
+        """
+        now = time.time()
+        with self._lock:
+            row = self._connection.execute('select value, expires from cache where key = ?', (key,)).fetchone()
+            if row is None or row[1] is not None and row[1] < now:
+                self.misses += 1
+                return default
+            self._accessed[key] = now
+            if len(self._accessed) >= ACCESS_FLUSH_INTERVAL:
+                self._flush_accessed()
+            self.hits += 1
+            return row[0]
+
+    def set(self, key, value, ttl=-1):
+        """
+        Saves value to cache
+        :param key: entry key
+        :type key: str
+        :param value: value to cache
+        :type value: Union[str,bytes,int,float]
+        :param ttl: entry time to live in seconds, None for entry that never expires, cache default if omitted
+        :return: None
+        """
+        now = time.time()
+        ttl = self.ttl if ttl == -1 else ttl
+        expires = now + ttl if ttl is not None else None
+        with self._lock:
+            self._connection.execute(
+                'insert or replace into cache (key, value, expires, accessed) values (?, ?, ?, ?)',
+                (key, value, expires, now))
+            self._sets += 1
+            if self._sets % EVICTION_INTERVAL == 0:
+                self._evict(now)
+
+    def _flush_accessed(self):
+        """
+        Writes access times of recent hits in one transaction
+        :return: None
+        """
+        if not self._accessed:
+            return
+        self._connection.execute('begin')
+        self._connection.executemany(
+            'update cache set accessed = ? where key = ?',
+            [(accessed, key) for key, accessed in self._accessed.items()])
+        self._connection.execute('commit')
+        self._accessed.clear()
+
+    def _evict(self, now):
+        """
+        Deletes expired entries and least recently used entries over max_entries and max_bytes
+        :param now: current timestamp
+        :return: None
+        """
+        self._flush_accessed()
+        self._connection.execute('delete from cache where expires < ?', (now,))
+        if self.max_entries is not None:
+            self._connection.execute(
+                'delete from cache where key in (select key from cache order by accessed desc limit -1 offset ?)',
+                (self.max_entries,))
+        if self.max_bytes is not None:
+            self._connection.execute(
+                'delete from cache where key in (select key from '
+                '(select key, sum(length(value)) over (order by accessed desc, key) as total from cache) '
+                'where total > ?)',
+                (self.max_bytes,))
+
+    def __len__(self):
+        with self._lock:
+            return self._connection.execute('select count(*) from cache').fetchone()[0]
+
+    def stats(self):
+        """
+        Cache efficiency counters
+        :return: hits, misses and current number of entries
+        :rtype: dict
+        """
+        return {'hits': self.hits, 'misses': self.misses, 'entries': len(self)}
+
+    def close(self):
+        """
+        Evicts extra entries and closes cache file
+        :return: None
+        """
+        with self._lock:
+            self._evict(time.time())
+            self._connection.close()
+
+
+def pack_json(value):
+    """
+    Compact cache value: JSON without spaces compressed with zlib
+    :param value: JSON serializable value
+    :rtype: bytes
+    """
+    return zlib.compress(json.dumps(value, separators=(',', ':')).encode())
+
+
+def unpack_json(blob):
+    """
+    Restores value packed with pack_json
+    :param blob: compressed JSON
+    :type blob: bytes
+    :return: value, tuples are restored as lists
+    """
+    return json.loads(zlib.decompress(blob))
@@ -1,10 +1,19 @@
-import datetime
+import csv
 import os
+from collections import Counter
+from itertools import islice
 
+import numpy as np
 from iso3166 import countries_by_alpha2
 from matplotlib import pyplot as plt
 
-from .os_tools import create_city_folder, path_to_
+from .os_tools import create_city_folder, open_csv_shard, path_to_
+
+COUNTRY_CODES = np.array(sorted(countries_by_alpha2))
+REJECTION_REASONS = ('columns', 'name', 'country', 'city', 'latitude', 'longitude')
+VALIDATION_CHUNK_SIZE = 10000
+SERIES_DTYPE = np.dtype('<f4')
+WEB_IMAGES_DIR = os.path.join('static', 'images')
 
 
 def is_country(country):
@@ -37,23 +46,135 @@ def is_coordinate(string):
     return True
 
 
-def read_validated(file_path):
+def parse_coordinates(values):
+    """
+    Converts column of coordinate strings to float array at once, values that are not numbers become NaN
+    :param values: latitude or longitude column
+    :type values: Sequence[str]
+    :rtype: numpy.ndarray
+    """
+    try:
+        return np.array(values, dtype=float)
+    except ValueError:
+        coordinates = np.full(len(values), np.nan)
+        for i, value in enumerate(values):
+            try:
+                coordinates[i] = float(value)
+            except ValueError:
+                pass
+        return coordinates
+
+
+def validate_rows(rows):
+    """
+    Validates chunk of csv rows column by column: fields are loaded to NumPy arrays and checked with vectorized masks.
+    Each rejected row is counted once, for the first failed check in REJECTION_REASONS order
+    :param rows: csv rows, each is a list of fields: id, hotel, country, city, latitude, longitude
+    :type rows: List[list[str]]
+    :return: validated records (hotel, country, city, latitude, longitude) and numbers of rejected rows by reason
+    :rtype: tuple[list[tuple[str,float]],Counter]
+    """
+    rejected = Counter()
+    complete_rows = [row for row in rows if len(row) == 6]
+    if len(complete_rows) < len(rows):
+        rejected['columns'] = len(rows) - len(complete_rows)
+    if not complete_rows:
+        return [], rejected
+    _, names, countries, cities, latitudes, longitudes = zip(*complete_rows)
+    names, countries, cities = np.array(names, dtype=str), np.array(countries, dtype=str), np.array(cities, dtype=str)
+    latitudes, longitudes = parse_coordinates(latitudes), parse_coordinates(longitudes)
+    with np.errstate(invalid='ignore'):
+        checks = (
+            ('name', names != ''),
+            ('country', np.isin(countries, COUNTRY_CODES)),
+            ('city', cities != ''),
+            ('latitude', np.abs(latitudes) <= 180),
+            ('longitude', np.abs(longitudes) <= 180),
+        )
+    valid = np.ones(len(complete_rows), dtype=bool)
+    for reason, mask in checks:
+        failed = int(np.count_nonzero(valid & ~mask))
+        if failed:
+            rejected[reason] = failed
+        valid &= mask
+    records = list(zip(
+        names[valid].tolist(), countries[valid].tolist(), cities[valid].tolist(),
+        latitudes[valid].tolist(), longitudes[valid].tolist()
+    ))
+    return records, rejected
+
+
+def read_validated_chunks(source, skip_header=True, chunk_size=VALIDATION_CHUNK_SIZE):
     """
-    Checks records from csv file line by line and yields only validated (no empty values or irrelevant information)
-    :param file_path: csv file with hotels records
+    Reads records from csv file in chunks (csv quoting is respected) and validates each chunk at once
+    :param source: path to csv file or text stream with hotels records
+    :param skip_header: whether first line is header
+    :param chunk_size: number of csv rows validated at once
+    :return: validated records and numbers of rejected rows by reason, one pair per chunk
+    :rtype: Generator[tuple[list[tuple[str,float]],Counter]]
+    """
+    if isinstance(source, (str, os.PathLike)):
+        with open(source, newline='') as input_file:
+            yield from read_validated_chunks(input_file, skip_header=skip_header, chunk_size=chunk_size)
+        return
+    reader = csv.reader(source)
+    if skip_header:
+        _ = next(reader, None)
+    for rows in chunked(reader, chunk_size):
+        yield validate_rows(rows)
+
+
+def iter_records(validated_chunks, rejected):
+    """
+    Yields records from validated chunks one by one and adds chunks rejection counts to given counter
+    :param validated_chunks: pairs of validated records and numbers of rejected rows by reason
+    :param rejected: counter to update with rejected rows numbers
+    :type rejected: Counter
+    :return: hotel, country, city, latitude, longitude
+    :rtype: Generator[tuple[str,float]]
+    """
+    for records, chunk_rejected in validated_chunks:
+        rejected.update(chunk_rejected)
+        yield from records
+
+
+def read_validated(source, skip_header=True):
+    """
+    Reads records from csv file and yields only validated (no empty values or irrelevant information)
+    :param source: path to csv file or text stream with hotels records
+    :param skip_header: whether first line is header
     :return: hotel, country, city, latitude, longitude
     :rtype: tuple[str,float]
     """
-    with open(file_path) as input_file:
-        _ = input_file.readline()
-        while line := input_file.readline():
-            fields = line.strip().split(',')
-            if len(fields) != 6:
-                continue
-            if not all(
-                    (fields[1], is_country(fields[2]), fields[3], is_coordinate(fields[4]), is_coordinate(fields[5]))):
-                continue
-            yield str(fields[1]), fields[2], fields[3], float(fields[4]), float(fields[5])
+    yield from iter_records(read_validated_chunks(source, skip_header=skip_header), Counter())
+
+
+def read_validated_shard(shard):
+    """
+    Reads all validated records from csv shard. Intended to run in worker process, so result is a list
+    :param shard: csv shard
+    :type shard: CsvShard
+    :return: validated records and numbers of rejected rows by reason
+    :rtype: tuple[list[tuple[str,float]],Counter]
+    """
+    rejected = Counter()
+    with open_csv_shard(shard) as stream:
+        records = list(iter_records(read_validated_chunks(stream, skip_header=not shard.start), rejected))
+    return records, rejected
+
+
+def chunked(iterable, size):
+    """
+    Splits iterable into consecutive lists of given size, the last list may be shorter.
+    Only one chunk is kept in memory at a time
+    :param iterable: any iterable, e.g. generator of validated records
+    :param size: maximal number of items in one chunk
+    :return: lists of items
+    :rtype: Generator[list]
+    """
+    iterator = iter(iterable)
+    while chunk := list(islice(iterator, size)):
+        yield chunk
 
 
 def find_city_center(coordinates_list):
@@ -73,22 +194,40 @@ def find_city_center(coordinates_list):
     return avg_latitude, avg_longitude
 
 
-def create_and_save_city_temp_plot(country, city, temperature_lists, output_path):
+def find_city_center_spherical(coordinates_list):
+    """
+    Calculates city center as spherical mean of hotels locations: hotels coordinates are converted to unit vectors,
+    their mean vector is converted back to latitude and longitude. Unlike arithmetic mean, it gives correct center
+    for cities crossed by antimeridian
+    :param coordinates_list: list of coordinates, one pair (latitude, longitude) for each hotel in the city
+    :return: latitude, longitude
+    :rtype: tuple(float)
+    """
+    latitudes, longitudes = np.radians(np.array(coordinates_list, dtype=float)).T
+    x = np.mean(np.cos(latitudes) * np.cos(longitudes))
+    y = np.mean(np.cos(latitudes) * np.sin(longitudes))
+    z = np.mean(np.sin(latitudes))
+    avg_latitude, avg_longitude = np.degrees(np.arctan2(z, np.hypot(x, y))), np.degrees(np.arctan2(y, x))
+    return float(avg_latitude), float(avg_longitude)
+
+
+def create_and_save_city_temp_plot(country, city, days_temp, output_path, web_root=None):
     """
-    Creates plot representing day max and day min temperatures in city during 10 days starting from 5 days ago
+    Creates plot representing day max and day min temperatures in city during observed days.
+    Plot is saved to city folder and its copy to WEB_IMAGES_DIR of web root
     :param country: country code (Alpha-2)
     :param city: city name
-    :param temperature_lists: list of temperature min-max pairs during 10 days. Includes historic and forecast data
-    :type temperature_lists: List[list]
+    :param days_temp: list of date, min temperature, max temperature tuples. Includes historic and forecast data
+    :type days_temp: List[tuple]
     :param output_path: base output path for all countries
-    :return: path to saved file from project root
+    :param web_root: directory web application serves images from, project root if omitted
+    :return: path to saved copy from web root
     :rtype: Path
     """
-    x = [i for i in range(1, 11)]
-    y1 = [max(day) for day in temperature_lists]
-    y2 = [min(day) for day in temperature_lists]
-    today = datetime.datetime.utcnow().date()
-    days = [str(today + datetime.timedelta(days=-5+i)) for i in range(10)]
+    x = [i for i in range(1, len(days_temp) + 1)]
+    y1 = [day[2] for day in days_temp]
+    y2 = [day[1] for day in days_temp]
+    days = [day[0] for day in days_temp]
 
     plt.title(f'Temperature in {city} by day')
     plt.xlabel('Day of observation')
@@ -101,10 +240,10 @@ def create_and_save_city_temp_plot(country, city, temperature_lists, output_path
     path_to_save = create_city_folder(output_path, country, city)
     file_path = os.path.join(path_to_save, f'{city}_plot.png')
     plt.savefig(file_path)
-    path_for_web = path_to_('static', 'images', f'{city}_plot.png')
+    path_for_web = os.path.join(web_root or path_to_(), WEB_IMAGES_DIR, f'{city}_plot.png')
     plt.savefig(path_for_web)
     plt.clf()
-    return os.path.join('static', 'images', f'{city}_plot.png')
+    return os.path.join(WEB_IMAGES_DIR, f'{city}_plot.png')
 
 
 def get_max_temp_day(city_10days_temp):
@@ -176,8 +315,9 @@ def get_city_statistics(city_10days_temp):
     - delta between highest and lowest day max temperature
     - min temperature and day when it was fixed
     - max difference between max and min temperatures in one day and day when it was fixed
-    :param city_10days_temp: list of temperature min-max pairs during 10 days, includes historic and forecast data
-    :type city_10days_temp: List[list]
+    :param city_10days_temp: list of date, min temperature, max temperature tuples during observed days,
+        includes historic and forecast data
+    :type city_10days_temp: List[tuple]
     :rtype: tuple[tuple]
     """
     indicator1 = get_max_temp_day(city_10days_temp)
@@ -185,3 +325,23 @@ def get_city_statistics(city_10days_temp):
     indicator3 = get_min_temp_day(city_10days_temp)
     indicator4 = get_max_minmax_temp_delta(city_10days_temp)
     return indicator1, indicator2, indicator3, indicator4
+
+
+def pack_temperature_series(temperatures):
+    """
+    Packs temperature series to compact binary form: little-endian float32 values, 4 bytes per measurement
+    :param temperatures: temperatures in order of measurement
+    :type temperatures: Iterable[float]
+    :rtype: bytes
+    """
+    return np.asarray(temperatures, dtype=SERIES_DTYPE).tobytes()
+
+
+def unpack_temperature_series(blob):
+    """
+    Restores series packed with pack_temperature_series. Array shares memory with blob, so it is read-only
+    :param blob: packed series
+    :type blob: bytes
+    :rtype: np.ndarray
+    """
+    return np.frombuffer(blob, dtype=SERIES_DTYPE)
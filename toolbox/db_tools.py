@@ -1,266 +1,690 @@
 import csv
-import datetime
 import json
-import os
+import math
 import pathlib
-from collections import defaultdict
-from concurrent.futures import ThreadPoolExecutor
-from functools import partial
+from collections import Counter, defaultdict, deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import groupby
+from operator import itemgetter
 
 import numpy as np
+import sqlalchemy as sa
 from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
-from sqlalchemy.sql import text
+from sqlalchemy.engine import make_url
+from sqlalchemy.orm import scoped_session, sessionmaker
+from sqlalchemy.pool import QueuePool
 
 from models import Base
 
-from .data_tools import (create_and_save_city_temp_plot, find_city_center,
-                         get_city_statistics, read_validated)
-from .geo_tools import get_address
-from .os_tools import create_city_folder, path_to_
-from .weather_tools import get_all_hist_temp, get_forecast_temp_list
+from .data_tools import (chunked, create_and_save_city_temp_plot,
+                         find_city_center_spherical, get_city_statistics,
+                         iter_records, pack_temperature_series,
+                         read_validated_chunks, read_validated_shard,
+                         unpack_temperature_series)
+from .geo_tools import (GEOCODE_CACHE_PRECISION, GEOCODE_CONCURRENCY,
+                        cluster_locations, configure_geocode_concurrency,
+                        geocode_locations, grid_cell)
+from .os_tools import (create_city_folder, hash_csv_source, open_csv_source,
+                       path_to_, source_key, split_csv_source)
+from .weather_tools import (FORECAST_DAYS, HISTORIC_DAYS, WEATHER_TIMEOUT,
+                            city_local_date, configure_weather_client,
+                            get_city_timezone_cached, submit_all_hist_temp,
+                            submit_forecast_temp_list)
+
+BULK_CHUNK_SIZE = 10000
+ADDRESS_PAGE_SIZE = 1000
+DERIVED_TABLES = ('major_cities', 'cities', 'daily_temperatures')
+SQLITE_PRAGMAS = (
+    ('journal_mode', 'WAL'),
+    ('synchronous', 'NORMAL'),
+    ('cache_size', -64 * 1024),
+    ('mmap_size', 256 * 1024 * 1024),
+    ('temp_store', 'MEMORY'),
+    ('busy_timeout', 5000),
+)
+
+
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    """
+    Connect event listener applying SQLITE_PRAGMAS to every new connection: write-ahead log, so readers
+    don't block writer, sync on checkpoints only, 64 MB page cache, memory-mapped reads and 5 seconds
+    wait for locks instead of immediate 'database is locked' error
+    :param dbapi_connection: sqlite3 connection
+    :param connection_record: connection pool record, not used
+    :return: None
+    """
+    cursor = dbapi_connection.cursor()
+    for name, value in SQLITE_PRAGMAS:
+        cursor.execute(f'pragma {name} = {value}')
+    cursor.close()
+
+
+def apply_sqlite_profile(engine):
+    """
+    Tunes connections of SQLite engine with SQLITE_PRAGMAS, other database engines are left as is
+    :param engine: SQLAlchemy Engine object
+    :return: engine
+    """
+    if engine.dialect.name == 'sqlite':
+        sa.event.listen(engine, 'connect', set_sqlite_pragmas)
+    return engine
+
+
+def create_db_engine(db_path):
+    """
+    Creates database engine. SQLite file database engine keeps queue of open connections between transactions
+    (file databases get a new connection per transaction by default), so tuned page cache and memory map
+    are not dropped after each commit. Pooled connection is used by one thread at a time but not always
+    by the thread that opened it, so sqlite3 same thread check is turned off.
+    In-memory database keeps default pool with one database per thread
+    :param db_path: path to database
+    :return: SQLAlchemy Engine object
+    """
+    url = make_url(db_path)
+    if url.get_backend_name() != 'sqlite':
+        return create_engine(db_path)
+    if url.database in (None, '', ':memory:'):
+        return apply_sqlite_profile(create_engine(db_path))
+    return apply_sqlite_profile(
+        create_engine(db_path, poolclass=QueuePool, connect_args={'check_same_thread': False}))
+
+
+def upgrade_db_schema(engine, metadata=Base.metadata, derived_tables=DERIVED_TABLES):
+    """
+    Brings tables created by previous versions up to date, as create_all only creates missing tables.
+    Missing columns are added with ALTER TABLE (they are nullable, so existing rows get NULL),
+    missing indexes are created. Table whose primary key changed can't be altered: if it keeps data
+    derived from hotels it is recreated empty and filled again by pipeline, otherwise RuntimeError is raised
+    :param engine: SQLAlchemy Engine object
+    :param metadata: tables definitions
+    :param derived_tables: names of tables that may be recreated
+    :return: names of added columns, indexes and recreated tables
+    :rtype: List[str]
+    """
+    inspector = sa.inspect(engine)
+    upgraded = []
+    with engine.begin() as connection:
+        for table in metadata.sorted_tables:
+            primary_key = inspector.get_pk_constraint(table.name)['constrained_columns']
+            if primary_key != [column.name for column in table.primary_key]:
+                if table.name not in derived_tables:
+                    raise RuntimeError(
+                        f'Primary key of {table.name} table changed from {primary_key}, create new database')
+                table.drop(connection)
+                table.create(connection)
+                upgraded.append(table.name)
+                continue
+            columns = {column['name'] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in columns:
+                    continue
+                definition = sa.schema.CreateColumn(column).compile(dialect=engine.dialect)
+                for foreign_key in column.foreign_keys:
+                    definition = f'{definition} REFERENCES {foreign_key.column.table.name} ({foreign_key.column.name})'
+                connection.execute(sa.text(f'ALTER TABLE {table.name} ADD COLUMN {definition}'))
+                upgraded.append(f'{table.name}.{column.name}')
+            indexes = {index['name'] for index in inspector.get_indexes(table.name)}
+            for index in table.indexes:
+                if index.name not in indexes:
+                    index.create(connection)
+                    upgraded.append(index.name)
+    return upgraded
 
 
 def start_db_session(db_path):
     """
-    Starts database session
+    Starts database session. Session is thread-local: each thread using it gets its own session and connection,
+    threads other than main should call session.remove() when finished.
+    Database created by previous versions is upgraded in place
     :param db_path: path to database
-    :return: SQLAlchemy Session object
+    :return: SQLAlchemy scoped_session object, used as Session object
     """
-    engine = create_engine(db_path)
+    engine = create_db_engine(db_path)
     Base.metadata.create_all(engine)
-    Session = sessionmaker(bind=engine)
-    session = Session()
-    return session
+    upgrade_db_schema(engine)
+    return scoped_session(sessionmaker(bind=engine))
 
 
-def add_records_to_table(file_path, session, cls):
+def add_records_to_table(records, session, cls, source=None):
     """
-    Adds valid records from csv file to hotels table
-    :param file_path: path to csv file with hotels information
+    Adds validated records to hotels table as ORM objects
+    :param records: validated records (hotel, country, city, latitude, longitude)
+    :type records: Iterable[tuple[str,float]]
     :param session: SQLAlchemy Session object
     :param cls: table class model
-    :return: None
-    """
-    for record in read_validated(file_path):
-        hotel = cls(name=record[0], country=record[1], city=record[2], latitude=record[3], longitude=record[4])
+    :param source: name of csv source records come from
+    :return: number of added records
+    :rtype: int
+    """
+    added = 0
+    for record in records:
+        hotel = cls(
+            name=record[0], country=record[1], city=record[2], latitude=record[3], longitude=record[4], source=source)
         session.add(hotel)
+        added += 1
+    return added
+
+
+def bulk_add_records_to_table(records, session, cls, chunk_size=BULK_CHUNK_SIZE, source=None):
+    """
+    Inserts validated records to hotels table in fixed-size chunks with executemany-style Core inserts.
+    Records bypass ORM unit of work, so memory usage doesn't depend on number of records
+    :param records: validated records (hotel, country, city, latitude, longitude)
+    :type records: Iterable[tuple[str,float]]
+    :param session: SQLAlchemy Session object
+    :param cls: table class model
+    :param chunk_size: number of records sent to database in one insert
+    :param source: name of csv source records come from
+    :return: number of inserted records
+    :rtype: int
+    """
+    insert_stmt = cls.__table__.insert()
+    inserted = 0
+    for chunk in chunked(records, chunk_size):
+        session.execute(insert_stmt, [
+            {'name': name, 'country': country, 'city': city, 'latitude': latitude, 'longitude': longitude,
+             'source': source}
+            for name, country, city, latitude, longitude in chunk
+        ])
+        inserted += len(chunk)
+    return inserted
+
+
+def read_validated_in_processes(shards, workers):
+    """
+    Validates csv shards in parallel worker processes.
+    At most two shards per worker are in flight, so memory usage doesn't depend on number of shards
+    :param shards: csv shards
+    :type shards: Iterable[CsvShard]
+    :param workers: number of worker processes
+    :return: shard, its validated records and numbers of rejected rows by reason, in order of shards
+    :rtype: Generator[tuple[CsvShard,tuple[list,Counter]]]
+    """
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        pending = deque()
+        for shard in shards:
+            pending.append((shard, pool.submit(read_validated_shard, shard)))
+            if len(pending) >= 2 * workers:
+                shard, future = pending.popleft()
+                yield shard, future.result()
+        while pending:
+            shard, future = pending.popleft()
+            yield shard, future.result()
+
+
+def find_changed_sources(sources, session, manifest_cls):
+    """
+    Compares csv sources with ingest manifest.
+    Content hash is calculated only if size or modification time differ from manifest,
+    sources with the same content but new modification time are updated in manifest and treated as unchanged
+    :param sources: csv sources found by find_csv_sources
+    :type sources: List[CsvSource]
+    :param session: SQLAlchemy Session object
+    :param manifest_cls: ingest manifest class model
+    :return: new or changed sources with their content hashes, names of sources missing from input
+    :rtype: tuple[list[tuple[CsvSource,str]],list[str]]
+    """
+    manifest = {record.source: record for record in session.query(manifest_cls)}
+    changed = []
+    for source in sources:
+        record = manifest.pop(source_key(source), None)
+        if record and record.size == source.size and record.mtime == source.mtime:
+            continue
+        content_hash = hash_csv_source(source)
+        if record and record.content_hash == content_hash:
+            record.size, record.mtime = source.size, source.mtime
+            continue
+        changed.append((source, content_hash))
+    session.commit()
+    return changed, list(manifest)
 
 
-def fill_table_from_csv(file_dir, session, cls):
+def retract_source(session, cls, key):
     """
-    Adds valid records from csv files from given directory to hotels table.
-    :param file_dir: path to directory with csv files
+    Deletes hotels loaded from given csv source
     :param session: SQLAlchemy Session object
     :param cls: table class model
+    :param key: csv source name, None for hotels loaded before their sources were recorded
+    :return: number of deleted records
+    :rtype: int
+    """
+    return session.query(cls).filter(cls.source == key).delete(synchronize_session=False)
+
+
+def record_source_ingested(session, manifest_cls, source, content_hash):
+    """
+    Saves csv source fingerprint to ingest manifest and commits its records along with it
+    :param session: SQLAlchemy Session object
+    :param manifest_cls: ingest manifest class model
+    :param source: csv source
+    :type source: CsvSource
+    :param content_hash: source content hash
     :return: None
     """
-    if session.query(cls).first():
-        return True
-    for file in os.listdir(file_dir):
-        if file.endswith('.csv'):
-            add_records_to_table(path_to_(file_dir, file), session, cls)
+    session.merge(manifest_cls(
+        source=source_key(source), size=source.size, mtime=source.mtime, content_hash=content_hash))
     session.commit()
 
 
-def find_major_cities(session, cls):
+def fill_table_from_csv(sources, session, cls, manifest_cls, bulk=True, chunk_size=BULK_CHUNK_SIZE, workers=1):
     """
-    Groups cities with maximal number of hotels in relation with countries
+    Adds valid records from csv sources (files in directory or members of zip archive) to hotels table.
+    Sources are read as streams, zip archive is never extracted to disk.
+    Ingest is incremental: only sources that are new or changed since previous run are loaded
+    (replacing their previous records), records of sources missing from input are deleted.
+    Each source is committed along with its manifest record, so interrupted ingest is resumed on next run.
+    Records loaded by previous versions have no source and are replaced as well.
+    With several workers sources are split into shards validated in worker processes,
+    while records are inserted by current process only.
+    :param sources: csv sources found by find_csv_sources
+    :type sources: List[CsvSource]
     :param session: SQLAlchemy Session object
     :param cls: table class model
+    :param manifest_cls: ingest manifest class model
+    :param bulk: insert records in chunks with Core inserts instead of adding ORM objects one by one
+    :param chunk_size: number of records in one bulk insert
+    :param workers: number of processes validating csv records, bulk insert is used if more than 1
+    :return: numbers of added and deleted records, numbers of rejected rows by reason
+    :rtype: tuple[int,int,Counter]
+    """
+    rejected = Counter()
+    changed, removed = find_changed_sources(sources, session, manifest_cls)
+    retracted = retract_source(session, cls, None)
+    for key in removed:
+        retracted += retract_source(session, cls, key)
+        session.query(manifest_cls).filter(manifest_cls.source == key).delete(synchronize_session=False)
+    session.commit()
+
+    added = 0
+    if workers > 1:
+        content_hashes = {source: content_hash for source, content_hash in changed}
+        shards = (shard for source, _ in changed for shard in split_csv_source(source))
+        for shard, (records, shard_rejected) in read_validated_in_processes(shards, workers):
+            if not shard.start:
+                retracted += retract_source(session, cls, source_key(shard.source))
+            added += bulk_add_records_to_table(
+                records, session, cls, chunk_size=chunk_size, source=source_key(shard.source))
+            rejected.update(shard_rejected)
+            if shard.end is None or shard.end == shard.source.size:
+                record_source_ingested(session, manifest_cls, shard.source, content_hashes[shard.source])
+        return added, retracted, rejected
+
+    for source, content_hash in changed:
+        retracted += retract_source(session, cls, source_key(source))
+        with open_csv_source(source) as stream:
+            records = iter_records(read_validated_chunks(stream), rejected)
+            if bulk:
+                added += bulk_add_records_to_table(
+                    records, session, cls, chunk_size=chunk_size, source=source_key(source))
+            else:
+                added += add_records_to_table(records, session, cls, source=source_key(source))
+        record_source_ingested(session, manifest_cls, source, content_hash)
+    return added, retracted, rejected
+
+
+def find_major_cities(session, cls):
+    """
+    Groups cities with maximal number of hotels in relation with countries.
+    Hotels are counted in one pass over (country, city) index, cities are ranked inside country with window function.
+    If several cities of a country have the same number of hotels, the first one in alphabetical order is chosen
+    :param session: SQLAlchemy Session object
+    :param cls: hotels class model
     :return: country-city pairs
     :rtype: dict
     """
-    stmt = text(
-        "select h.COU1, h.C1 from ("
-        "select country as COU1, city as C1, count(name) as I from hotels group by COU1, C1"
-        ") as h inner join ("
-        "select h3.COU3 as COU4, max(h3.K) as m from ("
-        "select country as COU3, count(name) as K from hotels group by COU3, city"
-        ") as h3 group by h3.COU3) as h4 on (h4.COU4 = h.COU1 and h4.m = h.I)"
-                ).columns(cls.country, cls.city)
-    query = session.query(cls).from_statement(stmt).all()
-    major_cities = {obj.country: obj.city for obj in query}
+    hotels_count = sa.func.count(cls.id)
+    city_rank = sa.func.row_number().over(partition_by=cls.country, order_by=(hotels_count.desc(), cls.city))
+    ranked_cities = session.query(
+        cls.country, cls.city, city_rank.label('city_rank')
+    ).group_by(cls.country, cls.city).subquery()
+    query = session.query(ranked_cities.c.country, ranked_cities.c.city).filter(ranked_cities.c.city_rank == 1)
+    major_cities = {country: city for country, city in query}
     return major_cities
 
 
 def fill_major_cities_table(session, cls, major_cities):
     """
-    Fills major cities table with countries and cities
+    Fills major cities table with countries and cities. Table filled in previous run is updated in place:
+    countries keep their city id, cities of countries missing in major_cities are deleted
     :param session: SQLAlchemy Session object
     :param cls: table class model
     :param major_cities: country-city pairs
     :type major_cities: dict
     :return: Union[True,None]
     """
-    if session.query(cls).first():
+    saved_cities = {major_city.country: major_city for major_city in session.query(cls)}
+    if {country: major_city.city for country, major_city in saved_cities.items()} == major_cities:
         return True
+    for country, major_city in saved_cities.items():
+        if country not in major_cities:
+            session.delete(major_city)
     for country, city in major_cities.items():
-        city = cls(country=country, city=city)
-        session.add(city)
+        if country in saved_cities:
+            saved_cities[country].city = city
+        else:
+            session.add(cls(country=country, city=city))
     session.commit()
 
 
-def attach_address_if_in_major_city(hotel, major_cities):
-    """
-    Attaches address attribute to hotel object
-    :param hotel: object of hotel model class
-    :param major_cities: country-city pairs
-    :type major_cities: dict
-    :return: object of hotel class with address attribute
-    """
-    # if hotel.city == 'Houston' and not hotel.address:  # for testing while developing to preserve free API calls limit
-    if hotel.city == major_cities.get(hotel.country) and not hotel.address:
-        latitude, longitude = hotel.latitude, hotel.longitude
-        address = get_address(latitude, longitude)
-        hotel.address = address
-    return hotel
-
-
-def fill_addresses_for_major_cities(session, cls, major_cities, threads=4):
+def link_hotels_to_major_cities(session, cls, city_cls):
     """
-    Updates hotel addresses for hotels in major cities
+    Sets major city id of hotels located in major cities, other hotels are unlinked.
+    Done in bulk once per run with one update per city over (country, city) index,
+    so following queries select hotels of major cities by indexed integer id instead of comparing names
     :param session: SQLAlchemy Session object
-    :param cls: table class model
-    :param major_cities: country-city pairs
-    :type major_cities: dict
-    :param threads: number of threads for parallel geocoding request
-    :return: None
-    """
-    attach_address = partial(attach_address_if_in_major_city, major_cities=major_cities)
-    hotels = session.query(cls).all()
-    with ThreadPoolExecutor(max_workers=threads) as pool:
-        pool.map(attach_address, hotels)
+    :param cls: hotels class model
+    :param city_cls: major cities class model
+    :return: number of hotels located in major cities
+    :rtype: int
+    """
+    hotels = cls.__table__
+    session.execute(hotels.update().where(hotels.c.major_city_id.isnot(None)).values(major_city_id=None))
+    link_stmt = hotels.update().where(
+        hotels.c.country == sa.bindparam('city_country'), hotels.c.city == sa.bindparam('city_name')
+    ).values(major_city_id=sa.bindparam('city_id'))
+    session.execute(link_stmt, [
+        {'city_id': city_id, 'city_country': country, 'city_name': city}
+        for city_id, country, city in session.query(city_cls.id, city_cls.country, city_cls.city)
+    ])
     session.commit()
+    return session.query(cls).filter(cls.major_city_id.isnot(None)).count()
 
 
-def get_hotels_coordinates(session, cls, country, city):
+def yield_hotel_groups_without_address(session, cls, share_distance=0, page_size=ADDRESS_PAGE_SIZE):
     """
-    Collects hotels coordinates from hotels table in relation to city and country
+    Yields hotels linked to major cities that have no address yet, grouped with spatial grid index.
+    Hotels are read page by page with keyset pagination in order of (latitude, longitude) index,
+    so only about page_size hotels are held in memory. Grid cell lies inside one row of latitude,
+    so page is extended till the end of its last grid row (or its last coordinates if share_distance is 0)
+    and nearby hotels on page boundary share one lookup as well
     :param session: SQLAlchemy Session object
     :param cls: table class model
-    :param country: country Alpha-2 code
-    :param city: city name
-    :return: list of all hotels coordinates in given city
-    :rtype: List[tuple[float]]
-    """
-    coordinates_list = []
-    query = session.query(cls).filter(cls.country == country, cls.city == city).all()
-    for hotel in query:
-        coordinates_list.append((float(hotel.latitude), float(hotel.longitude)))
-    return coordinates_list
+    :param share_distance: maximal distance in meters between hotels in one group,
+        0 to group only hotels with equal coordinates
+    :param page_size: number of hotels in one page, page is never split inside group
+    :return: pages, each is list of groups of (id, latitude, longitude) rows
+    :rtype: Generator[list[list]]
+    """
+    if share_distance:
+        def grid_row(hotel):
+            return grid_cell(hotel.latitude, hotel.longitude, share_distance)[0]
+    else:
+        def grid_row(hotel):
+            return hotel.latitude, hotel.longitude
+
+    def grouped(hotels):
+        groups = cluster_locations([(hotel.latitude, hotel.longitude) for hotel in hotels], share_distance)
+        return [[hotels[index] for index in group] for group in groups]
+
+    query = session.query(cls.id, cls.latitude, cls.longitude).filter(
+        cls.major_city_id.isnot(None), cls.address.is_(None)).order_by(cls.latitude, cls.longitude, cls.id)
+    position = sa.tuple_(cls.latitude, cls.longitude, cls.id)
+    page, last = [], None
+    while True:
+        hotels = (query if last is None else query.filter(position > last)).limit(page_size).all()
+        for hotel in hotels:
+            if len(page) >= page_size and grid_row(hotel) != grid_row(page[-1]):
+                yield grouped(page)
+                page = []
+            page.append(hotel)
+        if len(hotels) < page_size:
+            break
+        last = (hotels[-1].latitude, hotels[-1].longitude, hotels[-1].id)
+    if page:
+        yield grouped(page)
+
+
+def fill_addresses_for_major_cities(session, cls, threads=4, cache=None,
+                                    precision=GEOCODE_CACHE_PRECISION, share_distance=0, batch_size=1,
+                                    use_async=False, concurrency=GEOCODE_CONCURRENCY, page_size=ADDRESS_PAGE_SIZE,
+                                    max_threads=None):
+    """
+    Updates hotel addresses for hotels linked to major cities (see link_hotels_to_major_cities).
+    Only hotels without address are queried. They are grouped with spatial grid index, one geocoding lookup
+    is made per group and its address is shared by all hotels in group. Groups are geocoded page by page,
+    addresses of each page are written in bulk and committed by current thread, so interrupted run loses
+    at most one page and resumes with hotels that are still without address
+    :param session: SQLAlchemy Session object
+    :param cls: table class model
+    :param threads: initial number of parallel geocoding requests
+    :param cache: reverse geocoding cache
+    :type cache: PersistentCache
+    :param precision: number of decimal places coordinates are rounded to in cache key
+    :param share_distance: maximal distance in meters between hotels sharing one lookup,
+        0 to share lookups only between hotels with equal coordinates
+    :param batch_size: number of locations in one geocoding request
+    :param use_async: use asyncio geocoding engine instead of thread pool
+    :param concurrency: maximal number of geocoding requests in flight for asyncio engine
+    :param page_size: number of hotels geocoded between commits
+    :param max_threads: number of parallel geocoding requests grows up to max_threads while service
+        responds fast and decreases when it is throttling, equal to threads if omitted
+    :return: number of geocoding lookups saved by grouping
+    :rtype: int
+    """
+    saved_lookups = 0
+    max_threads = max_threads or threads
+    configure_geocode_concurrency(initial=threads, maximum=max_threads)
+    for groups in yield_hotel_groups_without_address(session, cls, share_distance, page_size=page_size):
+        locations = [(group[0].latitude, group[0].longitude) for group in groups]
+        addresses = geocode_locations(
+            locations, threads=max_threads, cache=cache, precision=precision, batch_size=batch_size,
+            use_async=use_async, concurrency=concurrency)
+        session.bulk_update_mappings(cls, [
+            {'id': hotel.id, 'address': address}
+            for group, address in zip(groups, addresses) if address is not None
+            for hotel in group
+        ])
+        session.commit()
+        saved_lookups += sum(len(group) for group in groups) - len(groups)
+    return saved_lookups
 
 
-def get_major_cities_coordinates(session, cls, major_cities):
+def get_major_cities_coordinates(session, cls, spherical=False):
     """
-    Returns city coordinates for all major cities.
+    Returns city coordinates for all major cities, calculated in one query over hotels table
+    grouped by indexed major city id (see link_hotels_to_major_cities).
+    Arithmetic mean of hotels coordinates is aggregated by database. Spherical mean of hotels unit vectors
+    is calculated from coordinates fetched in the same single query, it is correct near antimeridian and poles
     :param session: SQLAlchemy Session object
     :param cls: table class model
-    :param major_cities: country-city pairs
-    :return: List of cities coordinates
+    :param spherical: use spherical mean instead of arithmetic mean
+    :return: cities coordinates by major city id
+    :rtype: dict
     """
-    coordinates = defaultdict()
-    for country, city in major_cities.items():
-        coordinates_list = get_hotels_coordinates(session, cls, country, city)
-        coordinates[(country, city)] = find_city_center(coordinates_list)
+    if not spherical:
+        query = session.query(
+            cls.major_city_id, sa.func.avg(cls.latitude), sa.func.avg(cls.longitude)
+        ).filter(cls.major_city_id.isnot(None)).group_by(cls.major_city_id)
+        return {major_city_id: (latitude, longitude) for major_city_id, latitude, longitude in query}
+    query = session.query(
+        cls.major_city_id, cls.latitude, cls.longitude
+    ).filter(cls.major_city_id.isnot(None)).order_by(cls.major_city_id)
+    coordinates = {}
+    for major_city_id, rows in groupby(query, key=itemgetter(0)):
+        coordinates[major_city_id] = find_city_center_spherical([(row[1], row[2]) for row in rows])
     return coordinates
 
 
-def fill_major_cities_table_with_coordinates(session, source_cls, target_cls, major_cities):
+def fill_major_cities_table_with_coordinates(session, source_cls, target_cls, city_cls, spherical=False):
     """
-    Updates cities table with cities coordinates
+    Updates cities table with cities coordinates. Table filled in previous run is compared with current
+    major cities and their centers: cities that are no longer major or whose center moved (hotels were added
+    or deleted) are replaced with new rows, so their temperatures are fetched again, other rows are kept
     :param session: SQLAlchemy Session object
     :param source_cls: hotels class model
     :param target_cls: cities class model
-    :param major_cities: country-city pairs
-    :return: None
+    :param city_cls: major cities class model
+    :param spherical: use spherical mean of hotels coordinates as city center
+    :return: Union[True,None]
     """
-    city_centers = get_major_cities_coordinates(session, source_cls, major_cities)
-    if not session.query(target_cls).first():
-        for city, coords in city_centers.items():
-            session.add(target_cls(country=city[0], city=city[1], latitude=coords[0], longitude=coords[1]))
-        session.commit()
+    city_centers = get_major_cities_coordinates(session, source_cls, spherical=spherical)
+    expected = {
+        (major_city.country, major_city.city): city_centers[major_city.id]
+        for major_city in session.query(city_cls).filter(city_cls.id.in_(list(city_centers)))
+    }
+    saved = {(city.country, city.city): city for city in session.query(target_cls)}
+    unchanged = set()
+    for key, city in saved.items():
+        if key in expected and all(
+                math.isclose(value, center, abs_tol=1e-9)
+                for value, center in zip((city.latitude, city.longitude), expected[key])):
+            unchanged.add(key)
+        else:
+            session.delete(city)
+    if len(unchanged) == len(saved) == len(expected):
+        return True
+    for (country, city), (latitude, longitude) in expected.items():
+        if (country, city) not in unchanged:
+            session.add(target_cls(country=country, city=city, latitude=latitude, longitude=longitude))
+    session.commit()
 
 
-def fill_major_cities_table_with_temperatures(session, cls, threads=4):
+def fill_major_cities_table_with_temperatures(session, cls, temperature_cls, threads=4, timeout=WEATHER_TIMEOUT,
+                                              cache=None, max_threads=None, historic_days=HISTORIC_DAYS,
+                                              forecast_days=FORECAST_DAYS):
     """
-    Updates cities table with temperatures mins and maxs for 10 days starting from 5 days ago
+    Fills daily temperatures table with temperatures mins and maxs of each city in cities table
+    for window of days around today: historic_days days ago, today and forecast_days coming days.
+    Cities whose saved dates differ from current local window (new cities or window of previous day) are requested.
+    Local window is computed in city timezone, resolved with city country.
+    With weather cache all cities are requested again, so today temperatures and forecasts are refreshed
+    when their cache entries expire, while completed historic days are read from cache.
+    Temperatures of cities deleted from cities table are deleted.
+    Temperatures are written with one bulk insert along with packed series of all day measurements
+    and number of hourly measurements preceding 3-hourly forecast ones
     :param session: SQLAlchemy Session object
-    :param cls: table class model
-    :param threads: number of threads for parallel requests
+    :param cls: cities class model
+    :param temperature_cls: daily temperatures class model
+    :param threads: initial number of parallel weather requests
+    :param timeout: seconds to wait for connection and response of weather service
+    :param cache: weather cache, responses found there are not requested again
+    :type cache: Optional[PersistentCache]
+    :param max_threads: number of parallel requests grows up to max_threads while service responds fast
+        and decreases when it is throttling, equal to threads if omitted
+    :param historic_days: number of past days, up to HISTORIC_DAYS
+    :param forecast_days: number of coming days, up to FORECAST_DAYS
     :return: None
     """
-    cities = session.query(cls)
-    if cities.first().today:
-        return True
-    coordinates = [(city.latitude, city.longitude) for city in cities]
-    with ThreadPoolExecutor(max_workers=threads) as pool:
-        hist_all_days_by_city = pool.map(get_all_hist_temp, coordinates)
-        forecast_5days_by_city = pool.map(get_forecast_temp_list, coordinates)
+    session.query(temperature_cls).filter(temperature_cls.city_id.notin_(session.query(cls.id))).delete(
+        synchronize_session=False)
+    saved_dates = defaultdict(set)
+    for city_id, date in session.query(temperature_cls.city_id, temperature_cls.date).filter(
+            temperature_cls.series_split.isnot(None)):
+        saved_dates[city_id].add(date)
+    cities = session.query(cls.id, cls.latitude, cls.longitude, cls.country).order_by(cls.id).all()
+    configure_weather_client(concurrency=threads, max_concurrency=max_threads, timeout=timeout)
     for city in cities:
-        hist_temp_list = list(next(hist_all_days_by_city))
-        forecast_today, forecast_4days = list(next(forecast_5days_by_city))
+        get_city_timezone_cached(city.latitude, city.longitude, city.country)
+    if cache is None:
+        cities = [
+            city for city in cities if saved_dates[city.id] != {
+                city_local_date(city.latitude, city.longitude, day_num)
+                for day_num in range(-historic_days, forecast_days + 1)
+            }
+        ]
+    if not cities:
+        session.commit()
+        return True
+    hist_all_days = [submit_all_hist_temp(city[1:3], cache=cache, days=historic_days) for city in cities]
+    forecasts = [submit_forecast_temp_list(city[1:3], cache=cache) for city in cities]
+    rows = []
+    for (city_id, latitude, longitude, _), hist_days, forecast in zip(cities, hist_all_days, forecasts):
+        hist_temp_list = [day.result() for day in hist_days]
+        forecast_today, forecast_days_temp_list = forecast.result()
+        temp_lists = hist_temp_list[:-1] + [hist_temp_list[-1] + forecast_today] + \
+            forecast_days_temp_list[:forecast_days]
+        sources = ['historic'] * historic_days + ['today'] + ['forecast'] * forecast_days
+        splits = [len(temp_list) for temp_list in hist_temp_list] + [0] * forecast_days
+        for day_num, (temp_list, source, split) in enumerate(zip(temp_lists, sources, splits), -historic_days):
+            rows.append({
+                'city_id': city_id, 'date': city_local_date(latitude, longitude, day_num),
+                'min_temp': min(temp_list), 'max_temp': max(temp_list), 'source': source,
+                'series': pack_temperature_series(temp_list), 'series_split': split
+            })
+    session.query(temperature_cls).filter(temperature_cls.city_id.in_([city.id for city in cities])).delete(
+        synchronize_session=False)
+    session.execute(temperature_cls.__table__.insert(), rows)
+    session.commit()
 
-        hist_temp_ranges = (json.dumps((min(lst), max(lst))) for lst in hist_temp_list[:-1])
-        forecast_temp_ranges = (json.dumps((min(lst), max(lst))) for lst in forecast_4days)
-        today_temperatures = hist_temp_list[-1] + forecast_today
-        today_temp_range = json.dumps((min(today_temperatures), max(today_temperatures)))
 
-        city.historic_5, city.historic_4, city.historic_3, city.historic_2, city.historic_1 = hist_temp_ranges
-        city.forecast_1, city.forecast_2, city.forecast_3, city.forecast_4 = forecast_temp_ranges
-        city.today = today_temp_range
-    session.commit()
+def query_cities_temperatures(session, cls, temperature_cls):
+    """
+    Fetches temperatures of all cities with one query ordered by city and date
+    :param session: SQLAlchemy Session object
+    :param cls: cities class model
+    :param temperature_cls: daily temperatures class model
+    :return: city and its (date, min temperature, max temperature) tuples, dates are ISO formatted
+    :rtype: Iterator[tuple]
+    """
+    query = session.query(cls, temperature_cls.date, temperature_cls.min_temp, temperature_cls.max_temp).join(
+        temperature_cls, temperature_cls.city_id == cls.id).order_by(cls.id, temperature_cls.date)
+    for city, rows in groupby(query, key=itemgetter(0)):
+        yield city, [(date.isoformat(), min_temp, max_temp) for _, date, min_temp, max_temp in rows]
+
+
+def get_temperature_series(session, cls, temperature_cls, country, city):
+    """
+    Reads saved temperature measurements of city without requests to weather service.
+    Day measurements are split by resolution: hourly (historic) and 3-hourly (forecast),
+    today has both. Arrays are not copied from fetched rows, so they are read-only
+    :param session: SQLAlchemy Session object
+    :param cls: cities class model
+    :param temperature_cls: daily temperatures class model
+    :param country: country code (Alpha-2)
+    :param city: city name
+    :return: float32 arrays of hourly and 3-hourly day measurements by ISO formatted local date
+    :rtype: dict[str,tuple[np.ndarray,np.ndarray]]
+    """
+    query = session.query(temperature_cls.date, temperature_cls.series, temperature_cls.series_split).join(
+        cls, temperature_cls.city_id == cls.id).filter(cls.country == country, cls.city == city).order_by(
+        temperature_cls.date)
+    series = {}
+    for date, blob, split in query:
+        measurements = unpack_temperature_series(blob)
+        series[date.isoformat()] = (measurements[:split], measurements[split:])
+    return series
 
 
-def get_cities_statistics(session, cls):
+def get_cities_statistics(session, cls, temperature_cls):
     """
     Gets cities temperatures with relevant days for following analysis
     :param session: SQLAlchemy Session object
-    :param cls: table class model
+    :param cls: cities class model
+    :param temperature_cls: daily temperatures class model
     :return: all cities all days temperatures
     """
-    cities = session.query(cls)
-    column_names = [column.key for column in cls.__table__.columns]
-    temp_columns = column_names[-10:]
-    today = datetime.datetime.utcnow().date()
-    dates = [str(today + datetime.timedelta(days=-5+i)) for i in range(10)]
-    cities_statistics = []
-    for city in cities:
-        min_temperatures = [json.loads(city.__getattribute__(day))[0] for day in temp_columns]
-        max_temperatures = [json.loads(city.__getattribute__(day))[1] for day in temp_columns]
-        city_10days_temp = list(zip(dates, min_temperatures, max_temperatures))
-        city_statistics = get_city_statistics(city_10days_temp)
-        cities_statistics.append((city.country, city.city, city_statistics))
-    return cities_statistics
+    return [
+        (city.country, city.city, get_city_statistics(days_temp))
+        for city, days_temp in query_cities_temperatures(session, cls, temperature_cls)
+    ]
 
 
-def create_and_save_all_plots(session, cls, output_path):
+def create_and_save_all_plots(session, cls, temperature_cls, output_path, web_root=None):
     """
     Creates temperature plots for each major city based on data from table and saves them to cities folders.
     Adds absolute path to file in table record
     :param session: SQLAlchemy Session object
-    :param cls: table class model
+    :param cls: cities class model
+    :param temperature_cls: daily temperatures class model
     :param output_path: path to base output folder
+    :param web_root: directory web application serves images from, project root if omitted
     :return: None
     """
-    cities = session.query(cls)
-    column_names = [column.key for column in cls.__table__.columns]
-    temp_columns = column_names[-10:]
-    for city in cities:
-        day_temperatures = [json.loads(city.__getattribute__(day)) for day in temp_columns]
-        file_path = create_and_save_city_temp_plot(city.country, city.city, day_temperatures, output_path)
+    for city, days_temp in query_cities_temperatures(session, cls, temperature_cls):
+        file_path = create_and_save_city_temp_plot(city.country, city.city, days_temp, output_path, web_root)
         city.temperature_graphic = file_path
     session.commit()
 
 
-def analyse_statistics(session, cls):
+def analyse_statistics(session, cls, temperature_cls):
     """
     Returns common temperature statistics
     :param session: SQLAlchemy Session object
-    :param cls: table class model
+    :param cls: cities class model
+    :param temperature_cls: daily temperatures class model
     :return: json data
     """
-    cities_statistics = get_cities_statistics(session, cls)
+    cities_statistics = get_cities_statistics(session, cls, temperature_cls)
 
     countries = [data[0] for data in cities_statistics]
     cities = [data[1] for data in cities_statistics]
@@ -306,53 +730,53 @@ def analyse_statistics(session, cls):
     return json_results
 
 
-def write_temperature_analytics(session, cls, output_path):
+def write_temperature_analytics(session, cls, temperature_cls, output_path):
     """
     Writes common cities analytics to json file in output folder
     :param session: SQLAlchemy Session object
-    :param cls: table class model
+    :param cls: cities class model
+    :param temperature_cls: daily temperatures class model
     :param output_path: path to base output_folder
     :return: None
     """
     file_path = path_to_(output_path, 'temperature_analytics.json')
     pathlib.Path(path_to_(output_path)).mkdir(exist_ok=True)
-    data_to_write = analyse_statistics(session, cls)
+    data_to_write = analyse_statistics(session, cls, temperature_cls)
     with open(file_path, 'w') as output_file:
         json.dump(data_to_write, output_file, indent=4)
 
 
-def yield_filtered_from_db(session, cls, country, city):
+def yield_filtered_from_db(session, cls, major_city_id):
     """
-    Yields record for given city and country from database table
+    Yields records of hotels linked to given major city from database table
     :param session: SQLAlchemy Session object
     :param cls: table class model
-    :param country: country Alpha-2 code
-    :param city: city name
+    :param major_city_id: id of major city
     :return: Generator with country, city and list of data to fill in csv file
     """
-    hotels = session.query(cls).filter_by(country=country, city=city)
+    hotels = session.query(cls).filter_by(major_city_id=major_city_id)
     for hotel in hotels:
         yield hotel.country, hotel.city, [hotel.name, hotel.address, hotel.latitude, hotel.longitude]
 
 
-def write_to_city_csv(base_path, session, cls, country, city, _cities=[], _counter=[0], file_num=[0]):
+def write_to_city_csv(base_path, session, cls, major_city, _cities=[], _counter=[0], file_num=[0]):
     """
     Writes city hotels data to csv files, maximum 100 records per file
     :param base_path: path to base output folder
     :param session: SQLAlchemy Session object
     :param cls: table class model
-    :param country: country Alpha-2 code
-    :param city: city name
+    :param major_city: object of major cities model class
     :param _cities: service list for correct records per file counting
     :param _counter: service list for counting till 100 records
     :param file_num: sequence number of file
     :return: None
     """
+    country, city = major_city.country, major_city.city
     if city not in _cities:
         _counter[0] = 0
         file_num[0] += 1
         _cities.append(city)
-    db_generator = yield_filtered_from_db(session, cls, country, city)
+    db_generator = yield_filtered_from_db(session, cls, major_city.id)
     for record in db_generator:
         city_folder_path = create_city_folder(base_path, country, city)
         if _counter[0] == 100:
@@ -368,14 +792,14 @@ def write_to_city_csv(base_path, session, cls, country, city, _cities=[], _count
         _counter[0] += 1
 
 
-def write_from_db_to_files(base_path, session, cls, major_cities):
+def write_from_db_to_files(base_path, session, cls, city_cls):
     """
     Writes records from database table to csv files, maximum 100 records per file
     :param base_path: path to base output directory
     :param session: SQLAlchemy Session object
     :param cls: table class model
-    :param major_cities: country-city pairs dict
+    :param city_cls: major cities class model
     :return: None
     """
-    for country, city in major_cities.items():
-        write_to_city_csv(base_path, session, cls=cls, country=country, city=city)
+    for major_city in session.query(city_cls).order_by(city_cls.id).all():
+        write_to_city_csv(base_path, session, cls=cls, major_city=major_city)
@@ -1,21 +1,420 @@
-from geopy.extra.rate_limiter import RateLimiter
+import asyncio
+import math
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from urllib.parse import urlsplit
+
+import aiohttp
+import requests
+from geopy.adapters import RequestsAdapter
+from geopy.exc import (GeocoderRateLimited, GeocoderServiceError,
+                       GeocoderTimedOut, GeocoderUnavailable)
 from geopy.geocoders import OpenMapQuest
 
 import secret
 
+from .cache_tools import PersistentCache
+from .data_tools import chunked
+from .net_tools import AdaptiveConcurrency, TokenBucket
+
 GEOCODE_API_KEY = secret.geocode_api_key
+GEOCODE_RATE = 20
+GEOCODE_POOL_SIZE = 10
+GEOCODE_THREADS = 4
+GEOCODE_BASE_URL = os.environ.get('GEOCODE_BASE_URL')
+GEOCODE_BATCH_URL = f"{GEOCODE_BASE_URL or 'https://www.mapquestapi.com'}/geocoding/v1/batch"
+GEOCODE_BATCH_SIZE = 100
+GEOCODE_REVERSE_URL = f"{GEOCODE_BASE_URL or 'https://open.mapquestapi.com'}/nominatim/v1/reverse"
+GEOCODE_TIMEOUT = 5
+GEOCODE_CONCURRENCY = 100
+GEOCODE_CACHE_PRECISION = 4
+GEOCODE_CACHE_TTL = 90 * 24 * 60 * 60
+GEOCODE_CACHE_SIZE = 1000000
+METERS_PER_DEGREE = 111320
+GEOCODE_ERRORS = (GeocoderServiceError, requests.RequestException, aiohttp.ClientError, asyncio.TimeoutError, KeyError)
+
+geocode_limiter = TokenBucket(GEOCODE_RATE)
+geocode_concurrency = AdaptiveConcurrency(initial=GEOCODE_THREADS, maximum=GEOCODE_THREADS)
+_geocoders = {}
+_geocoders_lock = threading.Lock()
+_batch_session = requests.Session()
+_batch_session.mount('https://', requests.adapters.HTTPAdapter(pool_maxsize=GEOCODE_POOL_SIZE))
+_batch_session.mount('http://', requests.adapters.HTTPAdapter(pool_maxsize=GEOCODE_POOL_SIZE))
+
+
+def configure_geocode_base_url(base_url=None):
+    """
+    Points all reverse geocoding requests to another server, e.g. local stand-in (see benchmarks/stand_in_server.py).
+    Default base url may also be set with GEOCODE_BASE_URL environment variable
+    :param base_url: scheme and host of MapQuest compatible API, e.g. 'http://127.0.0.1:8000',
+        None for MapQuest servers
+    :return: None
+    """
+    global GEOCODE_BASE_URL, GEOCODE_BATCH_URL, GEOCODE_REVERSE_URL
+    GEOCODE_BASE_URL = base_url.rstrip('/') if base_url else None
+    GEOCODE_BATCH_URL = f"{GEOCODE_BASE_URL or 'https://www.mapquestapi.com'}/geocoding/v1/batch"
+    GEOCODE_REVERSE_URL = f"{GEOCODE_BASE_URL or 'https://open.mapquestapi.com'}/nominatim/v1/reverse"
+    with _geocoders_lock:
+        _geocoders.clear()
+
+
+def configure_geocode_concurrency(initial=GEOCODE_THREADS, maximum=None):
+    """
+    Replaces geocoding concurrency controller: number of requests in flight from thread pool starts from initial
+    and adapts to service latency and throttling within maximum
+    :param initial: initial number of requests in flight
+    :param maximum: maximal number of requests in flight, equal to initial if omitted
+    :return: controller
+    :rtype: AdaptiveConcurrency
+    """
+    global geocode_concurrency
+    geocode_concurrency = AdaptiveConcurrency(initial=initial, maximum=maximum or initial)
+    return geocode_concurrency
 
 
-def get_address(latitude, longitude, api_key=GEOCODE_API_KEY):
+def get_geocode_concurrency():
     """
-    Reverse geocoding function that gets address for given coordinates, uses OpenMapQuest service
+    Returns geocoding concurrency controller of the latest configuration, e.g. to log chosen concurrency
+    :rtype: AdaptiveConcurrency
+    """
+    return geocode_concurrency
+
+
+def get_geocoder(api_key=GEOCODE_API_KEY):
+    """
+    Returns process-wide OpenMapQuest client for given API key.
+    Client keeps one pooled HTTP session, so connections are reused by all calls and threads
+    :param api_key: OpenMapQuest API key
+    :return: geocoder
+    :rtype: OpenMapQuest
+    """
+    with _geocoders_lock:
+        if api_key not in _geocoders:
+            adapter_factory = partial(RequestsAdapter, pool_maxsize=GEOCODE_POOL_SIZE)
+            reverse_url = urlsplit(GEOCODE_REVERSE_URL)
+            _geocoders[api_key] = OpenMapQuest(
+                api_key=api_key, domain=reverse_url.netloc, scheme=reverse_url.scheme, adapter_factory=adapter_factory)
+        return _geocoders[api_key]
+
+
+def get_address(latitude, longitude, api_key=GEOCODE_API_KEY, max_retries=3):
+    """
+    Reverse geocoding function that gets address for given coordinates, uses OpenMapQuest service.
+    Requests from all threads share one rate limiter, so provider quota is not exceeded,
+    and one concurrency controller
     :param latitude: location latitude
     :param longitude: location longitude
     :param api_key: OpenMapQuest API key
-    :return: physical address
+    :param max_retries: number of retries when service is throttling, unavailable or timed out
+    :return: physical address, None if nothing found
     :rtype: str
     """
-    geolocator = OpenMapQuest(api_key=api_key)
-    geocode = RateLimiter(geolocator.reverse, min_delay_seconds=1/20, max_retries=3)
-    location = geocode(f'{latitude}, {longitude}', timeout=1)
-    return location.address
+    geolocator = get_geocoder(api_key)
+    for attempt in range(max_retries + 1):
+        geocode_limiter.acquire()
+        controller = geocode_concurrency
+        started = controller.acquire()
+        try:
+            location = geolocator.reverse(f'{latitude}, {longitude}', timeout=1)
+        except (GeocoderRateLimited, GeocoderTimedOut, GeocoderUnavailable) as error:
+            controller.release(started, overloaded=True)
+            if attempt == max_retries:
+                raise
+            retry_after = getattr(error, 'retry_after', None) or 2 ** attempt
+            if isinstance(error, GeocoderRateLimited):
+                geocode_limiter.pause(retry_after)
+            else:
+                time.sleep(retry_after)
+            continue
+        except Exception:
+            controller.release(started)
+            raise
+        controller.release(started)
+        return location.address if location else None
+
+
+def format_batch_address(result):
+    """
+    Makes address string from one location result of MapQuest batch geocoding response
+    :param result: result for one requested location
+    :type result: dict
+    :return: physical address, None if location wasn't resolved
+    :rtype: str
+    """
+    locations = result.get('locations') or []
+    if not locations:
+        return None
+    fields = ('street', 'adminArea6', 'adminArea5', 'adminArea4', 'adminArea3', 'postalCode', 'adminArea1')
+    address = ', '.join(locations[0][field] for field in fields if locations[0].get(field))
+    return address or None
+
+
+def batch_params(locations, api_key=GEOCODE_API_KEY):
+    """
+    Query parameters of MapQuest batch geocoding request
+    :param locations: latitude, longitude pairs
+    :param api_key: MapQuest API key
+    :rtype: List[tuple]
+    """
+    params = [('key', api_key), ('maxResults', 1), ('thumbMaps', 'false')]
+    params.extend(('location', f'{latitude},{longitude}') for latitude, longitude in locations)
+    return params
+
+
+def parse_batch_response(data, count, url=None):
+    """
+    Extracts addresses from MapQuest batch geocoding response
+    :param data: decoded JSON response
+    :param count: number of requested locations
+    :param url: requested url, for error message
+    :return: physical addresses in order of requested locations, None for locations that weren't resolved
+    :rtype: List[str]
+    """
+    try:
+        addresses = [format_batch_address(result) for result in data['results']]
+    except (KeyError, TypeError):
+        raise KeyError(f'Unexpected response from {url or GEOCODE_BATCH_URL}. Check url or try later')
+    return addresses[:count] + [None] * (count - len(addresses))
+
+
+def get_addresses_batch(locations, api_key=GEOCODE_API_KEY, url=None, max_retries=3):
+    """
+    Reverse geocoding of several locations in one request to MapQuest batch endpoint (up to 100 locations).
+    Whole request is retried when service is throttling or unavailable, locations that service couldn't resolve
+    get None and don't affect other locations
+    :param locations: latitude, longitude pairs
+    :type locations: List[tuple[float]]
+    :param api_key: MapQuest API key
+    :param url: batch geocoding endpoint, GEOCODE_BATCH_URL if omitted
+    :param max_retries: number of retries when service is throttling, unavailable or timed out
+    :return: physical addresses in order of locations
+    :rtype: List[str]
+    """
+    url = url or GEOCODE_BATCH_URL
+    params = batch_params(locations, api_key)
+    for attempt in range(max_retries + 1):
+        geocode_limiter.acquire()
+        controller = geocode_concurrency
+        started = controller.acquire()
+        try:
+            resp = _batch_session.get(url, params=params, timeout=GEOCODE_TIMEOUT)
+        except (requests.ConnectionError, requests.Timeout):
+            controller.release(started, overloaded=True)
+            if attempt == max_retries:
+                raise
+            time.sleep(2 ** attempt)
+            continue
+        controller.release(started, overloaded=resp.status_code == 429 or resp.status_code >= 500)
+        if resp.status_code == 429 or resp.status_code >= 500:
+            if attempt == max_retries:
+                resp.raise_for_status()
+            retry_after = float(resp.headers.get('Retry-After', 2 ** attempt))
+            if resp.status_code == 429:
+                geocode_limiter.pause(retry_after)
+            else:
+                time.sleep(retry_after)
+            continue
+        resp.raise_for_status()
+        return parse_batch_response(resp.json(), len(locations), url)
+
+
+async def fetch_json_async(session, url, params, max_retries=3):
+    """
+    Sends GET request with shared rate limiter, retries it when service is throttling, unavailable or timed out
+    :param session: aiohttp client session
+    :param url: endpoint url
+    :param params: query parameters
+    :param max_retries: number of retries
+    :return: decoded JSON response
+    """
+    for attempt in range(max_retries + 1):
+        delay = geocode_limiter.reserve()
+        if delay:
+            await asyncio.sleep(delay)
+        try:
+            async with session.get(url, params=params) as resp:
+                if resp.status == 429 or resp.status >= 500:
+                    if attempt == max_retries:
+                        resp.raise_for_status()
+                    retry_after = float(resp.headers.get('Retry-After', 2 ** attempt))
+                    if resp.status == 429:
+                        geocode_limiter.pause(retry_after)
+                    else:
+                        await asyncio.sleep(retry_after)
+                    continue
+                resp.raise_for_status()
+                return await resp.json(content_type=None)
+        except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+            if attempt == max_retries:
+                raise
+            await asyncio.sleep(2 ** attempt)
+
+
+async def get_addresses_async(batches, concurrency=GEOCODE_CONCURRENCY, api_key=GEOCODE_API_KEY, use_batch=False):
+    """
+    Reverse geocoding of location batches in one event loop thread with pooled HTTP connections.
+    Number of requests in flight is bounded by semaphore, request rate - by shared rate limiter.
+    :param batches: lists of latitude, longitude pairs
+    :param concurrency: maximal number of requests in flight
+    :param api_key: MapQuest API key
+    :param use_batch: send batches to batch endpoint, otherwise each batch must contain one location
+    :return: lists of physical addresses in order of batches and locations,
+        batches that failed after retries get None for each location
+    :rtype: List[list[str]]
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    timeout = aiohttp.ClientTimeout(total=GEOCODE_TIMEOUT)
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+        async def resolve(batch):
+            async with semaphore:
+                if use_batch:
+                    data = await fetch_json_async(session, GEOCODE_BATCH_URL, batch_params(batch, api_key))
+                    return parse_batch_response(data, len(batch))
+                latitude, longitude = batch[0]
+                params = {'key': api_key, 'format': 'json', 'lat': latitude, 'lon': longitude, 'addressdetails': 0}
+                data = await fetch_json_async(session, GEOCODE_REVERSE_URL, params)
+                return [data.get('display_name') if isinstance(data, dict) else None]
+
+        results = await asyncio.gather(*(resolve(batch) for batch in batches), return_exceptions=True)
+    for batch, result in zip(batches, results):
+        if isinstance(result, BaseException) and not isinstance(result, GEOCODE_ERRORS):
+            raise result
+    return [[None] * len(batch) if isinstance(result, BaseException) else result
+            for batch, result in zip(batches, results)]
+
+
+def geocode_locations(locations, threads=4, cache=None, precision=GEOCODE_CACHE_PRECISION, batch_size=1,
+                      api_key=GEOCODE_API_KEY, use_async=False, concurrency=GEOCODE_CONCURRENCY):
+    """
+    Gets addresses for list of locations in parallel threads or with asyncio engine.
+    Addresses found in cache are not requested, others are requested one location per request
+    or in batches of given size. Request that failed after retries leaves its locations unresolved,
+    addresses from other requests are returned and cached anyway
+    :param locations: latitude, longitude pairs
+    :type locations: List[tuple[float]]
+    :param threads: number of threads for parallel requests, number of requests in flight is adjusted
+        by geocode_concurrency controller
+    :param cache: reverse geocoding cache
+    :type cache: PersistentCache
+    :param precision: number of decimal places coordinates are rounded to in cache key
+    :param batch_size: number of locations in one request, batch endpoint is used if more than 1
+    :param api_key: MapQuest API key
+    :param use_async: use asyncio engine instead of thread pool
+    :param concurrency: maximal number of requests in flight for asyncio engine
+    :return: physical addresses in order of locations, None for locations that weren't resolved
+    :rtype: List[str]
+    """
+    addresses = [None] * len(locations)
+    pending = []
+    for i, (latitude, longitude) in enumerate(locations):
+        if cache is not None:
+            addresses[i] = cache.get(coordinates_key(latitude, longitude, precision))
+        if addresses[i] is None:
+            pending.append(i)
+    batches = list(chunked(pending, max(batch_size, 1)))
+
+    def request_addresses(batch):
+        try:
+            if batch_size > 1:
+                return get_addresses_batch([locations[i] for i in batch], api_key=api_key)
+            return [get_address(*locations[batch[0]], api_key=api_key)]
+        except GEOCODE_ERRORS:
+            return [None] * len(batch)
+
+    if use_async:
+        location_batches = [[locations[i] for i in batch] for batch in batches]
+        results = asyncio.run(get_addresses_async(
+            location_batches, concurrency=concurrency, api_key=api_key, use_batch=batch_size > 1))
+    else:
+        with ThreadPoolExecutor(max_workers=threads) as pool:
+            results = list(pool.map(request_addresses, batches))
+    for batch, batch_addresses in zip(batches, results):
+        for i, address in zip(batch, batch_addresses):
+            addresses[i] = address
+            if cache is not None and address is not None:
+                cache.set(coordinates_key(*locations[i], precision), address)
+    return addresses
+
+
+def open_geocode_cache(path, ttl=GEOCODE_CACHE_TTL, max_entries=GEOCODE_CACHE_SIZE):
+    """
+    Opens persistent reverse geocoding cache
+    :param path: path to cache file
+    :param ttl: address time to live in seconds
+    :param max_entries: maximal number of cached addresses
+    :rtype: PersistentCache
+    """
+    return PersistentCache(path, ttl=ttl, max_entries=max_entries)
+
+
+def coordinates_key(latitude, longitude, precision=GEOCODE_CACHE_PRECISION):
+    """
+    Cache key made of coordinates rounded to given number of decimal places
+    (4 places are about 11 meters, so nearby locations share one key)
+    :param latitude: location latitude
+    :param longitude: location longitude
+    :param precision: number of decimal places
+    :rtype: str
+    """
+    latitude, longitude = round(latitude, precision) + 0.0, round(longitude, precision) + 0.0
+    return f'{latitude:.{precision}f},{longitude:.{precision}f}'
+
+
+def get_address_cached(latitude, longitude, cache, precision=GEOCODE_CACHE_PRECISION, api_key=GEOCODE_API_KEY):
+    """
+    Gets address for given coordinates from cache, requests geocoding service only on cache miss
+    :param latitude: location latitude
+    :param longitude: location longitude
+    :param cache: reverse geocoding cache
+    :type cache: PersistentCache
+    :param precision: number of decimal places coordinates are rounded to in cache key
+    :param api_key: OpenMapQuest API key
+    :return: physical address, None if nothing found
+    :rtype: str
+    """
+    key = coordinates_key(latitude, longitude, precision)
+    address = cache.get(key)
+    if address is None:
+        address = get_address(latitude, longitude, api_key=api_key)
+        if address is not None:
+            cache.set(key, address)
+    return address
+
+
+def grid_cell(latitude, longitude, distance):
+    """
+    Cell of fixed geographic grid which cells diagonal equals given distance, so any two locations
+    inside one cell are not farther from each other than distance. Longitude step grows with latitude
+    to keep cells square on the ground
+    :param latitude: location latitude
+    :param longitude: location longitude
+    :param distance: cell diagonal in meters
+    :return: cell row and column
+    :rtype: tuple[int]
+    """
+    step = distance / math.sqrt(2) / METERS_PER_DEGREE
+    row = math.floor(latitude / step)
+    row_latitude = min(abs((row + 0.5) * step), 89.9)
+    column = math.floor(longitude / (step / math.cos(math.radians(row_latitude))))
+    return row, column
+
+
+def cluster_locations(coordinates_list, distance=0):
+    """
+    Groups locations with spatial grid index, so locations in one group can share one geocoding lookup.
+    With zero distance only locations with equal coordinates are grouped
+    :param coordinates_list: latitude, longitude pairs
+    :param distance: maximal distance in meters between locations in one group
+    :return: groups, each is a list of indexes in coordinates_list; number of saved lookups is
+        number of locations minus number of groups
+    :rtype: List[list[int]]
+    """
+    cells = {}
+    for i, (latitude, longitude) in enumerate(coordinates_list):
+        cell = grid_cell(latitude, longitude, distance) if distance else (latitude, longitude)
+        cells.setdefault(cell, []).append(i)
+    return list(cells.values())
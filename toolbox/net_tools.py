@@ -0,0 +1,373 @@
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import requests
+
+RETRY_STATUSES = frozenset((429, 500, 502, 503, 504))
+SCHEDULER_STATS = ('queued', 'in_flight', 'done', 'failed', 'max_queued', 'max_in_flight')
+MIN_LATENCY_DRIFT = 1.01
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket rate limiter shared by all workers calling one service.
+    Tokens are added continuously at given rate up to capacity, each request takes one token.
+    Tokens may be reserved in advance, so waiting callers are served in order at exactly given rate
+    """
+
+    def __init__(self, rate, capacity=1):
+        """
+        :param rate: number of requests per second
+        :param capacity: maximal number of requests that may be sent at once after idle period
+        """
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self):
+        """
+        Takes one token
+        :return: seconds to wait before request may be sent
+        :rtype: float
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= 1
+            if self._tokens >= 0:
+                return 0.0
+            return -self._tokens / self.rate
+
+    def acquire(self):
+        """
+        Blocks current thread until request may be sent
+        :return: None
+        """
+        delay = self.reserve()
+        if delay:
+            time.sleep(delay)
+
+    def pause(self, seconds):
+        """
+        Postpones all following requests, e.g. when service responded with 429 status
+        :param seconds: pause duration
+        :return: None
+        """
+        with self._lock:
+            self._tokens = min(self._tokens, 0) - seconds * self.rate
+
+
+class SingleFlight:
+    """
+    Collapses concurrent identical calls into one: first caller with given key runs function,
+    callers with the same key that come while it is running wait for its result instead of repeating the call.
+    Results are not kept after call is complete, combine with cache for that
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, function, *args, **kwargs):
+        """
+        Runs function or waits for result of the same call made by another thread
+        :param key: hashable call identifier
+        :param function: function to call
+        :return: function result
+        """
+        with self._lock:
+            future = self._calls.get(key)
+            is_leader = future is None
+            if is_leader:
+                future = self._calls[key] = Future()
+        if not is_leader:
+            return future.result()
+        try:
+            result = function(*args, **kwargs)
+        except BaseException as error:
+            future.set_exception(error)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                del self._calls[key]
+
+
+class AdaptiveConcurrency:
+    """
+    Thread-safe AIMD concurrency limiter shared by all workers calling one service.
+    Works as semaphore with changing number of slots: limit grows by about one request per round trip
+    while responses are fast and successful, and is halved when service is throttling, failing or timing out.
+    Every change of limit is kept in history, so chosen concurrency can be logged
+    """
+
+    def __init__(self, initial=4, minimum=1, maximum=32, increase=1.0, decrease=0.5, latency_tolerance=2.0):
+        """
+        :param initial: initial number of requests in flight
+        :param minimum: minimal number of requests in flight
+        :param maximum: maximal number of requests in flight, number of workers should be the same
+        :param increase: number of slots added per round trip of successful requests
+        :param decrease: multiplier applied to limit when service is overloaded
+        :param latency_tolerance: limit stops growing when latency is that many times over minimal observed latency
+        """
+        self.minimum = minimum
+        self.maximum = max(maximum, minimum)
+        self.increase = increase
+        self.decrease = decrease
+        self.latency_tolerance = latency_tolerance
+        self.limit = float(min(max(initial, minimum), self.maximum))
+        self.history = [(0.0, self.concurrency)]
+        self._in_flight = 0
+        self._min_latency = None
+        self._last_decrease = 0.0
+        self._started = time.monotonic()
+        self._condition = threading.Condition()
+
+    @property
+    def concurrency(self):
+        """
+        Current number of requests allowed in flight
+        :rtype: int
+        """
+        return int(self.limit)
+
+    def acquire(self):
+        """
+        Blocks current thread until there is a free slot
+        :return: request start time to pass to release
+        :rtype: float
+        """
+        with self._condition:
+            while self._in_flight >= self.concurrency:
+                self._condition.wait()
+            self._in_flight += 1
+        return time.monotonic()
+
+    def release(self, started, overloaded=False):
+        """
+        Frees slot and adjusts limit by request outcome. Only one decrease is made for requests
+        started before previous decrease, so burst of failures of the same round trip halves limit once
+        :param started: request start time returned by acquire
+        :param overloaded: service responded with 429 or 5xx status, or request timed out
+        :return: None
+        """
+        now = time.monotonic()
+        latency = now - started
+        with self._condition:
+            self._in_flight -= 1
+            previous = self.concurrency
+            if overloaded:
+                if started >= self._last_decrease:
+                    self.limit = max(self.minimum, self.limit * self.decrease)
+                    self._last_decrease = now
+            else:
+                if self._min_latency is None:
+                    self._min_latency = latency
+                self._min_latency = min(latency, self._min_latency * MIN_LATENCY_DRIFT)
+                if latency <= self._min_latency * self.latency_tolerance:
+                    self.limit = min(self.maximum, self.limit + self.increase / self.limit)
+            if self.concurrency != previous:
+                self.history.append((now - self._started, self.concurrency))
+            self._condition.notify_all()
+
+    def summary(self):
+        """
+        Initial, current, minimal and maximal chosen concurrency and number of changes
+        :rtype: dict[str,int]
+        """
+        values = [concurrency for _, concurrency in self.history]
+        return {'initial': values[0], 'final': values[-1], 'min': min(values), 'max': max(values),
+                'changes': len(values) - 1}
+
+
+class HttpClient:
+    """
+    Thread-safe HTTP client shared by all workers calling one service.
+    Connections are kept alive in a pool, failed requests (connection errors, timeouts, 429 and 5xx statuses)
+    are retried with exponential backoff and full jitter, so retrying workers don't hit service at the same moment.
+    With concurrency controller number of requests in flight adapts to service latency and throttling
+    """
+
+    def __init__(self, pool_size=10, timeout=(3.05, 10), max_retries=3, backoff=0.5, max_backoff=30, controller=None):
+        """
+        :param pool_size: number of kept alive connections per host, should be equal to number of workers
+        :param timeout: seconds to wait for connection and for response, single value sets both
+        :type timeout: Union[float,tuple[float,float]]
+        :param max_retries: number of retries after first failed attempt
+        :param backoff: base delay before first retry in seconds, doubled for each next retry
+        :param max_backoff: maximal delay before retry in seconds
+        :param controller: concurrency limiter every request attempt takes slot from
+        :type controller: Optional[AdaptiveConcurrency]
+        """
+        self.controller = controller
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.session = requests.Session()
+        self.resize(pool_size)
+
+    def resize(self, pool_size):
+        """
+        Replaces connection pool with pool of given size, e.g. when number of workers is known
+        :param pool_size: number of kept alive connections per host
+        :return: None
+        """
+        self.pool_size = pool_size
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def retry_delay(self, attempt, response=None):
+        """
+        Returns delay before retry: value of Retry-After header if service sent it,
+        random value between zero and exponential backoff otherwise
+        :param attempt: number of failed attempt starting from 0
+        :param response: failed response if any
+        :rtype: float
+        """
+        retry_after = response.headers.get('Retry-After') if response is not None else None
+        if retry_after and retry_after.isdigit():
+            return min(float(retry_after), self.max_backoff)
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+    def get(self, url, params=None):
+        """
+        Sends GET request through pooled connection, retries failed requests
+        :param url: request url
+        :param params: query parameters
+        :return: response, the last one if all retries failed with retryable status
+        :rtype: requests.Response
+        """
+        for attempt in range(self.max_retries + 1):
+            controller = self.controller
+            started = controller.acquire() if controller is not None else None
+            try:
+                response = self.session.get(url, params=params, timeout=self.timeout)
+            except (requests.ConnectionError, requests.Timeout):
+                if controller is not None:
+                    controller.release(started, overloaded=True)
+                if attempt == self.max_retries:
+                    raise
+                time.sleep(self.retry_delay(attempt))
+                continue
+            if controller is not None:
+                controller.release(started, overloaded=response.status_code in RETRY_STATUSES)
+            if response.status_code not in RETRY_STATUSES or attempt == self.max_retries:
+                return response
+            time.sleep(self.retry_delay(attempt, response))
+
+    def get_json(self, url, params=None):
+        """
+        Sends GET request and decodes JSON response
+        :param url: request url
+        :param params: query parameters
+        :return: decoded JSON response
+        """
+        return self.get(url, params=params).json()
+
+    def close(self):
+        """
+        Closes all pooled connections
+        :return: None
+        """
+        self.session.close()
+
+
+class RequestScheduler:
+    """
+    One bounded thread pool for all requests to a service. Requests are queued per endpoint
+    and dispatched to pool only while endpoint has free slots, so every endpoint has its own
+    concurrency and rate limit, and pool threads never wait for slots of busy endpoint
+    """
+
+    def __init__(self, limits):
+        """
+        :param limits: maximal number of requests in flight and requests per second for every endpoint,
+            rate may be None for no rate limit
+        :type limits: dict[str,tuple[int,Optional[float]]]
+        """
+        self.limits = dict(limits)
+        self._buckets = {endpoint: TokenBucket(rate) for endpoint, (_, rate) in self.limits.items() if rate}
+        self._pool = ThreadPoolExecutor(max_workers=sum(concurrency for concurrency, _ in self.limits.values()))
+        self._lock = threading.Lock()
+        self._queues = {endpoint: deque() for endpoint in self.limits}
+        self._stats = {endpoint: dict.fromkeys(SCHEDULER_STATS, 0) for endpoint in self.limits}
+
+    def submit(self, endpoint, function, *args, **kwargs):
+        """
+        Queues request task to given endpoint
+        :param endpoint: endpoint name, one of limits keys
+        :param function: function sending request
+        :return: future with function result
+        :rtype: Future
+        """
+        future = Future()
+        with self._lock:
+            self._queues[endpoint].append((future, function, args, kwargs))
+            stats = self._stats[endpoint]
+            stats['queued'] += 1
+            stats['max_queued'] = max(stats['max_queued'], stats['queued'])
+            self._dispatch(endpoint)
+        return future
+
+    def _dispatch(self, endpoint):
+        """
+        Moves queued tasks of endpoint to pool while endpoint has free slots, must be called under lock
+        :param endpoint: endpoint name
+        :return: None
+        """
+        queue, stats = self._queues[endpoint], self._stats[endpoint]
+        while queue and stats['in_flight'] < self.limits[endpoint][0]:
+            task = queue.popleft()
+            stats['queued'] -= 1
+            stats['in_flight'] += 1
+            stats['max_in_flight'] = max(stats['max_in_flight'], stats['in_flight'])
+            self._pool.submit(self._run, endpoint, *task)
+
+    def _run(self, endpoint, future, function, args, kwargs):
+        """
+        Runs request task in pool thread within endpoint rate limit
+        :return: None
+        """
+        failed = False
+        try:
+            if future.set_running_or_notify_cancel():
+                if endpoint in self._buckets:
+                    self._buckets[endpoint].acquire()
+                try:
+                    future.set_result(function(*args, **kwargs))
+                except BaseException as error:
+                    failed = True
+                    future.set_exception(error)
+        finally:
+            with self._lock:
+                stats = self._stats[endpoint]
+                stats['in_flight'] -= 1
+                stats['failed' if failed else 'done'] += 1
+                self._dispatch(endpoint)
+
+    def stats(self):
+        """
+        Returns current queue depth, number of requests in flight, completed and failed requests
+        and maximal queue depth and requests in flight reached so far for every endpoint
+        :rtype: dict[str,dict[str,int]]
+        """
+        with self._lock:
+            return {endpoint: dict(stats) for endpoint, stats in self._stats.items()}
+
+    def shutdown(self, wait=True):
+        """
+        Stops pool threads after all dispatched tasks are complete
+        :param wait: whether to wait for dispatched tasks
+        :return: None
+        """
+        self._pool.shutdown(wait=wait)
@@ -1,8 +1,28 @@
+import csv
+import datetime
+import hashlib
+import io
 import os
 import pathlib
 import shutil
+from collections import namedtuple
+from contextlib import contextmanager
 from zipfile import BadZipFile, ZipFile
 
+CsvSource = namedtuple('CsvSource', ['path', 'member', 'size', 'mtime'])
+CsvSource.__doc__ = """
+Csv file with hotels information: plain file on disk (member is None) or member of zip archive located at path.
+Size is uncompressed size in bytes, mtime is modification time as unix timestamp
+"""
+
+CsvShard = namedtuple('CsvShard', ['source', 'start', 'end'])
+CsvShard.__doc__ = """
+Byte range of csv source: lines starting at offsets from start (inclusive) to end (exclusive) belong to shard.
+Zip members can't be read from the middle, so they always form one shard with end set to None
+"""
+
+SHARD_SIZE = 16 * 1024 * 1024
+
 
 def path_to_(*path_parts):
     """
@@ -46,6 +66,131 @@ def unzip_next_to(file_path):
     return new_dir
 
 
+def find_csv_sources(source_path):
+    """
+    Lists csv files in given zip file or directory without extracting them.
+    Handled situations:
+    - path doesn't exist: return message
+    - path is a directory: csv files inside it are sources, if there are none - return message
+    - path is a file: csv members of zip archive are sources, if it is not a zip or has no csv inside - return message
+    :param source_path: path to zip file or directory with source data
+    :return: csv sources sorted by name or error message
+    :rtype: Union[List[CsvSource],str]
+    """
+    path = path_to_(source_path)
+    if not os.path.exists(path):
+        return f"Directory {path} doesn't exist. Please provide existing directory"
+    if os.path.isdir(path):
+        sources = []
+        for file_ in sorted(os.listdir(path)):
+            if file_.endswith('.csv'):
+                stat = os.stat(os.path.join(path, file_))
+                sources.append(CsvSource(os.path.join(path, file_), None, stat.st_size, stat.st_mtime))
+        if not sources:
+            return f'{source_path} is neither a zip file, nor a directory with csv files inside'
+        return sources
+    try:
+        with ZipFile(path, 'r') as zipObj:
+            sources = [
+                CsvSource(path, info.filename, info.file_size, datetime.datetime(*info.date_time).timestamp())
+                for info in sorted(zipObj.infolist(), key=lambda info: info.filename)
+                if not info.is_dir() and info.filename.endswith('.csv')
+            ]
+    except BadZipFile:
+        return f"Directory {path} is not a zip file. Please provide zip file or directory"
+    if not sources:
+        return f'{source_path} is a zip file without csv files inside'
+    return sources
+
+
+@contextmanager
+def open_csv_source(source):
+    """
+    Opens csv source as text stream. Zip members are decompressed on the fly, nothing is written to disk
+    :param source: csv source
+    :type source: CsvSource
+    :return: context manager with text stream
+    """
+    if source.member is None:
+        with open(source.path, encoding='utf-8', newline='') as stream:
+            yield stream
+    else:
+        with ZipFile(source.path, 'r') as zipObj, zipObj.open(source.member) as raw_stream:
+            yield io.TextIOWrapper(raw_stream, encoding='utf-8', newline='')
+
+
+def source_key(source):
+    """
+    Name that identifies csv source between runs: file name in directory or member name in zip archive
+    :param source: csv source
+    :type source: CsvSource
+    :rtype: str
+    """
+    return source.member if source.member is not None else os.path.basename(source.path)
+
+
+def hash_csv_source(source, block_size=1024 * 1024):
+    """
+    Calculates SHA-256 hash of csv source content, zip members are hashed decompressed
+    :param source: csv source
+    :type source: CsvSource
+    :param block_size: number of bytes read at once
+    :return: hex digest
+    :rtype: str
+    """
+    content_hash = hashlib.sha256()
+    if source.member is None:
+        with open(source.path, 'rb') as raw_stream:
+            while block := raw_stream.read(block_size):
+                content_hash.update(block)
+    else:
+        with ZipFile(source.path, 'r') as zipObj, zipObj.open(source.member) as raw_stream:
+            while block := raw_stream.read(block_size):
+                content_hash.update(block)
+    return content_hash.hexdigest()
+
+
+def split_csv_source(source, shard_size=SHARD_SIZE):
+    """
+    Splits csv source into byte-range shards that can be validated independently
+    :param source: csv source
+    :type source: CsvSource
+    :param shard_size: approximate shard size in bytes
+    :return: shards covering whole source
+    :rtype: List[CsvShard]
+    """
+    if source.member is not None or source.size <= shard_size:
+        return [CsvShard(source, 0, None)]
+    return [
+        CsvShard(source, start, min(start + shard_size, source.size))
+        for start in range(0, source.size, shard_size)
+    ]
+
+
+@contextmanager
+def open_csv_shard(shard):
+    """
+    Opens csv shard as text stream starting from first line that begins inside shard.
+    Line that crosses shard end is read completely, so shards of one file don't overlap and don't lose lines
+    Quoted fields containing line breaks must not cross shard boundaries, zip members are never split
+    :param shard: csv shard
+    :type shard: CsvShard
+    :return: context manager with text stream
+    """
+    if shard.end is None:
+        with open_csv_source(shard.source) as stream:
+            yield stream
+        return
+    with open(shard.source.path, 'rb') as raw_stream:
+        if shard.start:
+            raw_stream.seek(shard.start - 1)
+            raw_stream.readline()
+        data = raw_stream.read(max(shard.end - raw_stream.tell(), 0))
+        if data and not data.endswith(b'\n'):
+            data += raw_stream.readline()
+    yield io.StringIO(data.decode('utf-8'), newline='')
+
+
 def create_city_folder(output_path, country, city):
     """
     Creates folders if not existent according to following structure: {output_folder}/{country}/{city}
@@ -58,3 +203,18 @@ def create_city_folder(output_path, country, city):
     new_dir = path_to_(output_path, country, city)
     pathlib.Path(new_dir).mkdir(parents=True, exist_ok=True)
     return new_dir
+
+
+def write_concurrency_log(path, histories):
+    """
+    Saves chosen concurrency of outbound request stages over time to csv file
+    :param path: path to csv file
+    :param histories: stage name and list of (seconds from stage start, concurrency) changes
+    :type histories: dict[str,list[tuple[float,int]]]
+    :return: None
+    """
+    with open(path, 'w', newline='') as output_file:
+        writer = csv.writer(output_file)
+        writer.writerow(('stage', 'seconds', 'concurrency'))
+        for stage, history in histories.items():
+            writer.writerows((stage, round(seconds, 3), concurrency) for seconds, concurrency in history)
@@ -1,5 +1,17 @@
+import csv
 import datetime
+import os
 import time
+from functools import lru_cache
+
+import numpy as np
+
+try:
+    from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+except ImportError:
+    ZoneInfo = None
+
+TIMEZONES_PATH = os.path.join(os.path.dirname(__file__), 'data', 'timezones.csv')
 
 
 def local_timestamp_now(tz_shift):
@@ -60,3 +72,83 @@ def prev_n_day_end_local(tz_shift, day_number=-1):
     prev_day_end_ts = today_start_local_ts(curr_local_ts, tz_shift) - 1
     prev_n_day_end_ts = prev_day_end_ts + 60*60*24*(day_number + 1)
     return prev_n_day_end_ts
+
+
+@lru_cache(maxsize=None)
+def load_timezone_locations(path=TIMEZONES_PATH):
+    """
+    Loads bundled IANA timezones principal locations (from tz database zone.tab) as unit vectors.
+    File is read once per process
+    :param path: path to csv file with country, zone, latitude and longitude columns
+    :return: countries ISO codes, zone names and array of unit vectors, one row per zone
+    :rtype: tuple[numpy.ndarray,tuple[str],numpy.ndarray]
+    """
+    with open(path, newline='') as input_file:
+        reader = csv.reader(input_file)
+        _ = next(reader)
+        countries, zones, latitudes, longitudes = zip(*reader)
+    latitudes, longitudes = np.radians(np.array(latitudes, dtype=float)), np.radians(np.array(longitudes, dtype=float))
+    vectors = np.column_stack((
+        np.cos(latitudes) * np.cos(longitudes), np.cos(latitudes) * np.sin(longitudes), np.sin(latitudes)
+    ))
+    return np.array(countries), zones, vectors
+
+
+def find_timezone_name(latitude, longitude, country=None):
+    """
+    Finds IANA timezone of location offline: location belongs to the zone with the nearest principal location
+    on the sphere, i.e. zones boundaries are approximated with spherical Voronoi cells around principal locations.
+    If location country is known only zones of that country are considered, so locations near borders
+    are not attributed to neighbouring country zone. Inside countries with several zones boundaries
+    are still approximated
+    :param latitude: location latitude
+    :param longitude: location longitude
+    :param country: location country ISO code, e.g. 'ES', all zones are considered if omitted or unknown
+    :type country: Optional[str]
+    :return: timezone name, e.g. 'Europe/Moscow'
+    :rtype: str
+    """
+    countries, zones, vectors = load_timezone_locations()
+    indexes = np.flatnonzero(countries == country) if country else np.empty(0, dtype=int)
+    if not indexes.size:
+        indexes = np.arange(len(zones))
+    latitude, longitude = np.radians(latitude), np.radians(longitude)
+    point = np.array((np.cos(latitude) * np.cos(longitude), np.cos(latitude) * np.sin(longitude), np.sin(latitude)))
+    return zones[int(indexes[np.argmax(vectors[indexes] @ point)])]
+
+
+def get_zone_timezone(zone_name):
+    """
+    Current timezone shift of IANA timezone, DST included.
+    Returns None if tz database is not available in the system
+    :param zone_name: timezone name, e.g. 'Europe/Moscow'
+    :return: timezone (i.e. time shift in seconds from UTC time) or None
+    :rtype: Optional[int]
+    """
+    if ZoneInfo is None:
+        return None
+    try:
+        zone = ZoneInfo(zone_name)
+    except ZoneInfoNotFoundError:
+        return None
+    offset = datetime.datetime.now(datetime.timezone.utc).astimezone(zone).utcoffset()
+    return int(offset.total_seconds())
+
+
+def get_country_timezone(country):
+    """
+    Resolves current timezone shift of any location in the country without network requests.
+    Shift is known only if all zones of the country currently have the same shift, bundled principal locations
+    do not tell zones boundaries inside the country (e.g. Dallas is nearer to Indiana zone than to Chicago).
+    Returns None otherwise, if country is unknown or tz database is not available,
+    so caller can fall back to weather API
+    :param country: country ISO code, e.g. 'FR'
+    :type country: Optional[str]
+    :return: timezone (i.e. time shift in seconds from UTC time) or None
+    :rtype: Optional[int]
+    """
+    if not country:
+        return None
+    countries, zones, _ = load_timezone_locations()
+    timezones = {get_zone_timezone(zones[index]) for index in np.flatnonzero(countries == country)}
+    return timezones.pop() if len(timezones) == 1 else None
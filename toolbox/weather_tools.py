@@ -1,59 +1,182 @@
+import datetime
+import os
+import threading
 import time
-from concurrent.futures import ThreadPoolExecutor
-from functools import partial
-
-import requests
+from concurrent.futures import Future
 
 import secret
 
-from .time_tools import prev_n_day_end_local, today_end_local_ts
+from .cache_tools import PersistentCache, pack_json, unpack_json
+from .net_tools import (AdaptiveConcurrency, HttpClient, RequestScheduler,
+                        SingleFlight)
+from .time_tools import (get_country_timezone, local_timestamp_now,
+                         prev_n_day_end_local, today_end_local_ts,
+                         ts_to_datetime)
 
 WEATHER_API_KEY = secret.weather_api_key
 
-URL_CURRENT = "https://api.openweathermap.org/data/2.5/weather"
-URL_FORECAST = "https://api.openweathermap.org/data/2.5/forecast"
-URL_HISTORIC = "https://api.openweathermap.org/data/2.5/onecall/timemachine"
+WEATHER_BASE_URL = os.environ.get('WEATHER_BASE_URL', 'https://api.openweathermap.org')
+URL_CURRENT = f"{WEATHER_BASE_URL}/data/2.5/weather"
+URL_FORECAST = f"{WEATHER_BASE_URL}/data/2.5/forecast"
+URL_HISTORIC = f"{WEATHER_BASE_URL}/data/2.5/onecall/timemachine"
+TIMEZONE_PRECISION = 4
+WEATHER_CONCURRENCY = 4
+WEATHER_RATE = 50
+WEATHER_TIMEOUT = 10
+WEATHER_MAX_RETRIES = 3
+WEATHER_ENDPOINTS = ('historic', 'forecast')
+HISTORIC_DAYS = 5
+FORECAST_DAYS = 4
+WEATHER_CACHE_PRECISION = 2
+WEATHER_TODAY_TTL = 30 * 60
+WEATHER_FORECAST_TTL = 3 * 60 * 60
+WEATHER_CACHE_BYTES = 64 * 1024 * 1024
+
+weather_concurrency = AdaptiveConcurrency(initial=WEATHER_CONCURRENCY, maximum=WEATHER_CONCURRENCY)
+weather_client = HttpClient(
+    pool_size=WEATHER_CONCURRENCY, timeout=WEATHER_TIMEOUT, max_retries=WEATHER_MAX_RETRIES,
+    controller=weather_concurrency
+)
+weather_scheduler = RequestScheduler({endpoint: (WEATHER_CONCURRENCY, WEATHER_RATE) for endpoint in WEATHER_ENDPOINTS})
+request_flight = SingleFlight()
+_timezones = {}
+_timezones_lock = threading.Lock()
+
+
+def configure_weather_client(concurrency=WEATHER_CONCURRENCY, max_concurrency=None, rate=WEATHER_RATE,
+                             timeout=WEATHER_TIMEOUT, max_retries=WEATHER_MAX_RETRIES):
+    """
+    Adjusts shared weather HTTP client and request scheduler to number of workers and network conditions.
+    Number of requests in flight starts from concurrency and adapts to service latency and throttling
+    within max_concurrency. Previous scheduler finishes already queued requests
+    :param concurrency: initial number of requests in flight
+    :param max_concurrency: maximal number of requests in flight, equal to concurrency if omitted
+    :param rate: maximal number of requests per second to each endpoint
+    :param timeout: seconds to wait for connection and for response
+    :param max_retries: number of retries of failed request
+    :return: None
+    """
+    global weather_concurrency, weather_scheduler
+    max_concurrency = max_concurrency or concurrency
+    weather_concurrency = AdaptiveConcurrency(initial=concurrency, maximum=max_concurrency)
+    weather_client.controller = weather_concurrency
+    weather_client.timeout = timeout
+    weather_client.max_retries = max_retries
+    if max_concurrency != weather_client.pool_size:
+        weather_client.resize(max_concurrency)
+    previous_scheduler = weather_scheduler
+    weather_scheduler = RequestScheduler({endpoint: (max_concurrency, rate) for endpoint in WEATHER_ENDPOINTS})
+    previous_scheduler.shutdown(wait=False)
+
+
+def configure_weather_base_url(base_url):
+    """
+    Points all weather requests to another server, e.g. local stand-in (see benchmarks/stand_in_server.py).
+    Default base url may also be set with WEATHER_BASE_URL environment variable
+    :param base_url: scheme and host of OpenWeatherMap compatible API, e.g. 'http://127.0.0.1:8000'
+    :return: None
+    """
+    global WEATHER_BASE_URL, URL_CURRENT, URL_FORECAST, URL_HISTORIC
+    WEATHER_BASE_URL = base_url.rstrip('/')
+    URL_CURRENT = f"{WEATHER_BASE_URL}/data/2.5/weather"
+    URL_FORECAST = f"{WEATHER_BASE_URL}/data/2.5/forecast"
+    URL_HISTORIC = f"{WEATHER_BASE_URL}/data/2.5/onecall/timemachine"
+
+
+def get_weather_stats():
+    """
+    Returns queue depth, requests in flight, completed and failed requests for each weather endpoint
+    :rtype: dict[str,dict[str,int]]
+    """
+    return weather_scheduler.stats()
+
+
+def get_weather_concurrency():
+    """
+    Returns weather requests concurrency controller of the latest configuration, e.g. to log chosen concurrency
+    :rtype: AdaptiveConcurrency
+    """
+    return weather_concurrency
+
+
+def get_json(url, params):
+    """
+    Sends GET request through shared weather HTTP client and decodes JSON response.
+    Identical requests made by several threads at the same time are sent only once
+    :param url: base url for API call
+    :param params: query parameters
+    :type params: dict
+    :return: decoded JSON response
+    """
+    key = (url, tuple(sorted(params.items())))
+    return request_flight.do(key, weather_client.get_json, url, params)
 
 
-def get_city_timezone(latitude, longitude, url=URL_CURRENT, api_key=WEATHER_API_KEY):
+def get_city_timezone(latitude, longitude, url=None, api_key=WEATHER_API_KEY):
     """
     Fetches city timezone from OpenWeatherMap API
     :param latitude: city latitude
     :param longitude: city longitude
-    :param url: base url for API call
+    :param url: base url for API call, URL_CURRENT if omitted
     :param api_key: API key provided by OpenWeatherMap
     :return: timezone (i.e. time shift in seconds from UTC time)
     :rtype: int
     """
+    url = url or URL_CURRENT
     params = {'appid': api_key, 'lat': latitude, 'lon': longitude}
-    resp = requests.get(url, params=params)
+    data = get_json(url, params)
     try:
-        return resp.json()['timezone']
+        return data['timezone']
     except (KeyError, TypeError):
         raise KeyError(f'Unexpected response from {url}. Check url or try later')
 
 
-def get_day_hist_temp(day_num, latitude, longitude, url=URL_HISTORIC, api_key=WEATHER_API_KEY):
+def get_city_timezone_cached(latitude, longitude, country=None):
+    """
+    Returns city timezone from shared cache. Timezone is resolved offline if all zones of city country
+    have the same shift, otherwise (or if country is unknown) OpenWeatherMap API is requested once per city.
+    Cache key is made of coordinates rounded to TIMEZONE_PRECISION decimal places, so city timezone resolved
+    once with its country is reused by later calls with coordinates only
+    :param latitude: city latitude
+    :param longitude: city longitude
+    :param country: city country ISO code
+    :type country: Optional[str]
+    :return: timezone (i.e. time shift in seconds from UTC time)
+    :rtype: int
+    """
+    key = (round(latitude, TIMEZONE_PRECISION), round(longitude, TIMEZONE_PRECISION))
+    with _timezones_lock:
+        if key in _timezones:
+            return _timezones[key]
+    timezone = get_country_timezone(country)
+    if timezone is None:
+        timezone = request_flight.do(('timezone', key), get_city_timezone, latitude, longitude)
+    with _timezones_lock:
+        _timezones[key] = timezone
+    return timezone
+
+
+def get_day_hist_temp(day_num, latitude, longitude, url=None, api_key=WEATHER_API_KEY):
     """
     Gets one day temperatures list. Days possible range: from 5 days ago till current moment.
     Today temperatures list is provided for part of the day that has passed.
     :param day_num: day number in range (-5, 0)
     :param latitude: city latitude
     :param longitude: city longitude
-    :param url: base url for API calls for 5 days historic info
+    :param url: base url for API calls for 5 days historic info, URL_HISTORIC if omitted
     :param api_key: API key provided by OpenWeatherMap
     :return: list of day temperatures fixed every hour (24 values per day except today that is less)
     :rtype: List[float]
     """
+    url = url or URL_HISTORIC
     if not day_num:
         time_threshold = int(time.time() - 5)
     else:
-        timezone = get_city_timezone(latitude, longitude)
+        timezone = get_city_timezone_cached(latitude, longitude)
         time_threshold_local = prev_n_day_end_local(timezone, day_number=day_num)
         time_threshold = time_threshold_local - timezone
     params = {'appid': api_key, 'lat': latitude, 'lon': longitude, 'dt': time_threshold, 'units': 'metric'}
-    resp = requests.get(url, params=params)
-    data = resp.json()
+    data = get_json(url, params)
     try:
         day_temp_list = [record['temp'] for record in data['hourly']]
         return day_temp_list
@@ -61,43 +184,142 @@ def get_day_hist_temp(day_num, latitude, longitude, url=URL_HISTORIC, api_key=WE
         raise KeyError(f'Unexpected response from {url}. Check url or try later')
 
 
+def open_weather_cache(path, max_bytes=WEATHER_CACHE_BYTES):
+    """
+    Opens persistent weather cache. Entries have their own time to live: completed historic days never expire,
+    today temperatures and forecasts expire after WEATHER_TODAY_TTL and WEATHER_FORECAST_TTL seconds
+    :param path: path to cache file
+    :param max_bytes: maximal total size of cached responses in bytes
+    :rtype: PersistentCache
+    """
+    return PersistentCache(path, max_bytes=max_bytes)
+
+
+def weather_cache_key(endpoint, latitude, longitude, local_date):
+    """
+    Cache key made of endpoint, coordinates rounded to WEATHER_CACHE_PRECISION decimal places
+    (about 1 km, weather is the same for the whole city) and city local date
+    :param endpoint: weather endpoint name
+    :param latitude: city latitude
+    :param longitude: city longitude
+    :param local_date: city local date
+    :type local_date: datetime.date
+    :rtype: str
+    """
+    return (f'{endpoint}:{round(latitude, WEATHER_CACHE_PRECISION)}:'
+            f'{round(longitude, WEATHER_CACHE_PRECISION)}:{local_date.isoformat()}')
+
+
+def city_local_date(latitude, longitude, day_num=0):
+    """
+    Returns city local date of given day
+    :param latitude: city latitude
+    :param longitude: city longitude
+    :param day_num: day number in relation to current day
+    :rtype: datetime.date
+    """
+    today = ts_to_datetime(local_timestamp_now(get_city_timezone_cached(latitude, longitude))).date()
+    return today + datetime.timedelta(days=day_num)
+
+
+def submit_cached(cache, key, ttl, endpoint, function, *args):
+    """
+    Returns completed future with cached value or queues request to weather scheduler,
+    result of successful request is saved to cache before future is complete
+    :param cache: weather cache, None to send request anyway
+    :type cache: Optional[PersistentCache]
+    :param key: cache key
+    :param ttl: entry time to live in seconds, None for entry that never expires
+    :param endpoint: weather endpoint name
+    :param function: function sending request
+    :rtype: Future
+    """
+    blob = cache.get(key) if cache is not None else None
+    if blob is not None:
+        future = Future()
+        future.set_result(unpack_json(blob))
+        return future
+    if cache is None:
+        return weather_scheduler.submit(endpoint, function, *args)
+
+    def fetch_and_cache():
+        value = function(*args)
+        cache.set(key, pack_json(value), ttl=ttl)
+        return value
+    return weather_scheduler.submit(endpoint, fetch_and_cache)
+
+
+def submit_all_hist_temp(coords_tuple, cache=None, days=HISTORIC_DAYS):
+    """
+    Queues one historic temperatures request per day to weather scheduler: from given number of days ago
+    till current moment. Days found in weather cache are not requested
+    :param coords_tuple: latitude, longitude
+    :type coords_tuple: tuple[float]
+    :param cache: weather cache
+    :type cache: Optional[PersistentCache]
+    :param days: number of past days, up to HISTORIC_DAYS provided by weather service
+    :return: futures of day temperatures lists for past days plus part of today
+    :rtype: List[Future]
+    """
+    latitude, longitude = coords_tuple
+    futures = []
+    for day in range(-days, 1):
+        key = ttl = None
+        if cache is not None:
+            key = weather_cache_key('historic', latitude, longitude, city_local_date(latitude, longitude, day))
+            ttl = WEATHER_TODAY_TTL if not day else None
+        futures.append(submit_cached(cache, key, ttl, 'historic', get_day_hist_temp, day, latitude, longitude))
+    return futures
+
+
 def get_all_hist_temp(coords_tuple, threads=4):
     """
     Gets historic day temperature lists for all days in range: from 5 days ago till current moment.
     One list per day. Today temperatures list is provided for part of the day that has passed.
     :param coords_tuple: latitude, longitude
     :type coords_tuple: tuple[float]
-    :param threads: number of threads for parallel request to weather service API
+    :param threads: not used, requests concurrency is limited by weather scheduler (see configure_weather_client)
     :return: Lists of day temperatures for last 5 days plus part of today
-    :rtype: Generator[list[float]]
+    :rtype: List[list[float]]
+    """
+    return [future.result() for future in submit_all_hist_temp(coords_tuple)]
+
+
+def submit_forecast_temp_list(coord_tuple, cache=None):
+    """
+    Queues forecast temperatures request to weather scheduler if it is not found in weather cache
+    :param coord_tuple: latitude and longitude
+    :param cache: weather cache
+    :type cache: Optional[PersistentCache]
+    :return: future of today forecast temperatures and coming 4 days temperatures
+    :rtype: Future
     """
-    lat, lon = coords_tuple
-    get_city_day_temp = partial(get_day_hist_temp, latitude=lat, longitude=lon)
-    days = (day for day in range(-5, 1))
-    with ThreadPoolExecutor(max_workers=threads) as pool:
-        results = pool.map(get_city_day_temp, days)
-    return results
+    key = None
+    if cache is not None:
+        latitude, longitude = coord_tuple
+        key = weather_cache_key('forecast', latitude, longitude, city_local_date(latitude, longitude))
+    return submit_cached(cache, key, WEATHER_FORECAST_TTL, 'forecast', get_forecast_temp_list, coord_tuple)
 
 
-def get_forecast_temp_list(coord_tuple, url=URL_FORECAST, api_key=WEATHER_API_KEY):
+def get_forecast_temp_list(coord_tuple, url=None, api_key=WEATHER_API_KEY):
     """
     Gets today and 4 coming days temperature forecast
     :param coord_tuple: latitude and longitude
-    :param url: base url for API calls for forecast weather info
+    :param url: base url for API calls for forecast weather info, URL_FORECAST if omitted
     :param api_key: API key provided by OpenWeatherMap
     :return: tuple of 2 elements: list of today forecast temperatures and list of lists of coming 4 days temps
     :rtype: tuple[list[list],list[list[list]]]
     """
+    url = url or URL_FORECAST
     latitude, longitude = coord_tuple
-    tz_shift = get_city_timezone(latitude, longitude)
+    tz_shift = get_city_timezone_cached(latitude, longitude)
     threshold_ts = today_end_local_ts(tz_shift)
     params = {'appid': api_key, 'lat': latitude, 'lon': longitude, 'units': 'metric'}
-    resp = requests.get(url, params=params)
-    data = resp.json()
+    data = get_json(url, params)
     try:
         forecast_today = [record['main']['temp'] for record in data['list'] if record['dt'] < threshold_ts]
         forecast_4days_plus = [record['main']['temp'] for record in data['list'] if record['dt'] >= threshold_ts]
-        forecast_4days = [forecast_4days_plus[start:stop] for start, stop in ((0, 8), (8, 16), (16, 24), (24, 32))]
+        forecast_4days = [forecast_4days_plus[day * 8:(day + 1) * 8] for day in range(FORECAST_DAYS)]
         return forecast_today, forecast_4days
     except (KeyError, TypeError):
         raise KeyError(f'Unexpected response from {url}. Check url or try later')
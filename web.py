@@ -1,8 +1,8 @@
 from flask import Flask, render_template
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import and_
 
 from models import *
+from toolbox.db_tools import apply_sqlite_profile
 
 
 def configure_app(db_path='sqlite:///db.sqlite3'):
@@ -15,6 +15,8 @@ def configure_app(db_path='sqlite:///db.sqlite3'):
     app.config['SQLALCHEMY_DATABASE_URI'] = db_path
     app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
     db = SQLAlchemy(app)
+    with app.app_context():
+        apply_sqlite_profile(db.engine)
 
     @app.route('/')
     def home():
@@ -28,16 +30,8 @@ def configure_app(db_path='sqlite:///db.sqlite3'):
         """
         Hotels table with pagination and filter
         """
-        hotels = []
-        major_cities = db.session.query(MajorCity).all()
-        for major_city in major_cities:
-            city_hotels = db.session.query(Hotel).filter(
-                and_(
-                    Hotel.country == major_city.country,
-                    Hotel.city == major_city.city
-                )
-            ).all()
-            hotels.extend(city_hotels)
+        hotels = db.session.query(Hotel).filter(Hotel.major_city_id.isnot(None)).order_by(
+            Hotel.major_city_id, Hotel.id).all()
         return render_template('hotels.html', title='Hotels data', hotels=hotels)
 
     @app.route('/cities')